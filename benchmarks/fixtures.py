@@ -0,0 +1,119 @@
+# Synthetic, realistically sized inputs for the benchmarks.  Everything is
+# generated from a seed, so runs are comparable and fully offline.
+
+import random, datetime
+from collections import namedtuple
+
+
+FakeCell = namedtuple("FakeCell", "value")
+
+
+class FakeSheet:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_rows(self):
+        return iter(self.rows)
+
+
+class FakeBook:
+    # Just enough of xlrd's Book for the readers; stands in for
+    # xlrd.open_workbook, since xlrd cannot write workbooks.
+    datemode = 0
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def sheet_by_name(self, name):
+        return self.sheets[name]
+
+
+def country_names(count):
+    return [f"Country {i:03d}" for i in range(count)]
+
+
+def country_codes(count):
+    return ["".join(chr(ord("A") + i // 26**k % 26) for k in (2, 1, 0))
+            for i in range(count)]
+
+
+def cumulative_series(rng, days):
+    total = 0
+    series = []
+    for day in range(days):
+        total += int(rng.expovariate(1 / (1 + day))) if day > 20 else 0
+        series.append(total)
+    return series
+
+
+def jhu_csv_lines(provinces=3000, countries=190, days=900, seed=1):
+    rng = random.Random(seed)
+    start = datetime.date(2020, 1, 22)
+    dates = [start + datetime.timedelta(days=i) for i in range(days)]
+    header = ["Province/State", "Country/Region", "Lat", "Long"]
+    header += [f"{d.month}/{d.day}/{d.year % 100}" for d in dates]
+    lines = [",".join(header)]
+    names = country_names(countries)
+    for i in range(provinces):
+        row = [f"Province {i}", names[i % countries],
+               f"{rng.uniform(-60, 70):.4f}", f"{rng.uniform(-180, 180):.4f}"]
+        row += [str(n) for n in cumulative_series(rng, days)]
+        lines.append(",".join(row))
+    return lines
+
+
+def ecdc_book(countries=200, days=700, seed=2):
+    rng = random.Random(seed)
+    header = ["DateRep", "CountryExp", "NewConfCases", "NewDeaths", "GeoId",
+              "EU"]
+    rows = [[FakeCell(v) for v in header]]
+    first_serial = 43852.0      # 2020-01-22 in the 1900 date system
+    for name, code in zip(country_names(countries), country_codes(countries)):
+        for day in range(days):
+            cases = float(int(rng.expovariate(1 / (1 + day))))
+            rows.append([FakeCell(first_serial + day),
+                         FakeCell(name),
+                         FakeCell(cases),
+                         FakeCell(float(int(cases * 0.02))),
+                         FakeCell(code[:2]),
+                         FakeCell("Non-EU")])
+    return FakeBook({"CSV_4_COMS": FakeSheet(rows)})
+
+
+def worldbank_book(countries=264, first_year=1960, last_year=2019, seed=3):
+    rng = random.Random(seed)
+    years = list(range(first_year, last_year + 1))
+    rows = [
+        [FakeCell("Data Source"), FakeCell("World Development Indicators")],
+        [FakeCell("Last Updated Date"), FakeCell("2020-03-18")],
+        [FakeCell("")],
+    ]
+    header = ["Country Name", "Country Code", "Indicator Name",
+              "Indicator Code"]
+    rows.append([FakeCell(v) for v in header] +
+                [FakeCell(str(y)) for y in years])
+    for name, code in zip(country_names(countries), country_codes(countries)):
+        pop = rng.randint(10_000, 1_000_000_000)
+        values = [float(int(pop * (1 + 0.01 * i))) for i in range(len(years))]
+        # Some countries lack the latest years, like the real data.
+        for i in range(rng.choice([0, 0, 0, 1, 2])):
+            values[-1 - i] = ""
+        rows.append([FakeCell(name), FakeCell(code),
+                     FakeCell("Population, total"), FakeCell("SP.POP.TOTL")] +
+                    [FakeCell(v) for v in values])
+    return FakeBook({"Data": FakeSheet(rows)})
+
+
+def population_data(countries=264, seed=3):
+    from readers.popreader import PopData
+    rng = random.Random(seed)
+    return [PopData(name, code, 2019, rng.randint(10_000, 1_000_000_000))
+            for name, code in zip(country_names(countries),
+                                  country_codes(countries))]
+
+
+def template_text(lines=200):
+    body = [f"<p>Paragraph {i} with some text.</p>\n" for i in range(lines)]
+    body.insert(lines // 2, "<!-- INSERT MAP -->\n")
+    body.insert(1, "<p>Updated <!-- INSERT DATE -->.</p>\n")
+    return "".join(body)
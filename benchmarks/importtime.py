@@ -0,0 +1,82 @@
+# Tracks the startup cost of the CLIs using `python -X importtime`.
+#
+#   python -m benchmarks.importtime            # measure and print
+#   python -m benchmarks.importtime --record   # also append to history
+#   python -m benchmarks.importtime --check    # fail if heavy libs load
+
+import sys, json, time, subprocess
+from pathlib import Path
+
+
+ROOT = Path(__file__).parent.parent
+
+HISTORY_FILE = Path(__file__).parent / "importtime_history.jsonl"
+
+TARGETS = [
+    "plots",
+    "stats",
+    "readers.ecdc_reader",
+    "readers.jhucsse_reader",
+    "readers.popreader",
+]
+
+# Libraries that must only be imported when they are actually used.
+HEAVY_MODULES = ["plotly", "pandas", "requests", "xlrd"]
+
+
+def measure(module, repeat=5):
+    best = None
+    code = (f"import sys, json, {module}; "
+            "print(json.dumps(sorted(sys.modules)))")
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                              cwd=ROOT, capture_output=True, text=True,
+                              check=True)
+        total = parse_importtime(proc.stderr, module)
+        if best is None or total < best:
+            best = total
+        loaded = json.loads(proc.stdout)
+    heavy = sorted(m for m in loaded if m in HEAVY_MODULES)
+    return dict(module=module, cumulative_us=best, heavy_modules=heavy)
+
+
+def parse_importtime(stderr, module):
+    # Lines look like "import time:   self [us] | cumulative | name".
+    prefix = "import time:"
+    for line in stderr.splitlines():
+        if not line.startswith(prefix):
+            continue
+        self_us, cumulative_us, name = line[len(prefix):].split("|")
+        if name.strip() == module:
+            return int(cumulative_us)
+    raise ValueError(f"No import time reported for {module!r}")
+
+
+def git_revision():
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          cwd=ROOT, capture_output=True, text=True)
+    return proc.stdout.strip() or None
+
+
+def main():
+    args = sys.argv[1:]
+    results = [measure(m) for m in TARGETS]
+    for r in results:
+        heavy = ", ".join(r["heavy_modules"]) or "-"
+        print(f"{r['module']:<24} {r['cumulative_us'] / 1000:8.1f} ms"
+              f"   heavy: {heavy}")
+
+    if "--record" in args:
+        entry = dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     revision=git_revision(),
+                     python=sys.version.split()[0],
+                     results=results)
+        with open(HISTORY_FILE, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    if "--check" in args and any(r["heavy_modules"] for r in results):
+        sys.exit("Heavy modules imported at startup")
+
+
+if __name__ == "__main__":
+    main()
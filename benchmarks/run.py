@@ -0,0 +1,310 @@
+# Offline benchmarks for the hot paths, on synthetic fixtures.
+#
+#   python -m benchmarks.run                  # run everything
+#   python -m benchmarks.run sum_days ...     # run selected benchmarks
+#   python -m benchmarks.run --quick          # smaller inputs
+#   python -m benchmarks.run --save-baseline  # store results as baseline
+#   python -m benchmarks.run --check          # fail on regressions
+
+import sys, io, json, time, tracemalloc
+from pathlib import Path
+from collections import namedtuple
+from unittest.mock import patch
+
+from benchmarks import fixtures
+
+
+BASELINE_FILE = Path(__file__).parent / "baseline.json"
+
+# Slowdown relative to the baseline that counts as a regression.
+REGRESSION_THRESHOLD = 1.25
+
+# setup(scale) returns (state, item count); run(state) is what is timed.
+Benchmark = namedtuple("Benchmark", "name setup run unit")
+
+Result = namedtuple("Result", "name seconds items unit peak_bytes")
+
+benchmarks = []
+
+
+def benchmark(setup, unit="rows", name=None):
+    def register(run):
+        benchmarks.append(Benchmark(name or run.__name__, setup, run, unit))
+        return run
+    return register
+
+
+def jhu_setup(scale):
+    lines = fixtures.jhu_csv_lines(provinces=int(3000 * scale),
+                                   days=int(900 * scale) or 1)
+    return lines, len(lines) - 1
+
+
+def records_setup(scale):
+    import readers.jhucsse_reader as jhu
+    lines, count = jhu_setup(scale)
+    return list(jhu.parse_stream(iter(lines))), count
+
+
+def ecdc_setup(scale):
+    book = fixtures.ecdc_book(countries=200, days=int(700 * scale) or 1)
+    return book, len(book.sheets["CSV_4_COMS"].rows) - 1
+
+
+def worldbank_setup(scale):
+    book = fixtures.worldbank_book()
+    return book, len(book.sheets["Data"].rows)
+
+
+def store_setup(scale):
+    import readers.ecdc_reader as ecdc
+    book, count = ecdc_setup(scale)
+    with patch("xlrd.open_workbook", lambda filename, **kwargs: book):
+        return ecdc.read_store("synthetic.xls"), count
+
+
+def density_setup(scale):
+    import stats
+    store, _ = store_setup(scale)
+    data = list(stats.density_from_totals(stats.sum_days(store),
+                                          fixtures.population_data()))
+    data.append(("China", "CHN", 81_000, 56.3))
+    return data, len(data)
+
+
+def animation_setup(scale):
+    import stats, plots
+    from readers.popindex import build_index
+    store, _ = store_setup(scale)
+    index = build_index(fixtures.population_data())
+    metrics, _ = stats.load_metrics(lambda: store, popcount=index)
+    animation = plots.animation_data(metrics, index, "density", step=1)
+    return animation, len(animation.dates)
+
+
+def points_setup(scale):
+    import readers.jhucsse_reader as jhu
+    lines, count = jhu_setup(scale)
+    return jhu.points_from_table(jhu.parse_table(iter(lines))), count
+
+
+def template_setup(scale):
+    data, _ = density_setup(scale)
+    import plots
+    map_html = plots.make_map(data)
+    return (fixtures.template_text(), map_html), len(map_html)
+
+
+@benchmark(jhu_setup)
+def parse_stream(lines):
+    import readers.jhucsse_reader as jhu
+    for _ in jhu.parse_stream(iter(lines)):
+        pass
+
+
+@benchmark(jhu_setup)
+def load_records(lines):
+    # Keeps every record, so the peak memory is what a loaded file costs.
+    import readers.jhucsse_reader as jhu
+    return list(jhu.parse_stream(iter(lines)))
+
+
+@benchmark(jhu_setup)
+def parse_table(lines):
+    import readers.jhucsse_reader as jhu
+    jhu.casestore_from_table(jhu.parse_table(iter(lines)))
+
+
+@benchmark(records_setup)
+def casedaydata_from_records(records):
+    import readers.jhucsse_reader as jhu
+    for _ in jhu.casedaydata_from_records(iter(records)):
+        pass
+
+
+@benchmark(ecdc_setup)
+def read_file(book):
+    import readers.ecdc_reader as ecdc
+    with patch("xlrd.open_workbook", lambda filename, **kwargs: book):
+        for _ in ecdc.read_file("synthetic.xls"):
+            pass
+
+
+@benchmark(worldbank_setup)
+def parse_data(book):
+    import readers.popreader as popreader
+    with patch("xlrd.open_workbook", lambda filename, **kwargs: book):
+        list(popreader.parse_data(popreader.read_data_rows("synthetic.xls")))
+
+
+@benchmark(store_setup)
+def sum_days(store):
+    import stats
+    list(stats.sum_days(store))
+
+
+@benchmark(store_setup)
+def sum_days_streaming(store):
+    import stats
+    list(stats.sum_days_streaming(iter(store)))
+
+
+@benchmark(ecdc_setup)
+def sum_days_from_reader(book):
+    # Streaming straight from the reader's rows, without a store.
+    import stats
+    import readers.ecdc_reader as ecdc
+    with patch("xlrd.open_workbook", lambda filename, **kwargs: book):
+        list(stats.sum_days_streaming(ecdc.read_rows("synthetic.xls")))
+
+
+@benchmark(store_setup)
+def case_density(store):
+    import stats
+    from readers.popindex import build_index
+    index = build_index(fixtures.population_data())
+    list(stats.case_density(lambda: store, popcount=index))
+
+
+@benchmark(store_setup)
+def country_metrics(store):
+    import stats
+    from readers.popindex import build_index
+    index = build_index(fixtures.population_data())
+    stats.country_metrics(lambda: store, popcount=index)
+
+
+def series_setup(scale):
+    import stats
+    from readers.popindex import build_index
+    store, _ = store_setup(scale)
+    series = stats.case_series(lambda: store)
+    return (series, build_index(fixtures.population_data())), len(store)
+
+
+def with_pool(setup, workers):
+    # Starts the shared worker pool, and has its processes import
+    # parallel, outside the timed run.
+    def pool_setup(scale):
+        import parallel
+        if workers > 1:
+            list(parallel.executor(workers).map(
+                parallel.partitions, [1] * 4 * workers, [1] * 4 * workers))
+        return setup(scale)
+    return pool_setup
+
+
+# Scaling of the multi-process aggregation with the number of workers.
+for workers in (1, 2, 4, 8):
+    @benchmark(with_pool(store_setup, workers),
+               name=f"sum_days_workers_{workers}")
+    def sum_days_workers(store, workers=workers):
+        import stats
+        list(stats.sum_days(store, workers))
+
+    @benchmark(with_pool(series_setup, workers),
+               name=f"metrics_workers_{workers}")
+    def metrics_workers(state, workers=workers):
+        import stats
+        series, index = state
+        stats.metrics_from_series(series, index, workers=workers)
+
+
+@benchmark(animation_setup, "frames")
+def write_animation(animation):
+    import plots
+    options = plots.DEFAULT_OPTIONS._replace(plotlyjs="cdn", animate=1)
+    plots.write_animation(io.StringIO(), animation, options)
+
+
+@benchmark(points_setup, "regions")
+def province_map(points):
+    import plots, geogrid
+    options = plots.DEFAULT_OPTIONS._replace(plotlyjs="cdn", provinces=True)
+    plots.write_province_map(io.StringIO(), geogrid.levels(points), options)
+
+
+@benchmark(density_setup, "countries")
+def write_map(data):
+    import plots
+    plots.write_map(io.StringIO(), data)
+
+
+@benchmark(template_setup, "bytes")
+def process_template(args):
+    import plots
+    template, map_html = args
+    plots.process_template(io.StringIO(template), io.StringIO(),
+                           {"map": map_html, "date": "2020-03-20"})
+
+
+def measure(bench, scale, repeat):
+    state, items = bench.setup(scale)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bench.run(state)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        bench.run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Result(bench.name, min(times), items, bench.unit, peak)
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results):
+    with open(BASELINE_FILE, "w") as f:
+        json.dump({r.name: r._asdict() for r in results}, f, indent=2,
+                  sort_keys=True)
+        f.write("\n")
+
+
+def report(results, baseline):
+    regressions = []
+    print(f"{'benchmark':<26}{'time':>10}{'throughput':>20}"
+          f"{'peak mem':>12}{'vs base':>9}")
+    for r in results:
+        rate = r.items / r.seconds if r.seconds else float("inf")
+        line = (f"{r.name:<26}{r.seconds * 1000:>8.1f}ms"
+                f"{rate:>14,.0f} {r.unit + '/s':<5}"
+                f"{r.peak_bytes / 2**20:>10.1f}MB")
+        base = baseline.get(r.name)
+        if base and base["items"] == r.items:
+            ratio = r.seconds / base["seconds"]
+            line += f"{ratio:>8.2f}x"
+            if ratio > REGRESSION_THRESHOLD:
+                regressions.append(r.name)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def main():
+    args = sys.argv[1:]
+    scale = 0.1 if "--quick" in args else 1.0
+    repeat = 1 if "--quick" in args else 3
+    names = [a for a in args if not a.startswith("--")]
+    selected = [b for b in benchmarks if not names or b.name in names]
+
+    results = [measure(b, scale, repeat) for b in selected]
+    regressions = report(results, load_baseline())
+
+    if "--save-baseline" in args:
+        save_baseline(results)
+    if "--check" in args and regressions:
+        sys.exit(f"Regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Aggregates lat/long points into grid cells of a few sizes, so a map can
+# show one marker per cell instead of one per region, at each zoom level.
+
+from collections import namedtuple
+
+import numpy as np
+
+
+# Cell sizes in degrees, coarsest first.
+RESOLUTIONS = (10, 5, 2, 1, 0.5)
+
+# Levels with more cells than this are left out; finer zoom then keeps
+# showing the finest level that fits.
+MAX_CELLS = 2000
+
+# One marker per non-empty cell: the case-weighted centroid, the summed
+# count, the name of the largest region and the number of regions in it.
+Cells = namedtuple("Cells", "resolution lats longs cases names regions")
+
+
+def aggregate(points, resolution):
+    lats = np.asarray(points.lats, dtype=np.float64)
+    longs = np.asarray(points.longs, dtype=np.float64)
+    cases = np.asarray(points.cases, dtype=np.float64)
+    known = np.isfinite(lats) & np.isfinite(longs)
+    lats, longs, cases = lats[known], longs[known], cases[known]
+    names = np.asarray(points.names, dtype=object)[known]
+    if not len(lats):
+        empty = np.zeros(0)
+        return Cells(resolution, empty, empty, empty, [], empty)
+
+    row = np.floor((lats + 90) / resolution).astype(np.int64)
+    col = np.floor((longs + 180) / resolution).astype(np.int64)
+    columns = int(np.ceil(360 / resolution)) + 1
+    _, cell = np.unique(row * columns + col, return_inverse=True)
+    cell = cell.ravel()
+    n = cell.max() + 1
+
+    total = np.bincount(cell, weights=cases, minlength=n)
+    regions = np.bincount(cell, minlength=n)
+    # Centroids weighted by cases, falling back to the plain mean for
+    # cells without any.
+    weights = np.where(total[cell] > 0, cases, 1.0)
+    weight_sum = np.bincount(cell, weights=weights, minlength=n)
+    cell_lats = np.bincount(cell, weights=lats * weights, minlength=n)
+    cell_longs = np.bincount(cell, weights=longs * weights, minlength=n)
+
+    # The largest region of each cell comes first when sorted by cell,
+    # then by descending count.
+    order = np.lexsort((-cases, cell))
+    first = order[np.flatnonzero(np.diff(cell[order], prepend=-1))]
+    return Cells(resolution=resolution,
+                 lats=cell_lats / weight_sum,
+                 longs=cell_longs / weight_sum,
+                 cases=total,
+                 names=names[first].tolist(),
+                 regions=regions)
+
+
+def levels(points, resolutions=RESOLUTIONS, max_cells=MAX_CELLS):
+    result = []
+    for resolution in resolutions:
+        cells = aggregate(points, resolution)
+        if result and len(cells.cases) > max_cells:
+            break
+        if result and len(cells.cases) == len(result[-1].cases):
+            continue            # same cells as the coarser level
+        result.append(cells)
+    return result
@@ -0,0 +1,157 @@
+# Per-country aggregation on several cores.  The input and output arrays
+# live in shared memory, so a worker process only receives their names
+# and the range of countries it works on.  Every country is computed by
+# exactly one worker, which keeps the results identical to the serial
+# computation.
+
+import threading
+import multiprocessing
+from itertools import repeat
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import timeseries
+
+
+SharedArray = namedtuple("SharedArray", "name shape dtype")
+
+METRIC_FIELDS = ("cumulative", "density", "incidence_7", "incidence_14",
+                 "growth", "doubling_time")
+
+
+class SharedArrays:
+    # Copies of the given arrays in shared memory, freed on close().
+    # Only copies ever leave this object, so no view can outlive a block.
+    def __init__(self, **arrays):
+        self.blocks = {}
+        self.descriptors = {}
+        try:
+            for key, a in arrays.items():
+                a = np.ascontiguousarray(a)
+                block = shared_memory.SharedMemory(create=True,
+                                                   size=max(a.nbytes, 1))
+                self.blocks[key] = block
+                np.ndarray(a.shape, a.dtype, buffer=block.buf)[...] = a
+                self.descriptors[key] = SharedArray(block.name, a.shape,
+                                                    a.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+
+    def copy(self, key):
+        d = self.descriptors[key]
+        return np.ndarray(d.shape, np.dtype(d.dtype),
+                          buffer=self.blocks[key].buf).copy()
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def partitions(n, parts):
+    bounds = np.linspace(0, n, max(1, min(parts, n)) + 1).astype(int)
+    return [(lo, hi) for lo, hi in zip(bounds[:-1].tolist(),
+                                       bounds[1:].tolist()) if hi > lo]
+
+
+# One pool for the whole process, started with spawn: forking while
+# other threads run (the loader threads, the server's refresh thread)
+# can leave a lock held forever in the child.
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def executor(workers):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers < workers:
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        return _executor
+
+
+def run_partitions(func, shared, bounds, workers, *args):
+    return list(executor(workers).map(_run, repeat(func),
+                                      repeat(shared.descriptors), bounds,
+                                      *(repeat(a) for a in args)))
+
+
+def _run(func, descriptors, bounds, *args):
+    blocks = [shared_memory.SharedMemory(name=d.name)
+              for d in descriptors.values()]
+    try:
+        arrays = {key: np.ndarray(d.shape, np.dtype(d.dtype),
+                                  buffer=block.buf)
+                  for (key, d), block in zip(descriptors.items(), blocks)}
+        result = func(arrays, *bounds, *args)
+        arrays.clear()
+        return result
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def sum_by_country(store, workers=1):
+    # Each worker sums the rows of a range of countries, so the ranges
+    # are simply put side by side.
+    n = len(store.countries)
+    if workers <= 1 or n < 2:
+        return store.sum_by_country()
+    with SharedArrays(country_index=store.country_index,
+                      cases=store.cases, deaths=store.deaths) as shared:
+        parts = run_partitions(_sum_countries, shared,
+                               partitions(n, workers), workers)
+    return (np.concatenate([cases for cases, _ in parts]),
+            np.concatenate([deaths for _, deaths in parts]))
+
+
+def _sum_countries(arrays, lo, hi):
+    country_index = arrays["country_index"]
+    rows = (country_index >= lo) & (country_index < hi)
+    index = country_index[rows] - lo
+    cases = np.zeros(hi - lo, dtype=np.int64)
+    deaths = np.zeros(hi - lo, dtype=np.int64)
+    np.add.at(cases, index, arrays["cases"][rows])
+    np.add.at(deaths, index, arrays["deaths"][rows])
+    return cases, deaths
+
+
+def compute_metrics(series, population, workers=1):
+    # Partitioned by country: each worker writes the rows of its countries
+    # straight into the shared output matrices.
+    n = len(series.countries)
+    if workers <= 1 or n < 2:
+        return timeseries.compute(series, population)
+    shape = series.cases.shape
+    outputs = {field: np.zeros(shape, dtype=np.int64 if field == "cumulative"
+                               else np.float64)
+               for field in METRIC_FIELDS}
+    with SharedArrays(cases=series.cases,
+                      population=np.asarray(population, dtype=np.float64),
+                      **outputs) as shared:
+        run_partitions(_metric_rows, shared, partitions(n, workers), workers)
+        matrices = {field: shared.copy(field) for field in METRIC_FIELDS}
+    return timeseries.Metrics(countries=series.countries,
+                              dates=timeseries.dates(series), **matrices)
+
+
+def _metric_rows(arrays, lo, hi):
+    matrices = timeseries.metric_matrices(arrays["cases"][lo:hi],
+                                          arrays["population"][lo:hi])
+    for field, matrix in matrices.items():
+        arrays[field][lo:hi] = matrix
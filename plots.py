@@ -1,122 +1,865 @@
 # https://plot.ly/python/map-configuration/
 # https://plot.ly/python/choropleth-maps/
 
-import sys, time, re
+import os, sys, time, re, datetime, multiprocessing
 from pathlib import Path
 from io import StringIO
 from math import log10
-
-import plotly.graph_objects as go
-import plotly.express as px
-import numpy as np
-from pandas import DataFrame
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 import stats, readers
+from readers import instrument, make_filter
+from readers.loader import unwrap
+from rendercache import RenderCache
+
+
+# One page to render: which source it shows, and where it comes from/goes.
+Job = namedtuple("Job", "source_name template output")
+
+RENDER_CACHE_DIR = Path(__file__).parent / "cache" / "render"
+
+# Bump when write_map renders the same data differently.
+RENDER_VERSION = 1
+
+# Set by main() unless --no-render-cache is given.
+render_cache = None
+
+# compact: trimmed figure JSON with display-precision numbers.
+# plotlyjs: include_plotlyjs value for plotly (True, "cdn" or a .js URL).
+# precompress: also write .gz (and .br, if brotli is installed) pages.
+# metric: key of METRICS used to color the map.
+# animate: None for a single map, or the number of days between the
+# frames of an animated map.
+# provinces: show sub-national case counts as markers instead.
+OutputOptions = namedtuple(
+    "OutputOptions",
+    "compact plotlyjs precompress metric animate provinces",
+    defaults=("density", None, False))
+
+DEFAULT_OPTIONS = OutputOptions(compact=False, plotlyjs=True,
+                                precompress=False)
+
+# How to show each selectable color value: the colorbar title, the hover
+# label, the stats.MetricRow field it comes from and whether to use a
+# logarithmic scale.
+MapMetric = namedtuple("MapMetric", "title label field log")
+
+METRICS = {
+    "density": MapMetric("Cases/million", "Cases per million", "density",
+                         True),
+    "incidence7": MapMetric("7-day cases/million",
+                            "Cases per million, last 7 days",
+                            "incidence_7", True),
+    "incidence14": MapMetric("14-day cases/million",
+                             "Cases per million, last 14 days",
+                             "incidence_14", True),
+    "growth": MapMetric("Weekly growth (%)", "Growth over last week (%)",
+                        "growth", False),
+    "doubling": MapMetric("Doubling time (days)", "Doubling time (days)",
+                          "doubling_time", False),
+}
+
+
+def write_map(outfile, data, options=DEFAULT_OPTIONS):
+    with instrument.span("render"):
+        _write_map(outfile, data, options)
+
+
+def _write_map(outfile, data, options):
+    # Deferred so that --help and non-rendering paths start quickly.
+    import numpy as np
+
+    #print(sorted(data, key=lambda r: r[3]))
+
+    metric = METRICS[options.metric]
+    values = np.array([value for _, _, _, value in data])
+    prc_density = next((value for name, _, _, value in data
+                        if name == "China"), None)
+    clip_min, clip_max = color_range(values, options.metric, prc_density)
+    color_data = color_values(values, metric, clip_min, clip_max)
+
+    if options.compact:
+        fig = compact_figure(data, color_data, metric.label)
+    else:
+        fig = full_figure(data, color_data, metric.label)
+    update_colorbar(fig, metric, clip_min, clip_max, options.compact)
+    fig.write_html(file=outfile, full_html=False, auto_open=False,
+                   include_plotlyjs=options.plotlyjs)
 
 
-def write_map(outfile, data):
+def color_range(values, metric_name, prc_density=None):
+    import numpy as np
+    values = values[np.isfinite(values)]
+    positive = values[values > 0]
+    if metric_name == "density" and prc_density:
+        # For clarity, clip color values to 150% of the PRC value
+        # and use a logarithmic scale.
+        clip_min = positive.min() if len(positive) else 1
+        return clip_min, prc_density * 1.5
+    # No reference country for the rates: clip the extreme 2% instead.
+    log = METRICS[metric_name].log
+    if log:
+        values = positive
+    if not len(values):
+        return 1, 10
+    clip_min = np.percentile(values, 2)
+    clip_max = np.percentile(values, 98)
+    if clip_max <= clip_min:
+        clip_max = clip_min * 10 if log else clip_min + 1
+    return clip_min, clip_max
+
+
+def color_values(values, metric, clip_min, clip_max):
+    import numpy as np
+    color_data = np.clip(values, clip_min, clip_max)
+    return np.log10(color_data) if metric.log else color_data
+
+
+def update_colorbar(fig, metric, clip_min, clip_max, compact):
+    import plotly.express as px
+    fig.update_layout(height=1000)
+    fig.update_coloraxes(colorscale=px.colors.sequential.YlOrRd)
+
+    if metric.log:
+        low, high = log10(clip_min), log10(clip_max)
+    else:
+        low, high = clip_min, clip_max
+    tick_count = 10
+    tick_step = (high - low) / (tick_count - 1)
+    ticks = [low + tick_step * i for i in range(tick_count)]
+    if compact:
+        ticks = [round(x, 4) for x in ticks]
+
+    fig.update_layout(
+        coloraxis_colorbar=dict(
+            title=metric.title,
+            tickvals=ticks,
+            ticktext=[f"{10**x if metric.log else x:.2f}" for x in ticks],
+        ))
+
+
+def full_figure(data, color_data, label="Cases per million"):
+    import plotly.express as px
+    from pandas import DataFrame
+
     names, codes, cases, densities = zip(*data)
     df = DataFrame(dict(iso_alpha=codes,
                         cases=cases,
                         density=densities,
                         country=names))
-
-    #print(sorted(data, key=lambda r: r[3]))
-
-    # For clarity, clip color values to 150% of the PRC value
-    # and use a logarithmic scale.
-    prc_density = next(density for name, code, case, density in data
-                       if name == "China")
-    min_density = min(density for name, code, case, density in data)
-    clip_max = prc_density * 1.5
-    color_data = np.log10(np.clip(df["density"], min_density, clip_max))
-
-    # TODO: How can I use hovertemplate here?
-    fig = px.choropleth(
+    return px.choropleth(
         df,
         locations="iso_alpha",
         color=color_data,
         hover_name="country",
         hover_data=["cases", "density"],
         labels={"cases": "Confirmed cases",
-                "density": "Cases per million",
+                "density": label,
                 "iso_alpha": "Country code",
                 "color": "Color value"},
-        height=1000,
-        color_continuous_scale=px.colors.sequential.YlOrRd,
     )
 
-    tick_count = 10
-    tick_step = (log10(clip_max) - log10(min_density)) / (tick_count - 1)
-    ticks = [log10(min_density) + tick_step * i
-             for i in range(tick_count)]
 
+def compact_figure(data, color_data, label="Cases per million"):
+    # One trace with every array sent once, rounded to what is displayed:
+    # the hover text comes from customdata via a template instead of
+    # plotly express' duplicated hover fields.
+    import plotly.graph_objects as go
+
+    names, codes, cases, densities = zip(*data)
+    fig = go.Figure(go.Choropleth(
+        locations=codes,
+        z=[round(z, 3) for z in color_data.tolist()],
+        text=names,
+        customdata=[[c, round(d, 2)] for c, d in zip(cases, densities)],
+        hovertemplate=("<b>%{text}</b><br>"
+                       "Confirmed cases: %{customdata[0]}<br>"
+                       f"{label}: %{{customdata[1]}}"
+                       "<extra></extra>"),
+        coloraxis="coloraxis",
+    ))
+    return fig
+
+
+# One frame per reporting date, or per step days ending with the latest
+# date; values is a (countries, frames) matrix of the metric.
+Animation = namedtuple("Animation", "names codes dates values")
+
+# Rebuilds the frames from the first frame and the per-frame changes, then
+# adds the date slider.  Color values are derived here, not sent.
+ANIMATION_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var a = %s;
+var values = a.first.slice(), frames = [];
+function color(v) {
+    if (v === null) return null;
+    v = Math.min(Math.max(v, a.low), a.high);
+    return a.log ? Math.round(Math.log10(v) * 1000) / 1000 : v;
+}
+for (var k = 0; k < a.dates.length; k++) {
+    if (k > 0) {
+        var d = a.deltas[k - 1];
+        for (var i = 0; i < d[0].length; i++) values[d[0][i]] = d[1][i];
+    }
+    frames.push({name: a.dates[k], traces: [0],
+                 data: [{z: values.map(color), customdata: values.slice()}],
+                 layout: {title: {text: a.title + ", " + a.dates[k]}}});
+}
+var steps = a.dates.map(function (name) {
+    return {label: name, method: "animate",
+            args: [[name], {mode: "immediate",
+                            frame: {duration: 0, redraw: true},
+                            transition: {duration: 0}}]};
+});
+Plotly.addFrames(gd, frames).then(function () {
+    Plotly.relayout(gd, {sliders: [{active: a.dates.length - 1,
+                                    steps: steps, pad: {t: 30},
+                                    currentvalue: {prefix: "Date: "}}]});
+});
+"""
+
+
+def collect_history(data_source, popcount=None, metric="density", step=7,
+                    workers=1, as_of=None):
+    where = make_filter(exclude=excluded_countries)
+    metrics, popcount = stats.load_metrics(data_source, popcount=popcount,
+                                           where=where, workers=workers,
+                                           as_of=as_of)
+    return animation_data(metrics, popcount, metric, step)
+
+
+def animation_data(metrics, popcount, metric="density", step=7):
+    import numpy as np
+    from readers.popindex import as_population_index
+    index = as_population_index(popcount)
+    values = getattr(metrics, METRICS[metric].field)
+    if metric == "growth":
+        values = values * 100
+    columns = np.arange(len(metrics.dates) - 1, -1, -step)[::-1]
+    return Animation(names=list(metrics.countries),
+                     codes=[index.code(c) for c in metrics.countries],
+                     dates=[metrics.dates[i].isoformat() for i in columns],
+                     values=values[:, columns])
+
+
+def delta_frames(values, decimals=2):
+    # The first frame in full, then for each further frame only the
+    # countries whose (rounded) value changed: ([indices], [values]).
+    import numpy as np
+    values = np.round(values, decimals)
+    missing = ~np.isfinite(values)
+    values[missing] = np.nan
+    changed = ~((values[:, 1:] == values[:, :-1]) |
+                (missing[:, 1:] & missing[:, :-1]))
+    first = _json_values(values[:, 0]) if values.shape[1] else []
+    deltas = []
+    for k in range(1, values.shape[1]):
+        rows = np.flatnonzero(changed[:, k - 1])
+        deltas.append([rows.tolist(), _json_values(values[rows, k])])
+    return first, deltas
+
+
+def _json_values(column):
+    return [None if v != v else v for v in column.tolist()]
+
+
+def write_animation(outfile, animation, options=DEFAULT_OPTIONS):
+    with instrument.span("render.animation"):
+        html = _animation_html(animation, options)
+    instrument.count("animation_frames", len(animation.dates))
+    instrument.count("animation_bytes", len(html))
+    outfile.write(html)
+
+
+def _animation_html(animation, options):
+    import json
+    import plotly.graph_objects as go
+
+    metric = METRICS[options.metric]
+    if not animation.dates:
+        raise ValueError("No dates to animate")
+    prc_density = None
+    if "China" in animation.names:
+        prc_density = animation.values[animation.names.index("China"), -1]
+    clip_min, clip_max = color_range(animation.values, options.metric,
+                                     prc_density)
+    first, deltas = delta_frames(animation.values)
+    payload = dict(dates=animation.dates, first=first, deltas=deltas,
+                   low=float(clip_min), high=float(clip_max),
+                   log=metric.log, title=metric.title)
+
+    # The figure holds the last frame, so the page is complete even
+    # before the script has built the others.
+    last = animation.values[:, -1]
+    fig = go.Figure(go.Choropleth(
+        locations=animation.codes,
+        z=[None if z != z else round(z, 3) for z in
+           color_values(last, metric, clip_min, clip_max).tolist()],
+        text=animation.names,
+        customdata=_json_values(last.round(2)),
+        hovertemplate=("<b>%{text}</b><br>"
+                       f"{metric.label}: %{{customdata}}"
+                       "<extra></extra>"),
+        coloraxis="coloraxis",
+    ))
+    update_colorbar(fig, metric, clip_min, clip_max, compact=True)
+    play = dict(frame=dict(duration=300, redraw=True), fromcurrent=True)
+    pause = dict(mode="immediate", frame=dict(duration=0, redraw=False))
     fig.update_layout(
-        coloraxis_colorbar=dict(
-            title="Cases/million",
-            tickvals=ticks,
-            ticktext=[f"{10**x:.2f}" for x in ticks],
+        title=f"{metric.title}, {animation.dates[-1]}",
+        updatemenus=[dict(type="buttons", showactive=False, x=0, y=0,
+                          buttons=[
+                              dict(label="Play", method="animate",
+                                   args=[None, play]),
+                              dict(label="Pause", method="animate",
+                                   args=[[None], pause]),
+                          ])])
+    script = ANIMATION_SCRIPT % json.dumps(payload, separators=(",", ":"))
+    return fig.to_html(full_html=False, include_plotlyjs=options.plotlyjs,
+                       post_script=script, auto_play=False)
+
+
+# Shows the finest grid level that suits the current zoom of the map.
+ZOOM_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var minScales = %s, shown = 0;
+gd.on('plotly_relayout', function (update) {
+    var scale = update['geo.projection.scale'], level = 0;
+    if (scale === undefined) {
+        var projection = (gd.layout.geo || {}).projection || {};
+        scale = projection.scale || 1;
+    }
+    for (var i = 0; i < minScales.length; i++) {
+        if (scale >= minScales[i]) level = i;
+    }
+    if (level === shown) return;
+    shown = level;
+    Plotly.restyle(gd, {visible: minScales.map(function (_, i) {
+        return i === level;
+    })});
+});
+"""
+
+
+def collect_provinces(data_source, as_of=None):
+    import geogrid
+    if not hasattr(data_source, "provinces"):
+        raise Exception(f"No province data in {data_source.name}")
+    where = make_filter(exclude=excluded_countries)
+    points = stats.open_source(data_source, where, as_of).provinces()
+    with instrument.span("aggregate.grid"):
+        return geogrid.levels(points)
+
+
+def write_province_map(outfile, cell_levels, options=DEFAULT_OPTIONS):
+    with instrument.span("render.provinces"):
+        html = _province_map_html(cell_levels, options)
+    instrument.count("province_markers",
+                     sum(len(c.cases) for c in cell_levels))
+    outfile.write(html)
+
+
+def _province_map_html(cell_levels, options):
+    import json
+    import plotly.graph_objects as go
+
+    if not any(len(c.cases) for c in cell_levels):
+        raise ValueError("No province data to show")
+    largest = max(c.cases.max() for c in cell_levels if len(c.cases)) or 1
+    fig = go.Figure()
+    for i, cells in enumerate(cell_levels):
+        text = [name if n == 1 else f"{name} and {n - 1} more"
+                for name, n in zip(cells.names, cells.regions.tolist())]
+        fig.add_trace(go.Scattergeo(
+            lat=cells.lats.round(3),
+            lon=cells.longs.round(3),
+            text=text,
+            customdata=cells.cases.astype(int),
+            hovertemplate=("<b>%{text}</b><br>"
+                           "Confirmed cases: %{customdata}<extra></extra>"),
+            marker=dict(size=cells.cases, sizemode="area",
+                        sizeref=2 * largest / 40 ** 2, sizemin=2,
+                        color="#d7301f", opacity=0.6, line_width=0),
+            name=f"{cells.resolution}\u00b0 grid",
+            visible=i == 0,
         ))
+    fig.update_layout(height=1000, showlegend=False,
+                      geo=dict(showcountries=True,
+                               projection_type="natural earth"))
+
+    # Each finer level takes over once the map is zoomed in far enough
+    # for its cells to be as large on screen as the coarsest level's.
+    coarsest = cell_levels[0].resolution
+    min_scales = [coarsest / c.resolution for c in cell_levels]
+    script = ZOOM_SCRIPT % json.dumps(min_scales)
+    return fig.to_html(full_html=False, include_plotlyjs=options.plotlyjs,
+                       post_script=script)
+
+
+def write_plotlyjs_asset(directory):
+    # Written once per plotly version; pages refer to it by relative URL
+    # so browsers can cache it across pages and regenerations.
+    directory = Path(directory)
+    filename = f"plotly-{plotly_version()}.min.js"
+    path = directory / filename
+    if not path.exists():
+        from plotly.offline import get_plotlyjs
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(get_plotlyjs(), encoding="utf-8")
+        tmp.replace(path)
+        precompress(path)
+    return filename
 
-    fig.write_html(file=outfile, full_html=False, auto_open=False)
 
+def precompress(path):
+    import gzip
+    path = Path(path)
+    data = path.read_bytes()
+    Path(f"{path}.gz").write_bytes(gzip.compress(data, 9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    Path(f"{path}.br").write_bytes(brotli.compress(data))
 
-def make_map(data):
+
+def make_map(data, cache=None, options=DEFAULT_OPTIONS):
     # outfile = Path(__file__).parent / "map.html"
     # with outfile.open("w") as f:
     #     write_map(f, data)
 
+    cache = cache or render_cache
+    if cache is not None:
+        key = cache.key("map", RENDER_VERSION, plotly_version(), data,
+                        options.compact, options.plotlyjs, options.metric,
+                        options.animate, options.provinces)
+        html = cache.get(key)
+        if html is not None:
+            instrument.count("render_cache_hits")
+            return html
+        instrument.count("render_cache_misses")
+
     buf = StringIO()
-    write_map(buf, data)
-    return buf.getvalue()
+    map_renderer(options)(buf, data, options)
+    html = buf.getvalue()
+    if cache is not None:
+        cache.put(key, html)
+    return html
+
+
+def map_renderer(options):
+    if options.provinces:
+        return write_province_map
+    if options.animate:
+        return write_animation
+    return write_map
+
+
+def plotly_version():
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version("plotly")
+    except PackageNotFoundError:
+        return None
+
+
+def map_writer(data, options=DEFAULT_OPTIONS):
+    # Renders straight into the page being written, unless the map has to
+    # go through the render cache as a string anyway.
+    def write(outfile):
+        if render_cache is None:
+            map_renderer(options)(outfile, data, options)
+        else:
+            outfile.write(make_map(data, options=options))
+    return write
+
+
+INSERT_TAG = re.compile(r"<!-- *INSERT +([A-Za-z-]+) *-->")
+
+Placeholder = namedtuple("Placeholder", "name")
+
+
+class CompiledTemplate:
+    def __init__(self, segments):
+        self.segments = segments    # literal strs and Placeholders
+
+
+def compile_template(template):
+    if isinstance(template, CompiledTemplate):
+        return template
+    text = template if isinstance(template, str) else "".join(template)
+    segments = []
+    pos = 0
+    for m in INSERT_TAG.finditer(text):
+        if m.start() > pos:
+            segments.append(text[pos:m.start()])
+        segments.append(Placeholder(m.group(1)))
+        pos = m.end()
+    if pos < len(text):
+        segments.append(text[pos:])
+    return CompiledTemplate(segments)
 
 
 def process_template(template, outfile, replacements):
-    pat = re.compile(r"<!-- *INSERT +([A-Za-z-]+) *-->")
+    # Values can be strings, callables taking the output file, or
+    # iterables of string chunks.
+    template = compile_template(template)
     subs = {k.upper(): v for k, v in replacements.items()}
-    for line in template:
-        outfile.write(pat.sub(lambda m: subs[m.group(1)], line))
+    with instrument.span("template"):
+        for segment in template.segments:
+            if isinstance(segment, Placeholder):
+                write_value(outfile, subs[segment.name])
+            else:
+                outfile.write(segment)
+
+
+def write_value(outfile, value):
+    if isinstance(value, str):
+        outfile.write(value)
+    elif callable(value):
+        value(outfile)
+    else:
+        for chunk in value:
+            outfile.write(chunk)
 
 
-def collect_data(data_source):
-    excluded_countries=[     # extreme outliers throwing off the scale
-        "San Marino",
-    ]
+@contextmanager
+def atomic_open(path, mode="w"):
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        tmp.replace(path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
+
+class CountingWriter:
+    # Passes writes through, counting the UTF-8 encoded size.
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text.encode("utf-8"))
+        return self.outfile.write(text)
+
+
+excluded_countries = [     # extreme outliers throwing off the scale
+    "San Marino",
+]
+
+
+def exclude_outliers(density_data):
     exclude_set = set(excluded_countries)
-    data = list(r for r in stats.case_density(data_source)
-                if r[0] not in excluded_countries)
-    return data
+    return list(r for r in density_data if r[0] not in exclude_set)
 
 
-def main():
-    data_source = readers.ecdc_source
+def collect_data(data_source, popcount=None, metric="density", animate=None,
+                 provinces=False, workers=1, as_of=None):
+    # as_of (a date) selects the archived data of that day.
+    if provinces:
+        return collect_provinces(data_source, as_of)
+    if animate:
+        return collect_history(data_source, popcount, metric, animate,
+                               workers, as_of)
+    where = make_filter(exclude=excluded_countries)
+    if metric == "density":
+        return exclude_outliers(stats.case_density(data_source,
+                                                   popcount=popcount,
+                                                   where=where,
+                                                   workers=workers,
+                                                   as_of=as_of))
+    return metric_data(stats.country_metrics(data_source,
+                                             popcount=popcount,
+                                             where=where,
+                                             workers=workers,
+                                             as_of=as_of),
+                       metric)
+
+
+def metric_data(metric_rows, metric):
+    # Map rows for a timeseries metric, leaving out the countries where
+    # it is undefined (e.g. the doubling time of a shrinking outbreak).
+    field = METRICS[metric].field
+    scale = 100 if metric == "growth" else 1
+    rows = []
+    for r in metric_rows:
+        value = getattr(r, field)
+        if value == value and abs(value) != float("inf"):
+            rows.append((r.country, r.code, r.cases, value * scale))
+    return exclude_outliers(rows)
+
+
+def get_source(source_name):
+    return getattr(readers, source_name + "_source")
 
-    args = iter(sys.argv[1:])
-    rest_args = []
-    for arg in args:
-        if arg == "-s":
-            data_source = getattr(readers, next(args) + "_source")
-        else:
-            rest_args.append(arg)
 
+def data_age(data_source):
+    # Seconds since the served data was checked with its source, if known.
+    age = getattr(data_source, "data_age", None)
+    return age() if age else None
 
-    map_data = make_map(collect_data(data_source))
 
+def age_text(seconds):
+    if seconds is None:
+        return ""
+    for unit, length in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= length:
+            break
+    n = int(seconds // length)
+    return f" (data checked {n} {unit}{'' if n == 1 else 's'} ago)"
+
+
+def render_page(data_source, template, outfile, data, date=None,
+                options=DEFAULT_OPTIONS, age=None):
     replacements = {
-        "map": map_data,
-        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "map": map_writer(data, options),
+        "date": date or time.strftime("%Y-%m-%d %H:%M:%S"),
+        "data-age": age_text(age),
         "source-name": data_source.name,
         "source-url": data_source.info_url,
     }
+    process_template(template, outfile, replacements)
+
+
+def render_job(job, data, date, options=DEFAULT_OPTIONS, age=None):
+    data_source = get_source(job.source_name)
+    with open(job.template, "r") as f:
+        template = compile_template(f)
+    with atomic_open(job.output) as outfile:
+        render_page(data_source, template, outfile, data, date, options,
+                    age)
+    if options.precompress:
+        precompress(job.output)
+    return job.output
+
+
+def render_batch(jobs, workers=1, options=DEFAULT_OPTIONS, as_of=None):
+    # Load every source and the population data once, concurrently, then
+    # render the pages (the CPU-heavy plotly part) in worker processes.
+    page_data = batch_data(jobs, options, workers, as_of)
+    date = page_date(as_of)
+    # Known only here: the workers have not served any data themselves.
+    ages = [data_age(get_source(job.source_name)) for job in jobs]
+    job_options = asset_options(jobs, options)
+
+    if workers <= 1 or len(jobs) <= 1:
+        return [render_job(job, data, date, opts, age)
+                for job, data, opts, age
+                in zip(jobs, page_data, job_options, ages)]
+    # Spawned, not forked: the aggregation pool and any background
+    # refreshes have threads running by now.
+    with ProcessPoolExecutor(min(workers, len(jobs)),
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,
+                             initargs=(render_cache, RENDER_CACHE_DIR)) \
+            as executor:
+        return list(executor.map(render_job, jobs, page_data,
+                                 [date] * len(jobs), job_options, ages))
+
+
+def init_worker(cache, cache_dir):
+    # Spawned workers start from a fresh import of this module.
+    global render_cache, RENDER_CACHE_DIR
+    render_cache = cache
+    RENDER_CACHE_DIR = cache_dir
+
+
+def asset_options(jobs, options):
+    # The shared plotly.js file is written here, once per output
+    # directory, rather than by workers racing to write the same file.
+    if options.plotlyjs != "asset":
+        return [options] * len(jobs)
+    assets = {}
+    job_options = []
+    for job in jobs:
+        directory = Path(job.output).parent
+        if directory not in assets:
+            assets[directory] = write_plotlyjs_asset(directory)
+        job_options.append(options._replace(plotlyjs=assets[directory]))
+    return job_options
+
+
+def page_date(as_of=None):
+    if as_of is not None:
+        return f"{as_of.isoformat()} (archived data)"
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def batch_data(jobs, options, workers=1, as_of=None):
+    if options.provinces:
+        # Province maps need neither the aggregation nor population data.
+        return [collect_provinces(get_source(job.source_name), as_of)
+                for job in jobs]
+
+    where = make_filter(exclude=excluded_countries)
+    series = options.metric != "density" or bool(options.animate)
+    source_results, pop_result = stats.load_all(
+        [get_source(job.source_name) for job in jobs], where=where,
+        series=series, workers=workers, as_of=as_of)
+    loaded = unwrap(source_results)
+    [popcount] = unwrap([pop_result])
+    if options.animate:
+        return [animation_data(stats.metrics_from_series(s, popcount,
+                                                         workers=workers),
+                               popcount, options.metric, options.animate)
+                for s in loaded]
+    if series:
+        return [metric_data(stats.latest_metrics(
+                    stats.metrics_from_series(s, popcount, workers=workers),
+                    popcount),
+                    options.metric)
+                for s in loaded]
+    return [exclude_outliers(stats.density_from_totals(totals, popcount))
+            for totals in loaded]
+
+
+def make_jobs(source_names, templates, outputs):
+    if len(outputs) != len(source_names):
+        raise Exception("Need one output path per source")
+    if len(templates) == 1:
+        templates = templates * len(source_names)
+    elif len(templates) != len(source_names):
+        raise Exception("Need one template, or one per source")
+    return [Job(*args) for args in zip(source_names, templates, outputs)]
+
+
+USAGE = """usage: plots.py [-s SOURCE]... [-o OUTPUT]... [-j N] [TEMPLATE]...
+
+Render the case density map into TEMPLATE (default: stdin) for each
+SOURCE (ecdc or jhucsse). With several sources or any -o, one OUTPUT is
+required per source, and pages are rendered by N worker processes.
+N processes also share the per-country aggregation.
+
+--metrics FILE [--metrics-format json|prometheus] writes stage timings
+and counters to FILE (- for stderr). Rendered maps are cached in
+cache/render unless --no-render-cache is given.
+
+--max-stale SECONDS sets how long past its maximum age a download is
+still used while it is refreshed in the background; plots.py then waits
+for the refresh before it exits. 0 waits for a fresh copy up front.
+
+--metric density|incidence7|incidence14|growth|doubling selects the
+color value: all-time cases per million (the default), 7- or 14-day
+cases per million, week-on-week growth or doubling time.
+
+--animate DAYS renders an animated map with a date slider instead, with
+one frame every DAYS days up to the latest date; the page size and the
+time taken are reported on stderr.
+
+--provinces shows confirmed cases per province (jhucsse only) as
+markers, merged into grid cells that get finer as the map is zoomed in.
+
+--as-of YYYY-MM-DD renders the pages from the data archived on that day
+(see readers/archive.py) instead of fetching the current data.
+
+--compact trims the figure JSON, --plotlyjs cdn|asset|URL loads plotly.js
+from a CDN, a shared file next to the outputs or a given URL instead of
+inlining it, and --precompress writes .gz/.br copies of each output (so
+it needs -o)."""
+
+
+def main():
+    if "-h" in sys.argv[1:] or "--help" in sys.argv[1:]:
+        print(USAGE)
+        return
+
+    args, metrics_file, metrics_format = \
+        stats.parse_metrics_args(sys.argv[1:])
+    try:
+        render_pages(args)
+    finally:
+        if metrics_file:
+            instrument.write_report(metrics_file, metrics_format)
+
+
+def render_pages(args):
+    global render_cache
+    source_names = []
+    outputs = []
+    workers = 1
+    use_render_cache = True
+    options = DEFAULT_OPTIONS
+    as_of = None
+
+    args = iter(args)
+    rest_args = []
+    for arg in args:
+        if arg == "--no-render-cache":
+            use_render_cache = False
+        elif arg == "--compact":
+            options = options._replace(compact=True)
+        elif arg == "--plotlyjs":
+            options = options._replace(plotlyjs=next(args))
+        elif arg == "--precompress":
+            options = options._replace(precompress=True)
+        elif arg == "--metric":
+            options = options._replace(metric=next(args))
+            if options.metric not in METRICS:
+                raise Exception(f"Unknown metric {options.metric!r}")
+        elif arg == "--provinces":
+            options = options._replace(provinces=True)
+        elif arg == "--animate":
+            options = options._replace(animate=int(next(args)))
+        elif arg == "-s":
+            source_names.append(next(args))
+        elif arg == "-o":
+            outputs.append(next(args))
+        elif arg == "-j":
+            workers = int(next(args))
+        elif arg == "--as-of":
+            as_of = datetime.date.fromisoformat(next(args))
+        else:
+            rest_args.append(arg)
+
+    if use_render_cache:
+        render_cache = RenderCache(RENDER_CACHE_DIR)
+
+    if outputs or len(source_names) > 1:
+        jobs = make_jobs(source_names or ["ecdc"], rest_args, outputs)
+        start = time.perf_counter()
+        for output in render_batch(jobs, workers, options, as_of):
+            if options.animate:
+                print(f"{output}: {os.path.getsize(output):,} bytes",
+                      file=sys.stderr)
+            else:
+                print(output, file=sys.stderr)
+        if options.animate:
+            print(f"Generated in {time.perf_counter() - start:.2f} s",
+                  file=sys.stderr)
+        return
 
+    if options.precompress:
+        raise Exception("--precompress needs an output file (-o)")
+    if options.plotlyjs == "asset":
+        options = options._replace(plotlyjs=write_plotlyjs_asset("."))
+    start = time.perf_counter()
+    data_source = get_source(source_names[0] if source_names else "ecdc")
+    data = collect_data(data_source, metric=options.metric,
+                        animate=options.animate,
+                        provinces=options.provinces, workers=workers,
+                        as_of=as_of)
+    date = page_date(as_of)
+    age = data_age(data_source)
+    outfile = CountingWriter(sys.stdout)
     if len(rest_args) == 0:
-        process_template(sys.stdin, sys.stdout, replacements)
+        render_page(data_source, sys.stdin, outfile, data, date, options,
+                    age)
     elif len(rest_args) == 1:
         with open(rest_args[0], "r") as f:
-            process_template(f, sys.stdout, replacements)
+            render_page(data_source, f, outfile, data, date, options, age)
     else:
         raise Exception("Bad argument count")
+    if options.animate:
+        print(f"{len(data.dates)} frames, {outfile.size:,} bytes, "
+              f"generated in {time.perf_counter() - start:.2f} s",
+              file=sys.stderr)
 
 
 if __name__ == "__main__":
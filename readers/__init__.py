@@ -6,6 +6,41 @@ CaseDayData = namedtuple(
     "DateRep CountryExp NewConfCases NewDeaths GeoId EU")
 
 
+class Filter(namedtuple("Filter", "countries exclude start end")):
+    # Predicates a data source applies while reading. countries and
+    # exclude hold lower-case canonical names (countries=None means all);
+    # start and end are inclusive dates, or None for an open range.
+    __slots__ = ()
+
+    def match_country(self, name):
+        name = name.lower()
+        if name in self.exclude:
+            return False
+        return self.countries is None or name in self.countries
+
+    def match_date(self, d):
+        if self.start is not None and d < self.start:
+            return False
+        return self.end is None or d <= self.end
+
+    @property
+    def unrestricted(self):
+        return (self.countries is None and not self.exclude and
+                self.start is None and self.end is None)
+
+
+def make_filter(countries=None, exclude=(), start=None, end=None):
+    if countries is not None:
+        countries = frozenset(s.lower() for s in countries)
+    return Filter(countries=countries,
+                  exclude=frozenset(s.lower() for s in exclude),
+                  start=start,
+                  end=end)
+
+
+NO_FILTER = make_filter()
+
+
 def __getattr__(name):
     if name == "ecdc_source":
         from .ecdc_reader import EcdcDataSource
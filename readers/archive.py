@@ -0,0 +1,198 @@
+# Append-only archive of every version of the downloaded files, so pages
+# can be regenerated from the data as it was on an earlier day.
+#
+#   objects/ab/<sha256>.gz          gzipped file contents, stored once
+#   index/<kind>/<YYYY-MM>.jsonl    one line per new version, by fetch month
+#   files/<sha256 prefix>/<name>    versions checked out for reading
+#
+# Looking up a version reads only the index partitions from the requested
+# month backwards until one has an entry, never the stored objects.
+
+import os, gzip, json, time, shutil, datetime, threading
+from pathlib import Path
+from collections import namedtuple
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:             # not on Windows
+    fcntl = None
+
+from readers import instrument
+
+
+ARCHIVE_DIR = Path(__file__).parent / "../cache/archive"
+
+# How often record() compacts the archive, in seconds.
+COMPACT_INTERVAL = 7 * 24 * 3600
+
+# Held while recording or compacting, together with a lock on the
+# archive's lock file for other processes: compact() must not see an
+# object whose index line record() has not written yet.
+_lock = threading.Lock()
+
+# fetched is a UTC timestamp in ISO format ("2020-04-01T10:22:03Z").
+Version = namedtuple("Version", "kind fetched sha256 name")
+
+
+def _tmp_path(path):
+    return path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _tmp_path(path)
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+@contextmanager
+def _locked(directory):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    with _lock, open(directory / "lock", "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def object_path(sha256, directory=ARCHIVE_DIR):
+    return Path(directory) / "objects" / sha256[:2] / f"{sha256}.gz"
+
+
+def index_dir(kind, directory=ARCHIVE_DIR):
+    return Path(directory) / "index" / kind
+
+
+def partitions(kind, directory=ARCHIVE_DIR):
+    return sorted(index_dir(kind, directory).glob("*.jsonl"))
+
+
+def read_partition(path, kind):
+    with open(path, "r") as f:
+        return [Version(kind=kind, **json.loads(line))
+                for line in f if line.strip()]
+
+
+def latest(kind, directory=ARCHIVE_DIR):
+    for path in reversed(partitions(kind, directory)):
+        versions = read_partition(path, kind)
+        if versions:
+            return versions[-1]
+    return None
+
+
+def timestamp(t=None):
+    t = time.time() if t is None else t
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+def record(kind, filename, sha256, fetched=None, directory=ARCHIVE_DIR):
+    # Adds the file as a new version of kind, unless it is the same as the
+    # latest one.  Contents already stored under another version are
+    # not stored again.
+    filename = Path(filename)
+    with _locked(directory):
+        version = _record(kind, filename, sha256, fetched, directory)
+    maybe_compact(directory)
+    return version
+
+
+def _record(kind, filename, sha256, fetched, directory):
+    current = latest(kind, directory)
+    if current is not None and current.sha256 == sha256:
+        return current
+    with instrument.span("archive"):
+        obj = object_path(sha256, directory)
+        if not obj.exists():
+            _write_atomic(obj, gzip.compress(filename.read_bytes(), 6,
+                                              mtime=0))
+            instrument.count("archive_objects_written")
+        version = Version(kind, fetched or timestamp(), sha256, filename.name)
+        path = index_dir(kind, directory) / f"{version.fetched[:7]}.jsonl"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(dict(fetched=version.fetched, sha256=sha256,
+                                    name=version.name)) + "\n")
+    return version
+
+
+def find(kind, as_of, directory=ARCHIVE_DIR):
+    # The last version fetched on or before as_of (a date, or a datetime
+    # with a time zone).
+    if isinstance(as_of, datetime.datetime):
+        if as_of.tzinfo is None:
+            raise ValueError(f"as_of needs a time zone: {as_of}")
+        cutoff = timestamp(as_of.timestamp())
+    else:
+        cutoff = f"{as_of.isoformat()}T23:59:59Z"
+    for path in reversed(partitions(kind, directory)):
+        if path.stem > cutoff[:7]:
+            continue
+        versions = [v for v in read_partition(path, kind)
+                    if v.fetched <= cutoff]
+        if versions:
+            return max(versions, key=lambda v: v.fetched)
+    return None
+
+
+def checkout(kind, as_of, directory=ARCHIVE_DIR):
+    # Path of the archived file for as_of, decompressed once and reused,
+    # so snapshots of it are reused as well.
+    version = find(kind, as_of, directory)
+    if version is None:
+        raise LookupError(f"No archived {kind} data as of {as_of}")
+    path = Path(directory) / "files" / version.sha256[:16] / version.name
+    if not path.exists():
+        with gzip.open(object_path(version.sha256, directory), "rb") as f:
+            _write_atomic(path, f.read())
+    return path
+
+
+def compact(directory=ARCHIVE_DIR, now=None):
+    # Keeps only the last version of each day in the partitions of past
+    # months, then deletes the objects and checkouts no longer referenced.
+    with _locked(directory):
+        _compact(Path(directory), now)
+
+
+def _compact(directory, now):
+    current_month = timestamp(now)[:7]
+    referenced = set()
+    for kind_dir in sorted((directory / "index").glob("*")):
+        for path in sorted(kind_dir.glob("*.jsonl")):
+            versions = read_partition(path, kind_dir.name)
+            if path.stem < current_month:
+                by_day = {}
+                for v in versions:
+                    by_day[v.fetched[:10]] = v
+                kept = sorted(by_day.values(), key=lambda v: v.fetched)
+                if len(kept) < len(versions):
+                    _write_atomic(path, "".join(
+                        json.dumps(dict(fetched=v.fetched, sha256=v.sha256,
+                                        name=v.name)) + "\n"
+                        for v in kept).encode("utf-8"))
+                versions = kept
+            referenced.update(v.sha256 for v in versions)
+
+    for obj in (directory / "objects").glob("*/*.gz"):
+        if obj.name[:-len(".gz")] not in referenced:
+            obj.unlink(missing_ok=True)
+            instrument.count("archive_objects_removed")
+    prefixes = {sha256[:16] for sha256 in referenced}
+    for checkout_dir in (directory / "files").glob("*"):
+        if checkout_dir.name not in prefixes:
+            shutil.rmtree(checkout_dir, ignore_errors=True)
+    _write_atomic(directory / "compacted", timestamp(now).encode("ascii"))
+
+
+def maybe_compact(directory=ARCHIVE_DIR):
+    stamp = Path(directory) / "compacted"
+    try:
+        age = time.time() - stamp.stat().st_mtime
+    except FileNotFoundError:
+        _write_atomic(stamp, timestamp().encode("ascii"))
+        return
+    if age >= COMPACT_INTERVAL:
+        compact(directory)
@@ -0,0 +1,151 @@
+import datetime
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+from readers import CaseDayData
+
+
+CountryInfo = namedtuple("CountryInfo", "name geo_id eu")
+
+# Ordinal used for rows without a report date (never a valid date ordinal).
+NO_DATE = 0
+
+
+def date_to_ordinal(d):
+    return NO_DATE if d is None else d.toordinal()
+
+
+def ordinal_to_date(ordinal):
+    return None if ordinal == NO_DATE else datetime.date.fromordinal(ordinal)
+
+
+class CaseStore:
+    def __init__(self, countries, country_index, date_ordinal, cases, deaths):
+        self.countries = list(countries)
+        self.country_index = np.asarray(country_index, dtype=np.int32)
+        self.date_ordinal = np.asarray(date_ordinal, dtype=np.int32)
+        self.cases = np.asarray(cases, dtype=np.int32)
+        self.deaths = np.asarray(deaths, dtype=np.int32)
+
+    @classmethod
+    def from_rows(cls, rows):
+        builder = CaseStoreBuilder()
+        for r in rows:
+            builder.add(r.DateRep, r.CountryExp, r.NewConfCases, r.NewDeaths,
+                        geo_id=r.GeoId, eu=r.EU)
+        return builder.build()
+
+    @classmethod
+    def from_snapshot(cls, arrays, meta):
+        return cls([CountryInfo(*c) for c in meta["countries"]],
+                   arrays["country_index"], arrays["date_ordinal"],
+                   arrays["cases"], arrays["deaths"])
+
+    def to_snapshot(self):
+        arrays = dict(country_index=self.country_index,
+                      date_ordinal=self.date_ordinal,
+                      cases=self.cases,
+                      deaths=self.deaths)
+        return arrays, dict(countries=[list(c) for c in self.countries])
+
+    def __len__(self):
+        return len(self.country_index)
+
+    def __iter__(self):
+        # Compatibility view for consumers expecting CaseDayData rows.
+        countries = self.countries
+        for i, d, cases, deaths in zip(self.country_index.tolist(),
+                                       self.date_ordinal.tolist(),
+                                       self.cases.tolist(),
+                                       self.deaths.tolist()):
+            country = countries[i]
+            yield CaseDayData(DateRep=ordinal_to_date(d),
+                              CountryExp=country.name,
+                              NewConfCases=cases,
+                              NewDeaths=deaths,
+                              GeoId=country.geo_id,
+                              EU=country.eu)
+
+    def country_names(self):
+        return [c.name for c in self.countries]
+
+    def sum_by_country(self):
+        n = len(self.countries)
+        cases = np.zeros(n, dtype=np.int64)
+        deaths = np.zeros(n, dtype=np.int64)
+        np.add.at(cases, self.country_index, self.cases)
+        np.add.at(deaths, self.country_index, self.deaths)
+        return cases, deaths
+
+    def select(self, where):
+        if where.unrestricted:
+            return self
+        country_ok = np.array([where.match_country(c.name)
+                               for c in self.countries], dtype=bool)
+        mask = country_ok[self.country_index] if len(self) else \
+            np.zeros(0, dtype=bool)
+        if where.start is not None:
+            mask &= self.date_ordinal >= where.start.toordinal()
+        if where.end is not None:
+            mask &= self.date_ordinal <= where.end.toordinal()
+        return CaseStore(self.countries, self.country_index[mask],
+                         self.date_ordinal[mask], self.cases[mask],
+                         self.deaths[mask])
+
+    def reported_countries(self):
+        present = np.bincount(self.country_index,
+                              minlength=len(self.countries))
+        return {c.name for c, count in zip(self.countries, present) if count}
+
+
+class CaseStoreBuilder:
+    def __init__(self):
+        self._country_lookup = {}
+        self._countries = []
+        self._country_index = array("q")
+        self._date_ordinal = array("q")
+        self._cases = array("q")
+        self._deaths = array("q")
+
+    def country_id(self, name, geo_id=None, eu=None):
+        try:
+            return self._country_lookup[name]
+        except KeyError:
+            i = self._country_lookup[name] = len(self._countries)
+            self._countries.append(CountryInfo(name, geo_id, eu))
+            return i
+
+    def add(self, date, country, cases, deaths, geo_id=None, eu=None):
+        self._country_index.append(self.country_id(country, geo_id, eu))
+        self._date_ordinal.append(date_to_ordinal(date))
+        self._cases.append(int(cases))
+        self._deaths.append(int(deaths))
+
+    def build(self):
+        return CaseStore(self._countries,
+                         np.frombuffer(self._country_index, dtype=np.int64),
+                         np.frombuffer(self._date_ordinal, dtype=np.int64),
+                         np.frombuffer(self._cases, dtype=np.int64),
+                         np.frombuffer(self._deaths, dtype=np.int64))
+
+
+def cached_store(source_file, kind, version, read_store, where):
+    # The store of source_file, from its parse snapshot when there is one.
+    # The whole file is parsed and snapshotted, then filtered, so that
+    # filtered reads (which is most of them) restore it next time too.
+    from readers import snapshot
+    store = snapshot.cached_parse(source_file, kind, version, read_store,
+                                  CaseStore.to_snapshot,
+                                  CaseStore.from_snapshot)
+    return store.select(where)
+
+
+def as_case_store(data):
+    if isinstance(data, CaseStore):
+        return data
+    case_store = getattr(data, "case_store", None)
+    if case_store is not None:
+        return case_store()
+    return CaseStore.from_rows(data)
@@ -0,0 +1,151 @@
+# Shared downloader: one pooled requests session, megabyte-sized chunks,
+# resumable partial downloads and write-to-temp-then-rename, so a failed
+# download never leaves a truncated file where the readers look for data.
+
+import json, time, hashlib, logging, threading
+from pathlib import Path
+from collections import namedtuple
+
+from readers import instrument
+
+
+CHUNK_SIZE = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+Download = namedtuple("Download", "path status sha256 size seconds headers")
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests             # a bit slow to import
+            from requests.adapters import HTTPAdapter
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                  max_retries=2)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _session = s
+        return _session
+
+
+def get(url, **kwargs):
+    return session().get(url, **kwargs)
+
+
+def _part_paths(filename):
+    part = filename.with_name(filename.name + ".part")
+    return part, part.with_name(part.name + ".json")
+
+
+def _resume_point(part, part_info, url):
+    # A partial download can only be continued for the same URL, and only
+    # if we know a validator to send in If-Range.
+    try:
+        with open(part_info, "r") as f:
+            info = json.load(f)
+        size = part.stat().st_size
+    except (FileNotFoundError, ValueError):
+        return 0, None
+    if info.get("url") != url or not info.get("validator"):
+        return 0, None
+    return size, info["validator"]
+
+
+def _content_range(headers):
+    # "bytes first-last/total" as (first, last, total), total None if "*".
+    try:
+        unit, spec = headers["Content-Range"].split(" ", 1)
+        span, total = spec.split("/")
+        first, last = span.split("-")
+        return (int(first), int(last),
+                None if total.strip() == "*" else int(total))
+    except (KeyError, ValueError):
+        raise ValueError(
+            f"Bad Content-Range: {headers.get('Content-Range')!r}")
+
+
+def _expected_size(headers, offset):
+    # The full size of the file, if the response tells; received bytes
+    # are decoded, so only an unencoded body can be checked.
+    if headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    if offset:
+        total = _content_range(headers)[2]
+        if total is not None:
+            return total
+    if "Content-Length" in headers:
+        return offset + int(headers["Content-Length"])
+    return None
+
+
+def download(url, filename, headers=None, expected_sha256=None):
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    part, part_info = _part_paths(filename)
+    headers = dict(headers or {})
+    offset, validator = _resume_point(part, part_info, url)
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+
+    start = time.perf_counter()
+    with instrument.span("download"), \
+         get(url, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            return Download(filename, 304, None, 0,
+                            time.perf_counter() - start, r.headers)
+        r.raise_for_status()
+
+        digest = hashlib.sha256()
+        if r.status_code == 206 and offset:
+            first, _, total = _content_range(r.headers)
+            if first != offset:
+                raise ValueError(f"Range of {url} starts at {first}, "
+                                 f"not at {offset}")
+            mode = "ab"
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        else:
+            mode = "wb"
+            offset = 0
+        validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+        with open(part_info, "w") as f:
+            json.dump(dict(url=url, validator=validator), f)
+
+        received = 0
+        with open(part, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                received += len(chunk)
+                instrument.count("bytes_downloaded", len(chunk))
+        response_headers = r.headers
+        # Some urllib3 versions do not notice a connection closed early;
+        # the part is kept to resume from.
+        expected = _expected_size(r.headers, offset)
+        if expected is not None and offset + received != expected:
+            raise ConnectionError(f"Incomplete download of {url}: "
+                                  f"{offset + received} of {expected} bytes")
+
+    sha256 = digest.hexdigest()
+    if expected_sha256 is not None and sha256 != expected_sha256:
+        part.unlink(missing_ok=True)
+        part_info.unlink(missing_ok=True)
+        raise ValueError(f"Checksum mismatch for {url}: "
+                         f"expected {expected_sha256}, got {sha256}")
+    part.replace(filename)
+    part_info.unlink(missing_ok=True)
+
+    seconds = time.perf_counter() - start
+    log.info("Downloaded %s: %d bytes (%d resumed) in %.2f s, %.1f MB/s",
+             url, received + offset, offset, seconds,
+             received / 2**20 / seconds if seconds else 0)
+    return Download(filename, r.status_code, sha256, offset + received,
+                    seconds, response_headers)
@@ -1,57 +1,113 @@
 # https://www.ecdc.europa.eu/en/geographical-distribution-2019-ncov-cases
 
-import sys, re
+import sys, re, datetime
 from pathlib import Path
 
-import xlrd, requests
-
-from readers import CaseDayData
+from readers import (CaseDayData, NO_FILTER, httpcache, archive,
+                     instrument, download)
+from readers.casestore import CaseStoreBuilder, cached_store
 
 
 ENDPOINT = "https://www.ecdc.europa.eu/en/geographical-distribution-2019-ncov-cases"
 
 CACHE_DIR = Path(__file__).parent / "../cache"
+CACHE_FILE = CACHE_DIR / "cases.xls"
+
+# Bump when read_store changes its output, to invalidate snapshots.
+PARSER_VERSION = 1
 
 
 class EcdcDataSource:
     name = "European Centre for Disease Prevention and Control"
     info_url = ("https://www.ecdc.europa.eu/en/"
                 "geographical-distribution-2019-ncov-cases")
+    supports_filter = True
+    supports_as_of = True
+
+    def __init__(self, where=NO_FILTER, as_of=None):
+        self.where = where
+        self.as_of = as_of
 
     def __iter__(self):
-        return daily_stats()
+        # One row at a time, without building a store, for single-pass
+        # consumers; case_store() is the fast path for everything else.
+        return stream_rows(self.where, self.as_of)
+
+    def case_store(self):
+        return daily_stats(self.where, self.as_of)
+
+    @staticmethod
+    def data_age():
+        return httpcache.data_age(CACHE_FILE)
 
 
 def scrape_for_data_url(url):
     # I know, I know, but this is more extracting than parsing.
     # https://stackoverflow.com/a/1732454
-    r = requests.get(url)
+    with instrument.span("scrape"):
+        r = download.get(url)
+        r.raise_for_status()
     pat = r'<a href="([^"]+\.xls)"[^<]*Download[^<]*</a>'
     m = re.search(pat, r.text)
+    if m is None:
+        raise ValueError(f"No data file link found on {url}")
     return m.group(1)
 
 
 def fetch_data(filename):
-    url = scrape_for_data_url(ENDPOINT)
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-    filename.parent.mkdir(exist_ok=True)
-    with open(filename, "wb") as f:
-        for chunk in r.iter_content(chunk_size=128):
-            f.write(chunk)
-
-
-def read_file(filename):
-    book = xlrd.open_workbook(filename)
-    sheet = book.sheet_by_name("CSV_4_COMS")
-    rows_iter = sheet.get_rows()
-
+    def refresh():
+        cached = httpcache.update(scrape_for_data_url(ENDPOINT), filename)
+        archive.record("ecdc", filename, cached.sha256)
+        return cached
+    return httpcache.revalidate(filename, httpcache.get_policy("ecdc"),
+                                refresh)
+
+
+def read_store(filename, where=NO_FILTER):
+    import xlrd
+    builder = CaseStoreBuilder()
+    for r in book_rows(xlrd.open_workbook(filename), where):
+        builder.add(r.DateRep, r.CountryExp,
+                    r.NewConfCases, r.NewDeaths, geo_id=r.GeoId, eu=r.EU)
+    store = builder.build()
+    instrument.count("rows_parsed.ecdc", len(store))
+    return store
+
+
+def read_rows(filename, where=NO_FILTER):
+    # xlrd still loads the sheet's cells (.xls cannot be read
+    # incrementally), but no other sheet and no copy of the rows.
+    import xlrd
+    yield from book_rows(xlrd.open_workbook(filename, on_demand=True),
+                         where)
+
+
+def book_rows(book, where=NO_FILTER):
+    rows_iter = book.sheet_by_name("CSV_4_COMS").get_rows()
     header = tuple(cell.value for cell in next(rows_iter))
     if header != CaseDayData._fields:
         raise ValueError(f"Unexpected header: {header!r}")
 
     for row in rows_iter:
-        yield CaseDayData._make(cell.value for cell in row)
+        r = CaseDayData._make(cell.value for cell in row)
+        if not where.match_country(r.CountryExp):
+            continue
+        d = excel_date(r.DateRep, book.datemode)
+        if not where.match_date(d):
+            continue
+        yield r._replace(DateRep=d, NewConfCases=int(r.NewConfCases),
+                         NewDeaths=int(r.NewDeaths))
+
+
+def read_file(filename):
+    return iter(read_store(filename))
+
+
+def excel_date(value, datemode):
+    if isinstance(value, datetime.date):
+        return value
+    import xlrd
+    return xlrd.xldate.xldate_as_datetime(value, datemode).date()
 
 
 def sum_country(data, country_name):
@@ -59,10 +115,20 @@ def sum_country(data, country_name):
                if row.CountryExp == country_name)
 
 
-def daily_stats():
-    filename = CACHE_DIR / "cases.xls"
-    fetch_data(filename)
-    return read_file(filename)
+def data_file(as_of=None):
+    # The current file, or the archived one for as_of.
+    if as_of is not None:
+        return archive.checkout("ecdc", as_of)
+    return fetch_data(CACHE_FILE).path
+
+
+def daily_stats(where=NO_FILTER, as_of=None):
+    return cached_store(data_file(as_of), "cases", PARSER_VERSION,
+                        read_store, where)
+
+
+def stream_rows(where=NO_FILTER, as_of=None):
+    yield from read_rows(data_file(as_of), where)
 
 
 if __name__ == "__main__":
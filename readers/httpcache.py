@@ -0,0 +1,275 @@
+import os, re, json, time, shutil, hashlib, logging, threading
+from pathlib import Path
+from collections import namedtuple
+
+from readers import instrument, download
+
+
+log = logging.getLogger(__name__)
+
+# How long (in seconds) a download is trusted before it is revalidated
+# with a conditional request, and for how much longer it is still served
+# while it is revalidated in the background.
+Policy = namedtuple("Policy", "max_age max_stale", defaults=(0,))
+
+policies = {
+    "ecdc": Policy(max_age=3600, max_stale=24 * 3600),
+    "jhucsse": Policy(max_age=3600, max_stale=24 * 3600),
+    "worldbank": Policy(max_age=7 * 24 * 3600, max_stale=30 * 24 * 3600),
+}
+
+# Replaces the max_stale of every policy when set (--max-stale); 0 never
+# serves a stale copy, so nothing is refreshed in the background.
+max_stale = None
+
+# checked is when the contents were last confirmed with the server.
+CachedFile = namedtuple("CachedFile", "path sha256 checked")
+
+_served = {}                    # resolved path -> checked, as served
+_refreshes = {}                 # resolved path -> running refresh thread
+# Held while a cached file is replaced or pinned, so a pin always gets
+# the file its manifest describes.
+_lock = threading.Lock()
+
+
+def get_policy(source):
+    policy = policies.get(source, Policy(max_age=0))
+    if max_stale is not None:
+        policy = policy._replace(max_stale=max_stale)
+    return policy
+
+
+def manifest_path(filename):
+    filename = Path(filename)
+    return filename.with_name(filename.name + ".json")
+
+
+def read_manifest(filename):
+    try:
+        with open(manifest_path(filename), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(filename, manifest):
+    path = manifest_path(filename)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    tmp.replace(path)
+
+
+def file_stat(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def known_sha256(filename):
+    # The sha256 recorded for filename, as long as the file is still the
+    # one that was downloaded; saves reading the file to hash it.
+    manifest = read_manifest(filename)
+    try:
+        current = file_stat(filename)
+    except FileNotFoundError:
+        return None
+    if "sha256" not in manifest or manifest.get("stat") != current:
+        return None
+    return manifest["sha256"]
+
+
+def intact(filename, manifest):
+    # Whether the file still has the contents the manifest records: the
+    # same size and mtime, or else the same sha256.
+    try:
+        if manifest.get("stat") == file_stat(filename):
+            return True
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return False
+    if digest.hexdigest() == manifest["sha256"]:
+        return True
+    log.warning("%s does not match its recorded sha256", filename)
+    return False
+
+
+def stored(filename, url=None):
+    # The cached copy, however old, if its contents are intact.
+    filename = Path(filename)
+    manifest = read_manifest(filename)
+    if "sha256" not in manifest or not intact(filename, manifest):
+        return None
+    if url is not None and manifest.get("url") != url:
+        return None
+    return CachedFile(filename, manifest["sha256"],
+                      manifest.get("checked", 0))
+
+
+def cached(filename, policy, url=None):
+    copy = stored(filename, url)
+    if copy is None or time.time() - copy.checked >= policy.max_age:
+        return None
+    return copy
+
+
+def served(filename, result):
+    with _lock:
+        _served[Path(filename).resolve()] = result.checked
+    return result
+
+
+def pin(filename, url=None):
+    # The stored copy under a name of its own (a hard link, where
+    # possible), which a refresh does not replace while it is read.
+    with _lock:
+        copy = stored(filename, url)
+        if copy is None:
+            return None
+        path = copy.path.with_name(f"{copy.path.name}.{copy.sha256[:16]}")
+        if not path.exists():
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.unlink(missing_ok=True)
+            try:
+                os.link(copy.path, tmp)
+            except OSError:
+                shutil.copy2(copy.path, tmp)
+            tmp.replace(path)
+        write_manifest(path, dict(read_manifest(filename),
+                                  stat=file_stat(path)))
+    prune_pins(filename, keep=path)
+    return copy._replace(path=path)
+
+
+def prune_pins(filename, keep):
+    filename = Path(filename)
+    pattern = re.compile(re.escape(filename.name) + r"\.[0-9a-f]{16}")
+    for path in filename.parent.glob(filename.name + ".*"):
+        if path.name != keep.name and pattern.fullmatch(path.name):
+            path.unlink(missing_ok=True)
+            manifest_path(path).unlink(missing_ok=True)
+
+
+def data_age(filename, now=None):
+    # Seconds since the copy of filename served in this process was
+    # checked with the server, or None if it has not been served.
+    with _lock:
+        checked = _served.get(Path(filename).resolve())
+    if checked is None:
+        return None
+    return max(0, (time.time() if now is None else now) - checked)
+
+
+def revalidate(filename, policy, refresh, url=None):
+    # Serves the cached copy while it is fresh, and while it is at most
+    # max_stale past max_age, in which case refresh() runs in the
+    # background for the next reader.  Anything older waits for refresh(),
+    # or is served anyway if refresh() fails.  A copy served while a
+    # refresh runs is pinned, so read the returned path, not filename.
+    with instrument.span("fetch"):
+        return _revalidate(filename, policy, refresh, url)
+
+
+def _revalidate(filename, policy, refresh, url):
+    hit = cached(filename, policy, url)
+    if hit:
+        instrument.count("cache_hits")
+        if refreshing(filename):
+            hit = pin(filename, url) or hit
+        return served(filename, hit)
+    copy = stored(filename, url)
+    if (copy is not None and
+            time.time() - copy.checked < policy.max_age + policy.max_stale):
+        instrument.count("cache_stale")
+        copy = pin(filename, url) or copy
+        refresh_in_background(filename, refresh)
+        return served(filename, copy)
+    try:
+        return served(filename, refresh())
+    except Exception:
+        if copy is None:
+            raise
+        instrument.count("refresh_errors")
+        log.exception("Refresh of %s failed, serving the copy checked %s",
+                      filename, time.ctime(copy.checked))
+        return served(filename, pin(filename, url) or copy)
+
+
+def refreshing(filename):
+    with _lock:
+        return Path(filename).resolve() in _refreshes
+
+
+def refresh_in_background(filename, refresh):
+    # Not a daemon thread, so a refresh finishes before the process exits:
+    # a command line run that served a stale copy waits for the upstream
+    # at exit (--max-stale 0 waits for it up front instead).
+    key = Path(filename).resolve()
+    with _lock:
+        if key in _refreshes:
+            return
+        thread = threading.Thread(target=_refresh, args=(key, refresh),
+                                  name=f"refresh {key.name}")
+        _refreshes[key] = thread
+    thread.start()
+
+
+def _refresh(key, refresh):
+    try:
+        with instrument.span("refresh"):
+            refresh()
+    except Exception:
+        instrument.count("refresh_errors")
+        log.exception("Background refresh of %s failed", key)
+    finally:
+        with _lock:
+            del _refreshes[key]
+
+
+def wait_for_refreshes():
+    with _lock:
+        threads = list(_refreshes.values())
+    for thread in threads:
+        thread.join()
+
+
+def fetch(url, filename, policy=Policy(max_age=0)):
+    filename = Path(filename)
+    return revalidate(filename, policy, lambda: update(url, filename), url)
+
+
+def update(url, filename):
+    # Revalidates or downloads the file now, whatever its age.
+    manifest = read_manifest(filename)
+    have_file = stored(filename, url) is not None
+    headers = {}
+    if have_file and manifest.get("etag"):
+        headers["If-None-Match"] = manifest["etag"]
+    if have_file and manifest.get("last_modified"):
+        headers["If-Modified-Since"] = manifest["last_modified"]
+
+    now = time.time()
+    # Downloaded next to the file, which is only replaced together with
+    # its manifest.
+    new = filename.with_name(filename.name + ".new")
+    result = download.download(url, new, headers)
+    if result.status == 304 and have_file:
+        instrument.count("cache_not_modified")
+        with _lock:
+            manifest = dict(read_manifest(filename), checked=now)
+            write_manifest(filename, manifest)
+        return CachedFile(filename, manifest["sha256"], now)
+    instrument.count("cache_misses")
+
+    validators = {
+        "etag": result.headers.get("ETag"),
+        "last_modified": result.headers.get("Last-Modified"),
+    }
+    with _lock:
+        new.replace(filename)
+        write_manifest(filename, dict(validators, url=url,
+                                      sha256=result.sha256, checked=now,
+                                      stat=file_stat(filename)))
+    return CachedFile(filename, result.sha256, now)
@@ -0,0 +1,98 @@
+# Stage timings and counters for the whole pipeline.  Disabled by default;
+# when disabled, span() hands out a shared no-op context manager and
+# count() returns immediately, so the calls can stay in hot paths.
+
+import re, sys, json, time, threading
+from contextlib import contextmanager, nullcontext
+
+
+enabled = False
+
+_lock = threading.Lock()
+_spans = {}                     # name -> [calls, seconds]
+_counters = {}
+_null_span = nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def span(name):
+    if not enabled:
+        return _null_span
+    return _timed_span(name)
+
+
+@contextmanager
+def _timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            stats = _spans.setdefault(name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def report():
+    with _lock:
+        return {
+            "spans": {name: {"calls": calls, "seconds": seconds}
+                      for name, (calls, seconds) in sorted(_spans.items())},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def prometheus_text(prefix="covidstats"):
+    data = report()
+    lines = [
+        f"# TYPE {prefix}_stage_seconds_total counter",
+    ]
+    for name, s in data["spans"].items():
+        lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} '
+                     f'{s["seconds"]:.6f}')
+    lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+    for name, s in data["spans"].items():
+        lines.append(f'{prefix}_stage_calls_total{{stage="{name}"}} '
+                     f'{s["calls"]}')
+    for name, value in data["counters"].items():
+        metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(filename, fmt="json"):
+    if fmt == "json":
+        text = json.dumps(report(), indent=2) + "\n"
+    elif fmt == "prometheus":
+        text = prometheus_text()
+    else:
+        raise ValueError(f"Unknown metrics format {fmt!r}")
+    if filename == "-":
+        sys.stderr.write(text)
+    else:
+        with open(filename, "w") as f:
+            f.write(text)
@@ -1,24 +1,58 @@
-import csv, datetime
+import sys, csv, json, hashlib, datetime
+from array import array
+from pathlib import Path
 from contextlib import contextmanager
 from collections import namedtuple, defaultdict
+from functools import lru_cache
 from itertools import groupby
 from operator import itemgetter
 
-from readers import CaseDayData
+import numpy as np
+
+from readers import (CaseDayData, NO_FILTER, httpcache, archive,
+                     popindex, instrument)
+from readers.casestore import (CaseStore, CaseStoreBuilder, CountryInfo,
+                               cached_store, ordinal_to_date)
 
 
 ENDPOINT = ("https://raw.githubusercontent.com/CSSEGISandData/COVID-19/"
             "master/csse_covid_19_data/csse_covid_19_time_series/"
             "time_series_covid19_confirmed_global.csv")
 
+CACHE_DIR = Path(__file__).parent / "../cache"
+CACHE_FILE = CACHE_DIR / "confirmed_global.csv"
+
+# Bump when the parsed store changes, to invalidate snapshots.
+PARSER_VERSION = 1
+
 Record = namedtuple("Record", "province country lat long cumulative_cases")
 
+# The date columns of a file header: the keys of the columns and their
+# days after start (a date ordinal).  All records of a file share it.
+DateAxis = namedtuple("DateAxis", "start length keys offsets")
+
+# Marks the days without a report in CaseSeries.counts.
+MISSING = -2**63
+
+# Whole file in columnar form. counts is a (rows, dates) array of
+# cumulative counts; present marks the cells that were not empty.
+Table = namedtuple(
+    "Table", "provinces countries lats longs dates counts present")
+
+# What an incremental refresh needs to remember about the previous run:
+# the newest date processed, a digest of every cell up to that date, and
+# each country's latest cumulative count.
+IncrementalState = namedtuple(
+    "IncrementalState", "watermark history_digest last_cumulative")
+
+Update = namedtuple("Update", "store state rebuilt")
+
+# Latest cumulative count of each row (province, or whole country) of the
+# file, with its location.
+Points = namedtuple("Points", "names lats longs cases")
+
 # Treat ECDC's country names as canonical.
-country_name_map = {
-    "US": "United States of America",
-    "Korea, South": "South Korea",
-    "Taiwan*": "Taiwan",
-}
+country_name_map = popindex.jhucsse_name_map
 
 
 class JhuCsseDataSource:
@@ -27,44 +61,255 @@ class JhuCsseDataSource:
     info_url = ("https://data.humdata.org/dataset/"
                 "novel-coronavirus-2019-ncov-cases")
 
+    supports_filter = True
+    supports_as_of = True
+
+    def __init__(self, where=NO_FILTER, as_of=None):
+        self.where = where
+        self.as_of = as_of
+
     def __iter__(self):
-        return daily_stats()
+        # One row at a time, without building a store, for single-pass
+        # consumers; case_store() is the fast path for everything else.
+        return stream_rows(self.where, self.as_of)
+
+    def case_store(self):
+        return daily_stats(self.where, self.as_of)
+
+    def new_rows(self):
+        # An Update: its store holds the rows since the last call, unless
+        # rebuilt is set, in which case it holds the whole history again.
+        return incremental_stats()
+
+    def province_table(self):
+        with fetch_data(self.as_of) as stream, \
+             instrument.span("parse.jhucsse"):
+            return parse_table(stream, where=self.where)
+
+    def provinces(self):
+        return points_from_table(self.province_table())
+
+    @staticmethod
+    def data_age():
+        return httpcache.data_age(CACHE_FILE)
+
+
+def data_file(as_of=None):
+    # The current file, or the archived one for as_of.
+    if as_of is not None:
+        return archive.checkout("jhucsse", as_of)
+    return httpcache.revalidate(CACHE_FILE, httpcache.get_policy("jhucsse"),
+                                refresh_data, ENDPOINT).path
 
 
 @contextmanager
-def fetch_data():
-    import requests             # a bit slow to import
-    response = requests.get(ENDPOINT, stream=True)
-    with response:
-        response.raise_for_status()
-        yield response.iter_lines(decode_unicode=True)
+def fetch_data(as_of=None):
+    with open(data_file(as_of), "r", newline="", encoding="utf-8") as f:
+        yield f
+
+
+def refresh_data():
+    cached = httpcache.update(ENDPOINT, CACHE_FILE)
+    archive.record("jhucsse", CACHE_FILE, cached.sha256)
+    return cached
+
+
+class CaseSeries:
+    # The cumulative counts of a record, one machine integer per day from
+    # start, instead of a (date, count) tuple per report.  Iterates, and
+    # compares equal to a list of, the (date, count) pairs of the days
+    # with a report.
+    __slots__ = ("start", "counts")
+
+    def __init__(self, start, counts):
+        self.start = start
+        self.counts = counts
+
+    def __iter__(self):
+        for offset, count in enumerate(self.counts):
+            if count != MISSING:
+                yield ordinal_to_date(self.start + offset), count
+
+    def __len__(self):
+        return len(self.counts) - self.counts.count(MISSING)
+
+    def __eq__(self, other):
+        if not isinstance(other, (CaseSeries, list, tuple)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"CaseSeries({list(self)!r})"
+
+
+def date_axis(header):
+    keys = [k for k in header if k[:1].isnumeric()]
+    ordinals = [parse_american_date(k).toordinal() for k in keys]
+    start = min(ordinals, default=0)
+    length = max(ordinals, default=start - 1) - start + 1
+    return DateAxis(start, length, keys, [o - start for o in ordinals])
 
 
 def parse_stream(stream):
-    for data in csv.DictReader(stream):
-        yield parse_record(data)
+    reader = csv.DictReader(stream)
+    axis = date_axis(reader.fieldnames or [])
+    for data in reader:
+        yield parse_record(data, axis)
 
 
-def parse_record(data):
-    case_counts = [(parse_american_date(k), int(v)) for k, v in data.items()
-                   if k[0].isnumeric() and v]
-    return Record(province=data["Province/State"] or None,
-                  country=data["Country/Region"] or None,
+def parse_record(data, axis=None):
+    if axis is None:
+        axis = date_axis(list(data))
+    counts = array("q", [MISSING]) * axis.length
+    for key, offset in zip(axis.keys, axis.offsets):
+        value = data[key]
+        if value:
+            counts[offset] = int(value)
+    return Record(province=_intern(data["Province/State"]),
+                  country=_intern(data["Country/Region"]),
                   lat=float(data["Lat"]),
                   long=float(data["Long"]),
-                  cumulative_cases=case_counts)
+                  cumulative_cases=CaseSeries(axis.start, counts))
+
+
+def _intern(s):
+    # Province and country names repeat across sources and reloads.
+    return sys.intern(s) if s else None
 
 
+def parse_table(stream, since=None, where=NO_FILTER):
+    reader = csv.reader(stream)
+    return table_from_rows(next(reader), reader, since, where)
+
+
+def table_from_rows(header, rows, since=None, where=NO_FILTER):
+    province_col = header.index("Province/State")
+    country_col = header.index("Country/Region")
+    lat_col = header.index("Lat")
+    long_col = header.index("Long")
+    date_cols = [i for i, k in enumerate(header) if k[:1].isnumeric()]
+    dates = [parse_american_date(header[i]) for i in date_cols]
+    date_order = sorted(range(len(dates)), key=dates.__getitem__)
+    date_cols = [date_cols[i] for i in date_order]
+    dates = [dates[i] for i in date_order]
+    if since is not None:
+        date_cols = [i for i, d in zip(date_cols, dates) if d > since]
+        dates = [d for d in dates if d > since]
+
+    provinces, countries, lats, longs, cells = [], [], [], [], []
+    for row in rows:
+        if len(row) < len(header):
+            # Missing trailing cells are empty, as csv.DictReader has it.
+            row = row + [""] * (len(header) - len(row))
+        country = row[country_col]
+        if not where.match_country(country_name_map.get(country, country)):
+            continue
+        provinces.append(row[province_col] or None)
+        countries.append(country)
+        lats.append(_parse_float(row[lat_col]))
+        longs.append(_parse_float(row[long_col]))
+        cells.append([row[i] for i in date_cols])
+
+    instrument.count("rows_parsed.jhucsse", len(cells))
+    cells = np.array(cells, dtype=str).reshape(len(cells), len(date_cols))
+    present = cells != ""
+    cells[~present] = "0"
+    return Table(provinces=provinces,
+                 countries=countries,
+                 lats=np.array(lats),
+                 longs=np.array(longs),
+                 dates=dates,
+                 counts=cells.astype(np.int64),
+                 present=present)
+
+
+def _parse_float(s):
+    return float(s) if s else float("nan")
+
+
+@lru_cache(maxsize=4096)
 def parse_american_date(datestr):
     return datetime.datetime.strptime(datestr, "%m/%d/%y").date()
 
 
-def daily_stats():
-    with fetch_data() as stream:
-        yield from casedaydata_from_records(parse_stream(stream))
+def daily_stats(where=NO_FILTER, as_of=None):
+    # An unchanged file (say, after a 304) is restored from its snapshot.
+    return cached_store(data_file(as_of), "jhucsse", PARSER_VERSION,
+                        read_store, where)
+
+
+def read_store(filename, where=NO_FILTER):
+    with open(filename, "r", newline="", encoding="utf-8") as f:
+        return filtered_store(f, where)
+
+
+def stream_rows(where=NO_FILTER, as_of=None):
+    with fetch_data(as_of) as stream:
+        yield from rows_from_stream(stream, where)
+
+
+def rows_from_stream(stream, where=NO_FILTER):
+    # New cases of each country and day, as in the store: the provinces'
+    # counts (an empty cell counting as 0) are summed on each date any of
+    # them reports, and diffed against the country's previous report.
+    # Holds the running sums of the countries, not the rows; a country
+    # whose rows are not contiguous gets correcting rows.
+    reader = csv.reader(stream)
+    header = next(reader)
+    country_col = header.index("Country/Region")
+    columns = sorted(((parse_american_date(k), i)
+                      for i, k in enumerate(header) if k[:1].isnumeric()))
+    canonical = {}
+
+    def named_rows():
+        for row in reader:
+            country = row[country_col]
+            if country not in canonical:
+                if country in country_name_map.values():
+                    raise ValueError(f"Ambiguous name {country!r}")
+                canonical[country] = country_name_map.get(country, country)
+            name = canonical[country]
+            if where.match_country(name):
+                yield name, row
+
+    yielded = {}        # country -> sums, present, new cases by column
+    for name, rows in groupby(named_rows(), key=itemgetter(0)):
+        sums, present, before = yielded.get(
+            name, ([0] * len(columns), [False] * len(columns), {}))
+        for _, row in rows:
+            for j, (d, i) in enumerate(columns):
+                value = row[i] if i < len(row) else ""
+                if value:
+                    sums[j] += int(value)
+                    present[j] = True
+        new_cases = {}
+        previous = 0
+        for j, count in enumerate(sums):
+            if present[j]:
+                new_cases[j] = count - previous
+                previous = count
+        for j, cases in new_cases.items():
+            d = columns[j][0]
+            change = cases - before.get(j, 0)
+            if (j not in before or change) and where.match_date(d):
+                yield CaseDayData(d, name, change, 0, None, None)
+        yielded[name] = sums, present, new_cases
+
+
+def filtered_store(stream, where=NO_FILTER):
+    # Countries are dropped before their cells are parsed. Dates can only
+    # be cut after the diff, which needs the day before the range starts.
+    table = parse_table(stream, where=where)
+    return casestore_from_table(table).select(where)
 
 
 def casedaydata_from_records(records):
+    return iter(casestore_from_records(records))
+
+
+def casestore_from_records(records):
     cases_by_country_and_date = defaultdict(int)
     for r in records:
         for d, cumulative_count in r.cumulative_cases:
@@ -72,6 +317,7 @@ def casedaydata_from_records(records):
 
     sorted_data = sorted((country, d, cases) for (country, d), cases
                          in cases_by_country_and_date.items())
+    builder = CaseStoreBuilder()
     for country, g in groupby(sorted_data, key=itemgetter(0)):
         if country in country_name_map.values():
             raise ValueError(f"Ambiguous name {country!r}")
@@ -80,10 +326,171 @@ def casedaydata_from_records(records):
         for _, d, cases in g:
             new_cases = cases - preexisting_cases
             preexisting_cases = cases
-            yield CaseDayData(
-                DateRep=d,
-                CountryExp=canonical_country_name,
-                NewConfCases=new_cases,
-                NewDeaths=0,
-                GeoId=None,
-                EU=None)
+            builder.add(d, canonical_country_name, new_cases, 0)
+    return builder.build()
+
+
+def casestore_from_table(table):
+    store, _ = _aggregate_table(table)
+    return store
+
+
+def _aggregate_table(table, preexisting={}):
+    if not table.countries:
+        return CaseStoreBuilder().build(), dict(preexisting)
+
+    names, inverse = np.unique(table.countries, return_inverse=True)
+    for country in names.tolist():
+        if country in country_name_map.values():
+            raise ValueError(f"Ambiguous name {country!r}")
+
+    # Sum the provinces of each country with one reduction per group.
+    order = np.argsort(inverse, kind="stable")
+    starts = np.flatnonzero(np.diff(inverse[order], prepend=-1))
+    counts = np.where(table.present, table.counts, 0)
+    cumulative = np.add.reduceat(counts[order], starts, axis=0)
+    present = np.logical_or.reduceat(table.present[order], starts, axis=0)
+
+    # Diff each reported cell against the country's previous reported cell.
+    columns = np.arange(len(table.dates))
+    last_seen = np.maximum.accumulate(np.where(present, columns, -1), axis=1)
+    previous = np.full_like(last_seen, -1)
+    previous[:, 1:] = last_seen[:, :-1]
+    carried = np.array([preexisting.get(c, 0) for c in names.tolist()],
+                       dtype=np.int64)
+    preceding = np.take_along_axis(cumulative, previous.clip(0), axis=1)
+    new_cases = cumulative - np.where(previous >= 0, preceding,
+                                      carried[:, None])
+
+    last_cumulative = dict(preexisting)
+    if len(table.dates):
+        latest = np.take_along_axis(cumulative, last_seen[:, -1:].clip(0),
+                                    axis=1)[:, 0]
+        for c, seen, value in zip(names.tolist(), last_seen[:, -1].tolist(),
+                                  latest.tolist()):
+            if seen >= 0:
+                last_cumulative[c] = value
+
+    country_index, date_index = np.nonzero(present)
+    ordinals = np.array([d.toordinal() for d in table.dates], dtype=np.int64)
+    countries = [CountryInfo(country_name_map.get(c, c), None, None)
+                 for c in names.tolist()]
+    store = CaseStore(countries,
+                      country_index,
+                      ordinals[date_index],
+                      new_cases[present],
+                      np.zeros(len(country_index), dtype=np.int64))
+    return store, last_cumulative
+
+
+def row_names(table):
+    names = []
+    for province, country in zip(table.provinces, table.countries):
+        country = country_name_map.get(country, country)
+        names.append(f"{province}, {country}" if province else country)
+    return names
+
+
+def points_from_table(table):
+    names = row_names(table)
+    if len(table.dates):
+        columns = np.arange(len(table.dates))
+        last_seen = np.where(table.present, columns, -1).max(axis=1)
+        latest = np.take_along_axis(table.counts, last_seen.clip(0)[:, None],
+                                    axis=1)[:, 0]
+        cases = np.where(last_seen >= 0, latest, 0)
+    else:
+        cases = np.zeros(len(names), dtype=np.int64)
+    return Points(names, table.lats, table.longs, cases)
+
+
+def province_series(table):
+    # Cumulative count of each row (named as in points_from_table) on each
+    # of table.dates, missing cells carrying the previous count forward.
+    # Dense, so only built for callers that need it.
+    columns = np.arange(len(table.dates))
+    last_seen = np.maximum.accumulate(
+        np.where(table.present, columns, -1), axis=1)
+    return np.where(last_seen >= 0,
+                    np.take_along_axis(table.counts, last_seen.clip(0),
+                                       axis=1),
+                    0)
+
+
+def history_digests(header, rows, ends):
+    # Digests of the cells left of each column in ends, in one pass.
+    digests = {end: hashlib.sha256() for end in ends}
+    for row in [header] + rows:
+        for end, digest in digests.items():
+            digest.update("\x1f".join(row[:end]).encode("utf-8"))
+            digest.update(b"\x1e")
+    return {end: digest.hexdigest() for end, digest in digests.items()}
+
+
+def incremental_update(stream, state=None):
+    reader = csv.reader(stream)
+    header = next(reader)
+    rows = list(reader)
+    date_cols = [i for i, k in enumerate(header) if k[:1].isnumeric()]
+    dates = [parse_american_date(header[i]) for i in date_cols]
+
+    # Only a file that grows at the right edge can be processed
+    # incrementally; anything else is rebuilt from scratch every time.
+    append_only = (dates == sorted(dates) and
+                   date_cols == list(range(len(header) - len(dates),
+                                           len(header))))
+    if not dates or not append_only:
+        table = table_from_rows(header, rows)
+        return Update(casestore_from_table(table), None, True)
+
+    # The state keeps the digest of the cells up to its watermark; the
+    # same pass digests them up to the new one.
+    end = date_cols[-1] + 1
+    previous_end = None
+    if state is not None and state.watermark in dates:
+        previous_end = date_cols[dates.index(state.watermark)] + 1
+    digests = history_digests(header, rows, {end, previous_end} - {None})
+
+    since, preexisting, rebuilt = None, {}, True
+    if previous_end and digests[previous_end] == state.history_digest:
+        since, preexisting, rebuilt = (state.watermark,
+                                       state.last_cumulative, False)
+
+    table = table_from_rows(header, rows, since)
+    store, last_cumulative = _aggregate_table(table, preexisting)
+    state = IncrementalState(dates[-1], digests[end], last_cumulative)
+    return Update(store, state, rebuilt)
+
+
+def load_state(filename):
+    try:
+        with open(filename, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return IncrementalState(
+        watermark=datetime.date.fromisoformat(data["watermark"]),
+        history_digest=data["history_digest"],
+        last_cumulative=data["last_cumulative"])
+
+
+def save_state(filename, state):
+    if state is None:
+        # Rebuilt without a state; an old one no longer applies.
+        filename.unlink(missing_ok=True)
+        return
+    data = dict(watermark=state.watermark.isoformat(),
+                history_digest=state.history_digest,
+                last_cumulative=state.last_cumulative)
+    tmp = filename.with_name(filename.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    tmp.replace(filename)
+
+
+def incremental_stats():
+    state_file = CACHE_DIR / "confirmed_global.state.json"
+    with fetch_data() as stream:
+        update = incremental_update(stream, load_state(state_file))
+    save_state(state_file, update.state)
+    return update
@@ -0,0 +1,45 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+LoadResult = namedtuple("LoadResult", "name value error")
+
+
+class SourceError(Exception):
+    def __init__(self, name, error):
+        super().__init__(f"Failed to load {name}: {error!r}")
+        self.name = name
+        self.error = error
+
+
+def load_concurrently(loaders, timeout=None, max_workers=None):
+    # Waiting on the network dominates, so threads are enough to overlap
+    # the sources. Results come back in the order the loaders were given,
+    # whatever order they finish in.
+    loaders = list(loaders)
+    if not loaders:
+        return []
+    executor = ThreadPoolExecutor(max_workers or len(loaders))
+    try:
+        futures = [(name, executor.submit(load)) for name, load in loaders]
+        _, not_done = wait([f for _, f in futures], timeout=timeout)
+        results = []
+        for name, future in futures:
+            if future in not_done:
+                future.cancel()
+                error = TimeoutError(f"{name} did not finish in {timeout} s")
+                results.append(LoadResult(name, None, error))
+            elif future.exception() is not None:
+                results.append(LoadResult(name, None, future.exception()))
+            else:
+                results.append(LoadResult(name, future.result(), None))
+        return results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def unwrap(results):
+    for r in results:
+        if r.error is not None:
+            raise SourceError(r.name, r.error) from r.error
+    return [r.value for r in results]
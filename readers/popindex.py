@@ -0,0 +1,118 @@
+import json, hashlib
+from collections import namedtuple
+
+from readers import popreader, snapshot
+
+
+# Treat ECDC's country names as canonical.  Maps the World Bank's country
+# names to ECDC's names.
+worldbank_name_map = {
+    "Egypt, Arab Rep.": "Egypt",
+    "Iran, Islamic Rep.": "Iran",
+    "Russian Federation": "Russia",
+    "Korea, Rep.": "South Korea",
+    "United States": "United States of America",
+}
+
+# Maps JHU CSSE's country names to ECDC's names.
+jhucsse_name_map = {
+    "US": "United States of America",
+    "Korea, South": "South Korea",
+    "Taiwan*": "Taiwan",
+}
+
+# Bump when build_index changes its output, to invalidate stored indexes.
+INDEX_VERSION = 1
+
+
+PopEntry = namedtuple("PopEntry", "name code population year")
+
+
+class PopulationIndex:
+    def __init__(self, entries, aliases):
+        self.entries = [PopEntry(*e) for e in entries]
+        self.aliases = dict(aliases)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name.lower() in self.aliases
+
+    def lookup(self, name):
+        i = self.aliases.get(name.lower())
+        return None if i is None else self.entries[i]
+
+    def population(self, name):
+        return self[name].population
+
+    def code(self, name):
+        return self[name].code
+
+    def __getitem__(self, name):
+        entry = self.lookup(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry
+
+    def to_snapshot(self):
+        return {}, dict(entries=[list(e) for e in self.entries],
+                        aliases=self.aliases)
+
+    @classmethod
+    def from_snapshot(cls, arrays, meta):
+        return cls(meta["entries"], meta["aliases"])
+
+
+def build_index(popdata):
+    entries = []
+    aliases = {}
+
+    def add_alias(alias, i):
+        if alias:
+            aliases.setdefault(alias.lower(), i)
+
+    for p in popdata:
+        name = worldbank_name_map.get(p.country_name, p.country_name)
+        i = aliases.get(name.lower())
+        if i is None:
+            i = len(entries)
+            entries.append(PopEntry(name, p.country_code, p.population,
+                                    p.year))
+        add_alias(name, i)
+        add_alias(p.country_name, i)
+        add_alias(p.country_code, i)
+
+    for alias, name in jhucsse_name_map.items():
+        i = aliases.get(name.lower())
+        if i is not None:
+            add_alias(alias, i)
+
+    return PopulationIndex(entries, aliases)
+
+
+def as_population_index(data):
+    if isinstance(data, PopulationIndex):
+        return data
+    return build_index(data)
+
+
+def index_version():
+    # Stored indexes also depend on the alias tables and the supplemental
+    # data, so fold those into the version.
+    tables = [worldbank_name_map, jhucsse_name_map,
+              [list(p) for p in popreader.supplemental_data]]
+    digest = hashlib.sha256(json.dumps(tables, sort_keys=True).encode())
+    return f"{INDEX_VERSION}.{digest.hexdigest()[:8]}"
+
+
+def population_index(as_of=None):
+    datafile = popreader.data_file(as_of)
+    return snapshot.cached_parse(
+        datafile, "popindex", index_version(),
+        lambda path: build_index(popreader.population_count(path)),
+        PopulationIndex.to_snapshot,
+        PopulationIndex.from_snapshot)
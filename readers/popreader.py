@@ -1,10 +1,9 @@
 # https://data.worldbank.org/indicator/SP.POP.TOTL
 
-import time
 from pathlib import Path
 from collections import namedtuple
 
-import xlrd, requests
+from readers import httpcache, archive, snapshot, instrument
 
 
 ENDPOINT = ("https://api.worldbank.org/v2/en/indicator/" +
@@ -12,6 +11,9 @@ ENDPOINT = ("https://api.worldbank.org/v2/en/indicator/" +
 
 CACHE_DIR = Path(__file__).parent / "../cache"
 
+# Bump when parse_data changes its output, to invalidate snapshots.
+PARSER_VERSION = 1
+
 
 PopData = namedtuple(
     "PopData", "country_name country_code year population")
@@ -28,26 +30,28 @@ supplemental_data = [
 
 
 
-def fetch_data(filename):
-    r = requests.get(ENDPOINT, stream=True)
-    filename.parent.mkdir(exist_ok=True)
-    with open(filename, "wb") as f:
-        for chunk in r.iter_content(chunk_size=128):
-            f.write(chunk)
+def update_data(filename, max_age_days=None):
+    if max_age_days is None:
+        policy = httpcache.get_policy("worldbank")
+    else:
+        policy = httpcache.Policy(max_age=max_age_days * 24 * 3600)
+
+    def refresh():
+        cached = httpcache.update(ENDPOINT, filename)
+        archive.record("worldbank", filename, cached.sha256)
+        return cached
+    return httpcache.revalidate(filename, policy, refresh, ENDPOINT)
 
 
-def update_data(filename, max_age_days=7):
-    filename = Path(filename)
-    try:
-        deadline = filename.stat().st_mtime + max_age_days * 24 * 3600
-    except FileNotFoundError:
-        deadline = 0
-    now = time.time()
-    if deadline <= now:
-        fetch_data(filename)
+def data_file(as_of=None):
+    # The current file, or the archived one for as_of.
+    if as_of is not None:
+        return archive.checkout("worldbank", as_of)
+    return update_data(CACHE_DIR / "pop.xls").path
 
 
 def read_data_rows(filename):
+    import xlrd
     book = xlrd.open_workbook(filename)
     sheet = book.sheet_by_name("Data")
     rows_iter = sheet.get_rows()
@@ -92,15 +96,50 @@ def parse_data(rows):
                       population=int(pop))
 
 
+def parse_file(filename):
+    data = list(parse_data(read_data_rows(filename)))
+    instrument.count("rows_parsed.worldbank", len(data))
+    return data
+
+
+def popdata_to_snapshot(data):
+    import numpy as np
+    arrays = dict(year=np.array([p.year for p in data], dtype=np.int32),
+                  population=np.array([p.population for p in data],
+                                      dtype=np.int64))
+    meta = dict(country_name=[p.country_name for p in data],
+                country_code=[p.country_code for p in data])
+    return arrays, meta
+
+
+def popdata_from_snapshot(arrays, meta):
+    return [PopData(name, code, year, population)
+            for name, code, year, population
+            in zip(meta["country_name"], meta["country_code"],
+                   arrays["year"].tolist(), arrays["population"].tolist())]
+
+
 def _get_file_data():
-    datafile = CACHE_DIR / "pop.xls"
-    update_data(datafile)
-    data = read_data_rows(datafile)
-    return parse_data(data)
+    return _cached_parse(data_file())
+
 
+def _cached_parse(datafile):
+    return snapshot.cached_parse(datafile, "pop", PARSER_VERSION,
+                                 parse_file, popdata_to_snapshot,
+                                 popdata_from_snapshot)
 
-def latest_population_count():
-    yield from _get_file_data()
+
+def population_count(datafile):
+    # Like latest_population_count, from a file already fetched.
+    yield from _cached_parse(datafile)
+    yield from supplemental_data
+
+
+def latest_population_count(as_of=None):
+    if as_of is None:
+        yield from _get_file_data()
+    else:
+        yield from _cached_parse(data_file(as_of))
     yield from supplemental_data
 
 
@@ -0,0 +1,73 @@
+import json, shutil, hashlib
+from pathlib import Path
+
+from readers import instrument, httpcache
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_digest(source_file):
+    return httpcache.known_sha256(source_file) or file_digest(source_file)
+
+
+def snapshot_dir(source_file, kind, version, digest):
+    source_file = Path(source_file)
+    name = f"{kind}-v{version}-{digest[:16]}"
+    return source_file.parent / "snapshots" / name
+
+
+def save(directory, arrays, meta):
+    import numpy as np
+    directory = Path(directory)
+    tmp = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name, values in arrays.items():
+        np.save(tmp / f"{name}.npy", np.ascontiguousarray(values))
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(dict(meta, arrays=sorted(arrays)), f)
+    shutil.rmtree(directory, ignore_errors=True)
+    tmp.rename(directory)
+
+
+def load(directory):
+    import numpy as np
+    directory = Path(directory)
+    with open(directory / "meta.json", "r") as f:
+        meta = json.load(f)
+    arrays = {name: np.load(directory / f"{name}.npy", mmap_mode="r")
+              for name in meta.pop("arrays")}
+    return arrays, meta
+
+
+def prune(directory, kind):
+    directory = Path(directory)
+    for other in directory.parent.glob(f"{kind}-v*"):
+        if other != directory:
+            shutil.rmtree(other, ignore_errors=True)
+
+
+def cached_parse(source_file, kind, version, parse, dump, restore):
+    directory = snapshot_dir(source_file, kind, version,
+                             source_digest(source_file))
+    try:
+        arrays, meta = load(directory)
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    else:
+        instrument.count(f"snapshot_hits.{kind}")
+        return restore(arrays, meta)
+
+    instrument.count(f"snapshot_misses.{kind}")
+    with instrument.span(f"parse.{kind}"):
+        result = parse(source_file)
+    arrays, meta = dump(result)
+    save(directory, arrays, meta)
+    prune(directory, kind)
+    return result
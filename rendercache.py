@@ -0,0 +1,63 @@
+# On-disk cache of rendered HTML, keyed by a hash of everything that went
+# into the rendering.  Entries expire after max_age seconds, and only the
+# max_entries most recently used are kept.
+
+import os, json, time, hashlib
+from pathlib import Path
+
+
+def _key_default(value):
+    # numpy arrays abbreviate their repr, so list their contents.
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return repr(value)
+
+
+class RenderCache:
+    def __init__(self, directory, max_entries=32, max_age=7 * 24 * 3600):
+        self.directory = Path(directory)
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    @staticmethod
+    def key(*parts):
+        text = json.dumps(parts, sort_keys=True, default=_key_default)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.html"
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.max_age:
+                return None
+            text = path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        os.utime(path)          # mark as recently used
+        return text
+
+    def put(self, key, text):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(path)
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for path in self.directory.glob("*.html"):
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if now - mtime > self.max_age:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((mtime, path))
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            path.unlink(missing_ok=True)
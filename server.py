@@ -0,0 +1,164 @@
+# Long-running mode: keeps the parsed case and population data, the
+# rendered page and the case density stats in memory and refreshes them
+# in the background.
+#
+#   python server.py [-s SOURCE] [-p PORT] [-i SECONDS]
+#                    [--max-stale SECONDS] [TEMPLATE]
+
+import sys, json, time, threading, traceback
+from io import StringIO
+from collections import namedtuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import stats, plots
+from readers import httpcache
+from readers.loader import load_concurrently, unwrap
+
+
+# Everything a request needs, pre-encoded so serving is a dict lookup,
+# and the parsed data it was built from.
+Snapshot = namedtuple("Snapshot",
+                      "page stats_json generated_at store popcount",
+                      defaults=(None, None))
+
+
+def build_snapshot(data_source, template_text):
+    store, index = unwrap(load_concurrently([
+        ("cases",
+         lambda: stats.load_store(stats.open_source(data_source))),
+        ("population", stats.population_index),
+    ]))
+    totals = stats.store_totals(store)
+    density = list(stats.density_from_totals(totals, index))
+
+    page = StringIO()
+    plots.render_page(data_source, StringIO(template_text), page,
+                      plots.exclude_outliers(density),
+                      age=plots.data_age(data_source))
+    stats_json = json.dumps([
+        dict(country=country, code=code, cases=cases,
+             cases_per_million=cases_per_million)
+        for country, code, cases, cases_per_million in density
+    ])
+    return Snapshot(page=page.getvalue().encode("utf-8"),
+                    stats_json=stats_json.encode("utf-8"),
+                    generated_at=time.time(),
+                    store=store, popcount=index)
+
+
+class Dataset:
+    # Seconds to wait before retrying a failed load, doubled after each
+    # further failure up to the refresh interval.
+    retry_delay = 5
+
+    def __init__(self, build):
+        self.build = build
+        self.current = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        try:
+            snapshot = self.build()
+        except Exception as e:
+            # Keep serving the last good snapshot.
+            self.last_error = e
+            traceback.print_exc()
+            return False
+        self.current = snapshot      # a single reference swap
+        self.last_error = None
+        return True
+
+    def start(self, interval):
+        def run():
+            failures = 0 if self.last_error is None else 1
+            while not self._stop.wait(self.next_delay(interval, failures)):
+                failures = 0 if self.refresh() else failures + 1
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def next_delay(self, interval, failures):
+        if failures == 0:
+            return interval
+        return min(interval, self.retry_delay * 2 ** (failures - 1))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+class Handler(BaseHTTPRequestHandler):
+    routes = {
+        "/": ("page", "text/html; charset=utf-8"),
+        "/stats.json": ("stats_json", "application/json"),
+    }
+
+    def do_GET(self):
+        route = self.routes.get(self.path.split("?", 1)[0])
+        if route is None:
+            self.send_error(404)
+            return
+        snapshot = self.server.dataset.current
+        if snapshot is None:
+            self.send_error(503, "Data not loaded yet")
+            return
+        field, content_type = route
+        body = getattr(snapshot, field)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified",
+                         self.date_time_string(snapshot.generated_at))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(dataset, host="127.0.0.1", port=8000):
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.dataset = dataset
+    return httpd
+
+
+def main():
+    source_name = "ecdc"
+    port = 8000
+    interval = 3600
+    template_path = "template.html"
+
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "-s":
+            source_name = next(args)
+        elif arg == "-p":
+            port = int(next(args))
+        elif arg == "-i":
+            interval = float(next(args))
+        elif arg == "--max-stale":
+            httpcache.max_stale = float(next(args))
+        else:
+            template_path = arg
+
+    data_source = plots.get_source(source_name)
+    with open(template_path, "r") as f:
+        template_text = f.read()
+
+    dataset = Dataset(lambda: build_snapshot(data_source, template_text))
+    dataset.refresh()
+    dataset.start(interval)
+    httpd = make_server(dataset, port=port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dataset.stop()
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
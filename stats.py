@@ -1,72 +1,307 @@
 import sys
-from collections import defaultdict
+from collections import namedtuple, defaultdict
 
-import readers.popreader
+import readers
+from readers import popindex, instrument, httpcache, make_filter
+from readers.loader import load_concurrently, unwrap
 
 
-# Maps the World Bank's country names to ECDC's names.
-country_name_map = {
-    "Egypt, Arab Rep.": "Egypt",
-    "Iran, Islamic Rep.": "Iran",
-    "Russian Federation": "Russia",
-    "Korea, Rep.": "South Korea",
-    "United States": "United States of America",
-}
+# Latest values of the timeseries metrics for one country.
+MetricRow = namedtuple(
+    "MetricRow",
+    "country code cases density incidence_7 incidence_14 growth"
+    " doubling_time")
 
 
-def latest_population_count():
-    for r in readers.popreader.latest_population_count():
-        canonical_name = country_name_map.get(r.country_name)
-        if canonical_name:
-            yield r._replace(country_name=canonical_name)
-        else:
-            yield r
+def population_index(as_of=None):
+    return popindex.population_index(as_of)
+
+
+def sum_days(data, workers=1):
+    import parallel
+    from readers.casestore import as_case_store
+    store = as_case_store(data)
+    cases, deaths = parallel.sum_by_country(store, workers)
+    reported = store.reported_countries()
+    for country, c, d in zip(store.country_names(), cases.tolist(),
+                             deaths.tolist()):
+        if country in reported:
+            yield country, c, d
 
 
-def sum_days(data):
+def sum_days_streaming(rows):
+    # Single pass over any row iterable, holding one accumulator per
+    # country instead of the rows themselves.
     cases_by_country = defaultdict(int)
     deaths_by_country = defaultdict(int)
-    for r in data:
+    for r in rows:
         cases_by_country[r.CountryExp] += r.NewConfCases
         deaths_by_country[r.CountryExp] += r.NewDeaths
-    for country in cases_by_country.keys() | deaths_by_country.keys():
-        cases = cases_by_country[country]
-        deaths = deaths_by_country[country]
-        yield country, cases, deaths
-
-
-def case_density(data_source, countries=[]):
-    stats = list(data_source())
-    popcount = list(latest_population_count())
-    pop_by_country = {p.country_name: p.population
-                      for p in popcount}
-    country_codes = iso_alpha3_codes(popcount)
-    if countries:
-        countries_set = set(s.lower() for s in countries)
+    for country, cases in cases_by_country.items():
+        yield country, cases, deaths_by_country[country]
+
+
+def open_source(data_source, where=None, as_of=None):
+    # Sources that understand filters apply them while reading; the
+    # totals of any other source are filtered afterwards.
+    kwargs = {}
+    if where is not None and getattr(data_source, "supports_filter", False):
+        kwargs["where"] = where
+    if as_of is not None:
+        if not getattr(data_source, "supports_as_of", False):
+            raise ValueError(f"No archived data for {data_source!r}")
+        kwargs["as_of"] = as_of
+    return data_source(**kwargs)
+
+
+def load_store(data):
+    # Fetching and parsing (or restoring a snapshot) happen here, so the
+    # aggregate span times the aggregation alone.
+    from readers.casestore import as_case_store
+    with instrument.span("load"):
+        return as_case_store(data)
+
+
+def country_totals(data_source, streaming=False, where=None, workers=1,
+                   as_of=None):
+    data = open_source(data_source, where, as_of)
+    if not streaming:
+        return store_totals(load_store(data), where, workers)
+    # Reading and aggregating are the same pass.
+    with instrument.span("aggregate.streaming"):
+        totals = list(sum_days_streaming(iter(data)))
+    return select_totals(totals, where)
+
+
+def store_totals(store, where=None, workers=1):
+    with instrument.span("aggregate"):
+        totals = list(sum_days(store, workers))
+    return select_totals(totals, where)
+
+
+def select_totals(totals, where):
+    if where is not None:
+        totals = [t for t in totals if where.match_country(t[0])]
+    return totals
+
+
+def case_series(data_source, where=None, as_of=None):
+    import timeseries
+    store = load_store(open_source(data_source, where, as_of))
+    with instrument.span("aggregate"):
+        return timeseries.daily_series(store)
+
+
+def load_all(data_sources, streaming=False, timeout=None, where=None,
+             series=False, workers=1, as_of=None):
+    # With series=True, each source is loaded as a timeseries.DailySeries
+    # instead of per-country totals.  With as_of, the archived versions
+    # of the source and population data for that date are used.
+    if series:
+        def load(s):
+            return case_series(s, where, as_of)
+    elif streaming:
+        def load(s):
+            return country_totals(s, True, where, as_of=as_of)
     else:
-        reported_countries = set(r.CountryExp for r in stats)
-        countries_set = set(s.lower() for s in
-                            pop_by_country.keys() & reported_countries)
-    for country, cases, deaths in sum_days(stats):
-        if country.lower() in countries_set:
-            cases_per_million = 1_000_000 * cases / pop_by_country[country]
-            yield country, country_codes[country], cases, cases_per_million
+        # Only the loading runs on the loader threads; the aggregation
+        # (and any worker processes it starts) runs on this one.
+        def load(s):
+            return load_store(open_source(s, where, as_of))
+    loaders = [(getattr(s, "name", repr(s)), lambda s=s: load(s))
+               for s in data_sources]
+    loaders.append(("population", lambda: population_index(as_of=as_of)))
+    results = load_concurrently(loaders, timeout=timeout)
+    source_results = results[:-1]
+    if not (series or streaming):
+        source_results = [aggregate_result(r, where, workers)
+                          for r in source_results]
+    return source_results, results[-1]
 
 
-def iso_alpha3_codes(popcount):
-    return {p.country_name: p.country_code for p in popcount}
+def aggregate_result(result, where, workers):
+    if result.error is not None:
+        return result
+    try:
+        return result._replace(value=store_totals(result.value, where,
+                                                  workers))
+    except Exception as e:
+        return result._replace(value=None, error=e)
+
+
+def case_density(data_source, countries=[], streaming=False, timeout=None,
+                 popcount=None, where=None, workers=1, as_of=None):
+    if where is None and countries:
+        where = make_filter(countries)
+    if popcount is None:
+        source_results, pop_result = load_all([data_source], streaming,
+                                              timeout, where,
+                                              workers=workers, as_of=as_of)
+        totals, popcount = unwrap(source_results + [pop_result])
+    else:
+        totals = country_totals(data_source, streaming, where, workers,
+                                as_of)
+    return density_from_totals(totals, popcount, countries)
+
+
+def density_from_totals(totals, popcount, countries=[]):
+    index = popindex.as_population_index(popcount)
+    countries_set = set(s.lower() for s in countries)
+    for country, cases, deaths in totals:
+        if countries_set:
+            if country.lower() not in countries_set:
+                continue
+            entry = index[country]
+        else:
+            entry = index.lookup(country)
+            if entry is None:
+                instrument.count("countries_dropped")
+                continue        # no population data
+        instrument.count("countries_matched")
+        cases_per_million = 1_000_000 * cases / entry.population
+        yield country, entry.code, cases, cases_per_million
+
+
+def load_metrics(data_source, timeout=None, popcount=None, where=None,
+                 workers=1, as_of=None):
+    # Returns the timeseries.Metrics and the population data they used.
+    if popcount is None:
+        source_results, pop_result = load_all([data_source], timeout=timeout,
+                                              where=where, series=True,
+                                              as_of=as_of)
+        series, popcount = unwrap(source_results + [pop_result])
+    else:
+        series = case_series(data_source, where, as_of)
+    metrics = metrics_from_series(series, popcount, where, workers)
+    return metrics, popcount
+
+
+def country_metrics(data_source, timeout=None, popcount=None, where=None,
+                    workers=1, as_of=None):
+    metrics, popcount = load_metrics(data_source, timeout, popcount, where,
+                                     workers, as_of)
+    return list(latest_metrics(metrics, popcount))
+
+
+def metrics_from_series(series, popcount, where=None, workers=1):
+    # Computes timeseries.Metrics for the countries with population data.
+    import parallel
+    index = popindex.as_population_index(popcount)
+    rows, population = [], []
+    for i, country in enumerate(series.countries):
+        entry = index.lookup(country)
+        if entry is None or (where is not None and
+                             not where.match_country(country)):
+            instrument.count("countries_dropped")
+            continue
+        instrument.count("countries_matched")
+        rows.append(i)
+        population.append(entry.population)
+    series = series._replace(countries=[series.countries[i] for i in rows],
+                             cases=series.cases[rows],
+                             deaths=series.deaths[rows])
+    with instrument.span("metrics"):
+        return parallel.compute_metrics(series, population, workers)
+
+
+def latest_metrics(metrics, popcount):
+    index = popindex.as_population_index(popcount)
+    if not metrics.dates:
+        return
+    columns = zip(metrics.cumulative[:, -1].tolist(),
+                  metrics.density[:, -1].tolist(),
+                  metrics.incidence_7[:, -1].tolist(),
+                  metrics.incidence_14[:, -1].tolist(),
+                  metrics.growth[:, -1].tolist(),
+                  metrics.doubling_time[:, -1].tolist())
+    for country, values in zip(metrics.countries, columns):
+        yield MetricRow(country, index.code(country), *values)
+
+
+USAGE = """usage: stats.py [--stream | --incidence] [-j N]
+                [--max-stale SECONDS]
+                [--metrics FILE [--metrics-format FMT]] COUNTRY...
+
+Print confirmed cases and cases per million for the given countries.
+--incidence prints the latest 7- and 14-day cases per million, the
+week-on-week growth and the doubling time in days instead.
+-j aggregates on N processes.
+--max-stale sets how long past its maximum age a download is still used
+while it is refreshed in the background; the program then waits for the
+refresh before it exits. 0 waits for a fresh copy up front instead.
+--metrics writes stage timings and counters to FILE (- for stderr) as
+json (the default) or prometheus text."""
+
+
+def parse_metrics_args(args):
+    rest_args = []
+    metrics_file, metrics_format = None, "json"
+    args = iter(args)
+    for arg in args:
+        if arg == "--metrics":
+            metrics_file = next(args)
+        elif arg == "--metrics-format":
+            metrics_format = next(args)
+        elif arg == "--max-stale":
+            httpcache.max_stale = float(next(args))
+        else:
+            rest_args.append(arg)
+    if metrics_file:
+        instrument.enable()
+    return rest_args, metrics_file, metrics_format
 
 
 def main():
-    countries = set(s.lower() for s in sys.argv[1:])
-    pop_by_country = {p.country_name: p.population
-                      for p in latest_population_count()}
-    data_source = readers.ecdc_source
-    for country, cases, deaths in sum_days(data_source()):
+    args = sys.argv[1:]
+    if "-h" in args or "--help" in args:
+        print(USAGE)
+        return
+    args, metrics_file, metrics_format = parse_metrics_args(args)
+    try:
+        print_stats(args)
+    finally:
+        if metrics_file:
+            instrument.write_report(metrics_file, metrics_format)
+
+
+def print_stats(args):
+    streaming = incidence = False
+    workers = 1
+    countries = set()
+    args = iter(args)
+    for arg in args:
+        if arg == "--stream":
+            streaming = True
+        elif arg == "--incidence":
+            incidence = True
+        elif arg == "-j":
+            workers = int(next(args))
+        else:
+            countries.add(arg.lower())
+    if incidence:
+        print_incidence(countries, workers)
+        return
+    source_results, pop_result = load_all([readers.ecdc_source], streaming,
+                                          where=make_filter(countries),
+                                          workers=workers)
+    totals, index = unwrap(source_results + [pop_result])
+    for country, cases, deaths in totals:
         if country.lower() in countries:
-            cases_per_million = 1_000_000 * cases / pop_by_country[country]
+            cases_per_million = 1_000_000 * cases / index.population(country)
             print(country, cases, cases_per_million)
 
 
+def print_incidence(countries, workers=1):
+    source_results, pop_result = load_all([readers.ecdc_source],
+                                          where=make_filter(countries),
+                                          series=True)
+    series, index = unwrap(source_results + [pop_result])
+    metrics = metrics_from_series(series, index, make_filter(countries),
+                                  workers)
+    for r in latest_metrics(metrics, index):
+        print(r.country, f"{r.incidence_7:.2f}", f"{r.incidence_14:.2f}",
+              f"{r.growth:+.1%}", f"{r.doubling_time:.1f}")
+
+
 if __name__ == "__main__":
     main()
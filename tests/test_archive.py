@@ -0,0 +1,112 @@
+import gzip
+import tempfile
+import threading
+from datetime import date, datetime, timezone
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from readers import archive
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmpdir.name)
+        self.directory = self.root / "archive"
+        self.source = self.root / "cases.csv"
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def record(self, contents, fetched):
+        self.source.write_bytes(contents)
+        return archive.record("cases", self.source, contents.hex(),
+                              fetched, self.directory)
+
+    def objects(self):
+        return sorted(p.name for p in
+                      (self.directory / "objects").glob("*/*.gz"))
+
+    def test_stores_each_content_once(self):
+        self.record(b"v1", "2020-03-01T10:00:00Z")
+        self.record(b"v1", "2020-03-01T11:00:00Z")
+        self.record(b"v2", "2020-03-02T10:00:00Z")
+        self.record(b"v1", "2020-03-03T10:00:00Z")
+        self.assertEqual([b"v1".hex() + ".gz", b"v2".hex() + ".gz"],
+                         self.objects())
+        versions = archive.read_partition(
+            archive.index_dir("cases", self.directory) / "2020-03.jsonl",
+            "cases")
+        self.assertEqual(["2020-03-01T10:00:00Z", "2020-03-02T10:00:00Z",
+                          "2020-03-03T10:00:00Z"],
+                         [v.fetched for v in versions])
+
+    def test_finds_version_as_of_date(self):
+        self.record(b"v1", "2020-03-30T10:00:00Z")
+        self.record(b"v2", "2020-03-31T10:00:00Z")
+        self.record(b"v3", "2020-05-02T10:00:00Z")
+
+        def find(as_of):
+            version = archive.find("cases", as_of, self.directory)
+            return version and bytes.fromhex(version.sha256)
+
+        with self.assertRaises(ValueError):
+            find(datetime(2020, 3, 30, 12))
+        self.assertIsNone(find(date(2020, 3, 29)))
+        self.assertEqual(b"v1", find(date(2020, 3, 30)))
+        self.assertEqual(b"v2", find(date(2020, 4, 15)))
+        self.assertEqual(b"v3", find(date(2020, 6, 1)))
+
+    def test_checks_out_archived_contents(self):
+        self.record(b"v1", "2020-03-01T10:00:00Z")
+        self.record(b"v2", "2020-03-02T10:00:00Z")
+        path = archive.checkout("cases", date(2020, 3, 1), self.directory)
+        self.assertEqual("cases.csv", path.name)
+        self.assertEqual(b"v1", path.read_bytes())
+        with self.assertRaises(LookupError):
+            archive.checkout("cases", date(2020, 2, 1), self.directory)
+
+    def test_compacts_past_months_to_one_version_a_day(self):
+        self.record(b"v1", "2020-03-01T10:00:00Z")
+        self.record(b"v2", "2020-03-01T20:00:00Z")
+        self.record(b"v3", "2020-04-01T10:00:00Z")
+        self.record(b"v4", "2020-04-01T20:00:00Z")
+        morning = datetime(2020, 3, 1, 12, tzinfo=timezone.utc)
+        path = archive.checkout("cases", morning, self.directory)
+        self.assertEqual(b"v1", path.read_bytes())
+        now = 1586131200                # 2020-04-06
+        archive.compact(self.directory, now)
+        self.assertEqual([s.hex() + ".gz" for s in (b"v2", b"v3", b"v4")],
+                         self.objects())
+        self.assertEqual([], list((self.directory / "files").glob("*")))
+        path = archive.checkout("cases", date(2020, 3, 1), self.directory)
+        self.assertEqual(b"v2", path.read_bytes())
+        with gzip.open(archive.object_path(b"v3".hex(), self.directory)) as f:
+            self.assertEqual(b"v3", f.read())
+
+    def test_compaction_waits_for_recording(self):
+        self.record(b"v1", "2020-03-01T10:00:00Z")
+        written = threading.Event()
+        resume = threading.Event()
+
+        def count(name, n=1):
+            if name == "archive_objects_written":
+                written.set()
+                resume.wait(5)
+
+        with patch("readers.instrument.count", count):
+            recording = threading.Thread(
+                target=self.record, args=(b"v2", "2020-03-02T10:00:00Z"))
+            recording.start()
+            written.wait(5)
+            compacting = threading.Thread(
+                target=archive.compact, args=(self.directory, 1583366400))
+            compacting.start()
+            compacting.join(0.2)
+            self.assertTrue(compacting.is_alive())
+            resume.set()
+            recording.join()
+            compacting.join()
+        self.assertEqual([b"v1".hex() + ".gz", b"v2".hex() + ".gz"],
+                         self.objects())
@@ -0,0 +1,58 @@
+from datetime import date
+from unittest import TestCase
+
+from readers import CaseDayData, make_filter
+from readers.casestore import CaseStore, CaseStoreBuilder, as_case_store
+import stats
+
+
+sample_rows = [
+    CaseDayData(date(2020, 3, 1), "A", 1, 0, "AA", "EU"),
+    CaseDayData(date(2020, 3, 2), "A", 2, 1, "AA", "EU"),
+    CaseDayData(date(2020, 3, 1), "B", 10, 3, "BB", None),
+    CaseDayData(None, "C", 100, 0, None, None),
+]
+
+
+class CaseStoreTest(TestCase):
+    def test_iterates_as_casedaydata(self):
+        store = CaseStore.from_rows(sample_rows)
+        self.assertEqual(sample_rows, list(store))
+
+    def test_sums_by_country(self):
+        store = CaseStore.from_rows(sample_rows)
+        cases, deaths = store.sum_by_country()
+        self.assertEqual(["A", "B", "C"], store.country_names())
+        self.assertEqual([3, 10, 100], cases.tolist())
+        self.assertEqual([1, 3, 0], deaths.tolist())
+
+    def test_selects_countries_and_dates(self):
+        store = CaseStore.from_rows(sample_rows)
+        where = make_filter(["a", "B"], start=date(2020, 3, 2))
+        self.assertEqual([sample_rows[1]], list(store.select(where)))
+        where = make_filter(exclude=["b"])
+        self.assertEqual(["A", "A", "C"],
+                         [r.CountryExp for r in store.select(where)])
+
+    def test_empty_store(self):
+        store = CaseStoreBuilder().build()
+        self.assertEqual(0, len(store))
+        self.assertEqual([], list(store))
+        self.assertEqual(set(), store.reported_countries())
+
+    def test_converts_iterables_and_sources(self):
+        store = CaseStore.from_rows(sample_rows)
+
+        class Source:
+            def case_store(self):
+                return store
+
+        self.assertIs(store, as_case_store(store))
+        self.assertIs(store, as_case_store(Source()))
+        self.assertEqual(sample_rows, list(as_case_store(iter(sample_rows))))
+
+
+class SumDaysTest(TestCase):
+    def test_accepts_rows(self):
+        result = sorted(stats.sum_days(iter(sample_rows)))
+        self.assertEqual([("A", 3, 1), ("B", 10, 3), ("C", 100, 0)], result)
@@ -0,0 +1,137 @@
+import hashlib, tempfile, threading
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from readers import download
+
+
+BODY = bytes(range(256)) * 64
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") == '"v1"':
+            start = int(range_header.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f"bytes {start}-{len(BODY) - 1}/{len(BODY)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(BODY) - start))
+        self.end_headers()
+        body = BODY[start:]
+        if server.fail_after is not None:
+            self.wfile.write(body[:server.fail_after])
+            self.wfile.flush()
+            server.fail_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeResponse:
+    # What requests returns, for bodies urllib3 may not check.
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+class DownloadTest(TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.filename = Path(self._tmpdir.name) / "data.bin"
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.httpd.requests = []
+        self.httpd.fail_after = None
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        host, port = self.httpd.server_address
+        self.url = f"http://{host}:{port}/data"
+        self._chunk_patcher = patch("readers.download.CHUNK_SIZE", 1024)
+        self._chunk_patcher.start()
+
+    def tearDown(self):
+        self._chunk_patcher.stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._tmpdir.cleanup()
+
+    def test_downloads_and_verifies_checksum(self):
+        expected = hashlib.sha256(BODY).hexdigest()
+        result = download.download(self.url, self.filename,
+                                   expected_sha256=expected)
+        self.assertEqual(BODY, self.filename.read_bytes())
+        self.assertEqual(expected, result.sha256)
+        self.assertEqual(len(BODY), result.size)
+
+    def test_rejects_checksum_mismatch_without_touching_target(self):
+        self.filename.write_bytes(b"old")
+        with self.assertRaises(ValueError):
+            download.download(self.url, self.filename,
+                              expected_sha256="0" * 64)
+        self.assertEqual(b"old", self.filename.read_bytes())
+        self.assertEqual(["data.bin"],
+                         [p.name for p in self.filename.parent.iterdir()])
+
+    def test_resumes_interrupted_download(self):
+        self.filename.write_bytes(b"old")
+        self.httpd.fail_after = 5000
+        with self.assertRaises(Exception):
+            download.download(self.url, self.filename)
+        self.assertEqual(b"old", self.filename.read_bytes())
+
+        result = download.download(self.url, self.filename)
+        self.assertEqual(BODY, self.filename.read_bytes())
+        self.assertEqual(206, result.status)
+        self.assertEqual(hashlib.sha256(BODY).hexdigest(), result.sha256)
+        self.assertTrue(self.httpd.requests[-1]["Range"].startswith("bytes="))
+
+    def test_rejects_body_shorter_than_content_length(self):
+        self.filename.write_bytes(b"old")
+        response = FakeResponse(200, {"ETag": '"v1"',
+                                      "Content-Length": str(len(BODY))},
+                                 BODY[:5000])
+        with patch("readers.download.get", lambda url, **kwargs: response):
+            with self.assertRaises(ConnectionError):
+                download.download(self.url, self.filename)
+        self.assertEqual(b"old", self.filename.read_bytes())
+
+    def test_rejects_range_not_starting_at_part_end(self):
+        self.httpd.fail_after = 5000
+        with self.assertRaises(Exception):
+            download.download(self.url, self.filename)
+        part = self.filename.with_name("data.bin.part")
+        partial = part.read_bytes()
+        response = FakeResponse(
+            206, {"ETag": '"v1"', "Content-Range":
+                  f"bytes 0-{len(BODY) - 1}/{len(BODY)}",
+                  "Content-Length": str(len(BODY))}, BODY)
+        with patch("readers.download.get", lambda url, **kwargs: response):
+            with self.assertRaises(ValueError):
+                download.download(self.url, self.filename)
+        self.assertEqual(partial, part.read_bytes())
+        self.assertFalse(self.filename.exists())
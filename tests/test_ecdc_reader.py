@@ -0,0 +1,55 @@
+from datetime import date
+from collections import namedtuple
+from unittest import TestCase
+
+from readers import CaseDayData, make_filter
+from readers.ecdc_reader import book_rows
+
+
+Cell = namedtuple("Cell", "value")
+
+
+class Book:
+    # Stands in for an xlrd workbook; get_rows() records what was read.
+    datemode = 0
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.read = 0
+
+    def sheet_by_name(self, name):
+        assert name == "CSV_4_COMS"
+        return self
+
+    def get_rows(self):
+        for row in self.rows:
+            self.read += 1
+            yield [Cell(v) for v in row]
+
+
+class BookRowsTest(TestCase):
+    def book(self):
+        return Book([
+            CaseDayData._fields,
+            (43891.0, "A", 1.0, 0.0, "AA", "EU"),      # 2020-03-01
+            (43892.0, "A", 2.0, 1.0, "AA", "EU"),
+            (43891.0, "B", 10.0, 3.0, "BB", "Non-EU"),
+        ])
+
+    def test_reads_rows_lazily(self):
+        book = self.book()
+        rows = book_rows(book)
+        self.assertEqual(CaseDayData(date(2020, 3, 1), "A", 1, 0, "AA", "EU"),
+                         next(rows))
+        self.assertEqual(2, book.read)
+        self.assertEqual(2, len(list(rows)))
+
+    def test_skips_filtered_rows(self):
+        where = make_filter(["b"], start=date(2020, 3, 1))
+        self.assertEqual(["B"],
+                         [r.CountryExp for r in book_rows(self.book(), where)])
+
+    def test_rejects_unexpected_header(self):
+        book = Book([("Date", "Country")])
+        with self.assertRaises(ValueError):
+            list(book_rows(book))
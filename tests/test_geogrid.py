@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import geogrid
+from readers.jhucsse_reader import Points
+
+
+points = Points(names=["A", "B", "C", "D"],
+                lats=[10.2, 10.8, -5.0, float("nan")],
+                longs=[20.1, 20.9, 100.0, 0.0],
+                cases=[10, 30, 5, 1000])
+
+
+class AggregateTest(TestCase):
+    def test_merges_points_in_the_same_cell(self):
+        cells = geogrid.aggregate(points, 1)
+        self.assertEqual([5, 40], cells.cases.tolist())
+        self.assertEqual(["C", "B"], cells.names)
+        self.assertEqual([1, 2], cells.regions.tolist())
+
+    def test_weights_centroids_by_cases(self):
+        cells = geogrid.aggregate(points, 1)
+        self.assertAlmostEqual(10.65, cells.lats[1])
+        self.assertAlmostEqual(20.7, cells.longs[1])
+
+    def test_splits_cells_at_finer_resolution(self):
+        cells = geogrid.aggregate(points, 0.5)
+        self.assertEqual(3, len(cells.cases))
+
+    def test_handles_points_without_location(self):
+        cells = geogrid.aggregate(points._replace(lats=[float("nan")] * 4), 1)
+        self.assertEqual(0, len(cells.cases))
+
+
+class LevelsTest(TestCase):
+    def test_skips_levels_without_new_cells(self):
+        levels = geogrid.levels(points, resolutions=(10, 5, 1, 0.5))
+        self.assertEqual([10, 0.5], [c.resolution for c in levels])
+
+    def test_stops_at_cell_limit(self):
+        levels = geogrid.levels(points, resolutions=(10, 0.5),
+                                max_cells=2)
+        self.assertEqual([10], [c.resolution for c in levels])
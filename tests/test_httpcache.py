@@ -0,0 +1,204 @@
+import hashlib, threading, tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from readers import httpcache
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer:
+    def __init__(self, body=b"hello", etag='"v1"'):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.httpd.body = body
+        self.httpd.etag = etag
+        self.httpd.requests = []
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/data"
+
+    def __enter__(self):
+        self.thread.start()
+        return self.httpd
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FetchTest(TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.filename = Path(self._tmpdir.name) / "data.bin"
+        self.stub = StubServer()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def fetch(self, policy=httpcache.Policy(max_age=0)):
+        return httpcache.fetch(self.stub.url, self.filename, policy)
+
+    def test_downloads_and_records_validators(self):
+        with self.stub:
+            result = self.fetch()
+        self.assertEqual(sha256(b"hello"), result.sha256)
+        self.assertEqual(b"hello", self.filename.read_bytes())
+        manifest = httpcache.read_manifest(self.filename)
+        self.assertEqual('"v1"', manifest["etag"])
+        self.assertEqual(result.sha256, manifest["sha256"])
+
+    def test_sends_conditional_request_and_handles_not_modified(self):
+        with self.stub as httpd:
+            self.fetch()
+            result = self.fetch()
+        self.assertEqual(sha256(b"hello"), result.sha256)
+        self.assertEqual('"v1"', httpd.requests[1].get("If-None-Match"))
+        self.assertEqual(b"hello", self.filename.read_bytes())
+
+    def test_fresh_file_is_not_revalidated(self):
+        with self.stub as httpd:
+            self.fetch()
+            result = self.fetch(httpcache.Policy(max_age=3600))
+        self.assertEqual(sha256(b"hello"), result.sha256)
+        self.assertEqual(1, len(httpd.requests))
+
+    def test_detects_changed_content(self):
+        with self.stub as httpd:
+            first = self.fetch()
+            httpd.body = b"world"
+            httpd.etag = '"v2"'
+            second = self.fetch()
+        self.assertNotEqual(first.sha256, second.sha256)
+        self.assertEqual(b"world", self.filename.read_bytes())
+
+    def test_downloads_again_when_cached_file_is_corrupted(self):
+        with self.stub as httpd:
+            self.fetch()
+            self.filename.write_bytes(b"hellp")
+            result = self.fetch()
+        self.assertNotIn("If-None-Match", httpd.requests[1])
+        self.assertEqual(sha256(b"hello"), result.sha256)
+        self.assertEqual(b"hello", self.filename.read_bytes())
+
+    def age_manifest(self, seconds):
+        manifest = httpcache.read_manifest(self.filename)
+        manifest["checked"] -= seconds
+        httpcache.write_manifest(self.filename, manifest)
+
+    def test_serves_stale_file_while_refreshing_in_background(self):
+        policy = httpcache.Policy(max_age=60, max_stale=3600)
+        with self.stub as httpd:
+            self.fetch()
+            self.age_manifest(600)
+            httpd.body = b"world"
+            httpd.etag = '"v2"'
+            result = self.fetch(policy)
+            self.assertEqual(sha256(b"hello"), result.sha256)
+            self.assertAlmostEqual(600, httpcache.data_age(self.filename),
+                                   delta=5)
+            httpcache.wait_for_refreshes()
+        self.assertEqual(b"world", self.filename.read_bytes())
+        self.assertEqual(2, len(httpd.requests))
+        # The served copy is pinned, so it still matches its age.
+        self.assertNotEqual(self.filename, result.path)
+        self.assertEqual(b"hello", result.path.read_bytes())
+        self.assertEqual(result.sha256, httpcache.known_sha256(result.path))
+
+    def test_prunes_earlier_pins(self):
+        policy = httpcache.Policy(max_age=60, max_stale=3600)
+        with self.stub as httpd:
+            self.fetch()
+            self.age_manifest(600)
+            first = self.fetch(policy)
+            httpcache.wait_for_refreshes()
+            httpd.body = b"world"
+            httpd.etag = '"v2"'
+            self.fetch()
+            self.age_manifest(600)
+            second = self.fetch(policy)
+            httpcache.wait_for_refreshes()
+        self.assertFalse(first.path.exists())
+        self.assertEqual(b"world", second.path.read_bytes())
+
+    def test_waits_for_files_past_max_stale(self):
+        policy = httpcache.Policy(max_age=60, max_stale=3600)
+        with self.stub as httpd:
+            self.fetch()
+            self.age_manifest(7200)
+            httpd.body = b"world"
+            httpd.etag = '"v2"'
+            result = self.fetch(policy)
+        self.assertEqual(sha256(b"world"), result.sha256)
+        self.assertEqual(b"world", self.filename.read_bytes())
+        self.assertLess(httpcache.data_age(self.filename), 5)
+
+    def test_keeps_serving_stale_file_when_refresh_fails(self):
+        policy = httpcache.Policy(max_age=60, max_stale=3600)
+        with self.stub:
+            self.fetch()
+        self.age_manifest(600)
+
+        def refresh():
+            raise ConnectionError("upstream down")
+
+        with self.assertLogs("readers.httpcache", "ERROR"):
+            result = httpcache.revalidate(self.filename, policy, refresh)
+            httpcache.wait_for_refreshes()
+        self.assertEqual(b"hello", result.path.read_bytes())
+
+    def test_serves_stored_file_when_refresh_past_max_stale_fails(self):
+        policy = httpcache.Policy(max_age=60, max_stale=3600)
+        with self.stub:
+            self.fetch()
+        self.age_manifest(7200)
+
+        def refresh():
+            raise ConnectionError("upstream down")
+
+        with self.assertLogs("readers.httpcache", "ERROR"):
+            result = httpcache.revalidate(self.filename, policy, refresh)
+        self.assertEqual(b"hello", result.path.read_bytes())
+        self.assertAlmostEqual(7200, httpcache.data_age(self.filename),
+                               delta=5)
+
+    def test_fails_without_stored_file(self):
+        def refresh():
+            raise ConnectionError("upstream down")
+
+        with self.assertRaises(ConnectionError):
+            httpcache.revalidate(self.filename, httpcache.Policy(60),
+                                 refresh)
+
+
+class PolicyTest(TestCase):
+    def test_max_stale_can_be_overridden(self):
+        self.assertEqual(24 * 3600, httpcache.get_policy("ecdc").max_stale)
+        with patch.object(httpcache, "max_stale", 0):
+            self.assertEqual(httpcache.Policy(3600, 0),
+                             httpcache.get_policy("ecdc"))
@@ -0,0 +1,27 @@
+import sys, json, subprocess
+from pathlib import Path
+from unittest import TestCase
+
+
+ROOT = Path(__file__).parent.parent
+
+HEAVY_MODULES = {"plotly", "pandas", "requests", "xlrd"}
+
+
+def loaded_modules(code):
+    code += "; import sys, json; print(json.dumps(sorted(sys.modules)))"
+    proc = subprocess.run([sys.executable, "-c", code], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    return set(json.loads(proc.stdout.splitlines()[-1]))
+
+
+class LazyImportTest(TestCase):
+    def test_importing_clis_loads_no_heavy_modules(self):
+        modules = loaded_modules("import plots, stats")
+        self.assertEqual(set(), modules & HEAVY_MODULES)
+
+    def test_help_loads_no_heavy_modules(self):
+        code = ("import sys, plots, stats; sys.argv[1:] = ['--help']; "
+                "plots.main(); stats.main()")
+        modules = loaded_modules(code)
+        self.assertEqual(set(), modules & (HEAVY_MODULES | {"numpy"}))
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from readers import instrument
+
+
+class InstrumentTest(TestCase):
+    def setUp(self):
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def test_records_nothing_when_disabled(self):
+        with instrument.span("stage"):
+            instrument.count("rows", 10)
+        self.assertEqual({"spans": {}, "counters": {}}, instrument.report())
+
+    def test_records_spans_and_counters(self):
+        instrument.enable()
+        for _ in range(2):
+            with instrument.span("stage"):
+                instrument.count("rows", 10)
+        report = instrument.report()
+        self.assertEqual(2, report["spans"]["stage"]["calls"])
+        self.assertGreaterEqual(report["spans"]["stage"]["seconds"], 0)
+        self.assertEqual({"rows": 20}, report["counters"])
+
+    def test_records_span_when_stage_fails(self):
+        instrument.enable()
+        with self.assertRaises(ValueError):
+            with instrument.span("stage"):
+                raise ValueError()
+        self.assertEqual(1, instrument.report()["spans"]["stage"]["calls"])
+
+    def test_formats_prometheus_text(self):
+        instrument.enable()
+        with instrument.span("download"):
+            instrument.count("rows_parsed.ecdc", 3)
+        text = instrument.prometheus_text()
+        self.assertIn('covidstats_stage_calls_total{stage="download"} 1',
+                      text)
+        self.assertIn("covidstats_rows_parsed_ecdc_total 3", text)
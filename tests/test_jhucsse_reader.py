@@ -1,11 +1,13 @@
+import tempfile
 from datetime import date
+from pathlib import Path
 from itertools import zip_longest
 from contextlib import contextmanager
 from unittest import TestCase, skip
 from unittest.mock import patch
 
 import readers.jhucsse_reader
-from readers import CaseDayData
+from readers import CaseDayData, NO_FILTER, make_filter
 
 
 sample_data = [
@@ -76,6 +78,20 @@ class StreamParserTest(TestCase):
         self.assertEqual([[(date(2020, 1, 1), 42)], [(date(2020, 1, 2), 1)]],
                          [r.cumulative_cases for r in result])
 
+    def test_records_share_date_axis(self):
+        data = [
+            "Province/State,Country/Region,Lat,Long,1/3/20,1/1/20",
+            "A,Country,0,0,3,1",
+            "B,Country,0,0,,2",
+        ]
+        a, b = self.parse_stream(data)
+        self.assertEqual([(date(2020, 1, 1), 1), (date(2020, 1, 3), 3)],
+                         a.cumulative_cases)
+        self.assertEqual(1, len(b.cumulative_cases))
+        self.assertEqual(3, len(a.cumulative_cases.counts))
+        self.assertIs(a.cumulative_cases.start, b.cumulative_cases.start)
+        self.assertIs(a.country, b.country)
+
 
 class CaseDayDataConversionTest(TestCase):
     def casedaydata_from_records(self, data):
@@ -148,19 +164,183 @@ class CaseDayDataConversionTest(TestCase):
             self.casedaydata_from_records(data)
 
 
+class TableParserTest(TestCase):
+    def casedaydata_from_table(self, data):
+        table = readers.jhucsse_reader.parse_table(iter(data))
+        return list(readers.jhucsse_reader.casestore_from_table(table))
+
+    def casedaydata_from_records(self, data):
+        records = readers.jhucsse_reader.parse_stream(iter(data))
+        return list(readers.jhucsse_reader.casedaydata_from_records(records))
+
+    def test_parses_header_dates_once(self):
+        table = readers.jhucsse_reader.parse_table(iter(sample_data))
+        self.assertEqual([date(2020, 1, 22), date(2020, 1, 23),
+                          date(2020, 1, 24)], table.dates)
+        self.assertEqual((3, 3), table.counts.shape)
+
+    def test_matches_record_based_conversion(self):
+        data = sample_data + [
+            "US,US,0,0,1,,5",
+            "Other,US,0,0,,,2",
+            ",Taiwan*,0,0,,,",
+        ]
+        self.assertEqual(self.casedaydata_from_records(data),
+                         self.casedaydata_from_table(data))
+
+    def test_rejects_conflicting_canonicalization(self):
+        data = [
+            "Province/State,Country/Region,Lat,Long,1/1/20",
+            ",United States of America,0,0,1",
+        ]
+        with self.assertRaises(ValueError):
+            self.casedaydata_from_table(data)
+
+    def test_treats_missing_trailing_cells_as_empty(self):
+        data = sample_data[:3] + [",Germany,51,9,1"]
+        table = readers.jhucsse_reader.parse_table(iter(data))
+        self.assertEqual([True, False, False], table.present[2].tolist())
+        self.assertEqual(self.casedaydata_from_records(data),
+                         self.casedaydata_from_table(data))
+
+    def test_handles_empty_file(self):
+        self.assertEqual([], self.casedaydata_from_table(sample_data[:1]))
+
+    def test_skips_rows_of_filtered_countries(self):
+        where = make_filter(["Germany"])
+        table = readers.jhucsse_reader.parse_table(iter(sample_data),
+                                                   where=where)
+        self.assertEqual(["Germany"], table.countries)
+
+    def test_keeps_latest_count_per_province(self):
+        data = sample_data + [",Taiwan*,23.7,121,3,,"]
+        table = readers.jhucsse_reader.parse_table(iter(data))
+        points = readers.jhucsse_reader.points_from_table(table)
+        self.assertEqual(["Beijing, Mainland China",
+                          "Hainan, Mainland China", "Germany", "Taiwan"],
+                         points.names)
+        self.assertEqual([36, 8, 0, 3], points.cases.tolist())
+        self.assertEqual(40.1824, points.lats[0])
+
+    def test_keeps_series_per_province(self):
+        data = sample_data + [",Taiwan*,23.7,121,,3,"]
+        table = readers.jhucsse_reader.parse_table(iter(data))
+        series = readers.jhucsse_reader.province_series(table)
+        self.assertEqual([[14, 22, 36], [4, 5, 8], [0, 0, 0], [0, 3, 3]],
+                         series.tolist())
+
+    def test_date_filter_keeps_per_day_counts(self):
+        where = make_filter(start=date(2020, 1, 24))
+        store = readers.jhucsse_reader.filtered_store(iter(sample_data),
+                                                      where)
+        expected = [r for r in self.casedaydata_from_table(sample_data)
+                    if r.DateRep >= date(2020, 1, 24)]
+        self.assertEqual(expected, list(store))
+
+
+class IncrementalUpdateTest(TestCase):
+    def update(self, data, state=None):
+        return readers.jhucsse_reader.incremental_update(iter(data), state)
+
+    def extended_data(self):
+        return [
+            sample_data[0] + ",1/25/20",
+            sample_data[1] + ",40",
+            sample_data[2] + ",",
+            sample_data[3] + ",2",
+        ]
+
+    def test_first_run_is_full_rebuild(self):
+        update = self.update(sample_data)
+        self.assertTrue(update.rebuilt)
+        self.assertEqual(6, len(update.store))
+        self.assertEqual(date(2020, 1, 24), update.state.watermark)
+        self.assertEqual({"Mainland China": 44, "Germany": 0},
+                         update.state.last_cumulative)
+
+    def test_emits_only_new_dates(self):
+        state = self.update(sample_data).state
+        update = self.update(self.extended_data(), state)
+        self.assertFalse(update.rebuilt)
+        expected = [
+            make_caseday("Germany", date(2020, 1, 25), 2),
+            make_caseday("Mainland China", date(2020, 1, 25), 40 - 44),
+        ]
+        self.assertEqual(expected, list(update.store))
+        self.assertEqual(date(2020, 1, 25), update.state.watermark)
+
+    def test_unchanged_file_yields_nothing(self):
+        state = self.update(sample_data).state
+        update = self.update(sample_data, state)
+        self.assertFalse(update.rebuilt)
+        self.assertEqual([], list(update.store))
+        self.assertEqual(state, update.state)
+
+    def test_rebuilds_when_history_is_revised(self):
+        state = self.update(sample_data).state
+        data = self.extended_data()
+        data[1] = data[1].replace(",22,", ",23,")
+        update = self.update(data, state)
+        self.assertTrue(update.rebuilt)
+        self.assertEqual(8, len(update.store))
+
+    def test_digests_history_in_one_pass(self):
+        state = self.update(sample_data).state
+        digests = readers.jhucsse_reader.history_digests
+        with patch("readers.jhucsse_reader.history_digests",
+                   side_effect=digests) as history_digests:
+            update = self.update(self.extended_data(), state)
+        self.assertEqual(1, history_digests.call_count)
+        self.assertFalse(update.rebuilt)
+
+    def test_new_rows_of_source_since_last_call(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            data = sample_data
+
+            @contextmanager
+            def fetch_data(as_of=None):
+                yield iter(data)
+
+            source = readers.jhucsse_reader.JhuCsseDataSource()
+            with patch("readers.jhucsse_reader.fetch_data", fetch_data), \
+                 patch("readers.jhucsse_reader.CACHE_DIR", Path(tmpdir)):
+                first = source.new_rows()
+                data = self.extended_data()
+                second = source.new_rows()
+        self.assertTrue(first.rebuilt)
+        self.assertEqual(6, len(first.store))
+        self.assertFalse(second.rebuilt)
+        self.assertEqual({date(2020, 1, 25)},
+                         {r.DateRep for r in second.store})
+
+    def test_drops_saved_state_when_rebuilt_without_one(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = Path(tmpdir) / "state.json"
+            jhu = readers.jhucsse_reader
+            jhu.save_state(filename, self.update(sample_data).state)
+            self.assertIsNotNone(jhu.load_state(filename))
+            update = self.update([sample_data[0] + ",1/1/20"] +
+                                 [row + ",0" for row in sample_data[1:]])
+            self.assertIsNone(update.state)
+            jhu.save_state(filename, update.state)
+            self.assertIsNone(jhu.load_state(filename))
+
+
 class DailyStatsTest(TestCase):
     def setUp(self):
-        self._fetch_patcher = patch("readers.jhucsse_reader.fetch_data")
-        self._fetch_mock = self._fetch_patcher.start()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.filename = Path(self._tmpdir.name) / "confirmed_global.csv"
+        self._file_patcher = patch("readers.jhucsse_reader.data_file",
+                                   lambda as_of=None: self.filename)
+        self._file_patcher.start()
 
     def tearDown(self):
-        self._fetch_patcher.stop()
+        self._file_patcher.stop()
+        self._tmpdir.cleanup()
 
-    def daily_stats(self, data=sample_data):
-        def fake_fetch():
-            yield iter(data)
-        self._fetch_mock.side_effect = contextmanager(fake_fetch)
-        return readers.jhucsse_reader.daily_stats()
+    def daily_stats(self, data=sample_data, where=NO_FILTER):
+        self.filename.write_text("\n".join(data) + "\n")
+        return readers.jhucsse_reader.daily_stats(where)
 
     def test_yields_casedaydata_with_country_and_cases(self):
         result = self.daily_stats()
@@ -173,3 +353,22 @@ class DailyStatsTest(TestCase):
             make_caseday("Germany", date(2020, 1, 24), 0),
         }
         self.assertEqual(expected, set(result))
+
+    def test_restores_unchanged_file_from_snapshot(self):
+        first = list(self.daily_stats())
+        with patch("readers.jhucsse_reader.filtered_store") as parse:
+            second = list(self.daily_stats())
+            filtered = list(self.daily_stats(where=make_filter(["Germany"])))
+        parse.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual({"Germany"}, {r.CountryExp for r in filtered})
+
+    def test_filtered_reads_save_and_restore_snapshot(self):
+        where = make_filter(exclude=["Germany"])
+        first = list(self.daily_stats(where=where))
+        self.assertTrue((self.filename.parent / "snapshots").exists())
+        with patch("readers.jhucsse_reader.filtered_store") as parse:
+            second = list(self.daily_stats(where=where))
+        parse.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual({"Mainland China"}, {r.CountryExp for r in second})
@@ -0,0 +1,39 @@
+import time
+from unittest import TestCase
+
+from readers.loader import load_concurrently, unwrap, SourceError
+
+
+class LoadConcurrentlyTest(TestCase):
+    def test_keeps_input_order(self):
+        def slow():
+            time.sleep(0.05)
+            return "slow"
+
+        results = load_concurrently([("a", slow), ("b", lambda: "fast")])
+        self.assertEqual(["a", "b"], [r.name for r in results])
+        self.assertEqual(["slow", "fast"], unwrap(results))
+
+    def test_runs_loaders_concurrently(self):
+        start = time.monotonic()
+        load_concurrently([(str(i), lambda: time.sleep(0.1))
+                           for i in range(4)])
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_reports_errors_per_source(self):
+        def fail():
+            raise ValueError("boom")
+
+        results = load_concurrently([("ok", lambda: 1), ("bad", fail)])
+        self.assertEqual(1, results[0].value)
+        self.assertIsInstance(results[1].error, ValueError)
+        with self.assertRaises(SourceError) as cm:
+            unwrap(results)
+        self.assertEqual("bad", cm.exception.name)
+
+    def test_reports_timeouts(self):
+        results = load_concurrently([("slow", lambda: time.sleep(0.5)),
+                                     ("fast", lambda: 2)],
+                                    timeout=0.05)
+        self.assertIsInstance(results[0].error, TimeoutError)
+        self.assertEqual(2, results[1].value)
@@ -0,0 +1,51 @@
+from datetime import date, timedelta
+from unittest import TestCase
+
+import numpy as np
+
+import parallel
+import timeseries
+from readers.casestore import CaseStoreBuilder
+
+
+def sample_store(countries=7, days=30):
+    rng = np.random.default_rng(3)
+    builder = CaseStoreBuilder()
+    start = date(2020, 3, 1)
+    for d in range(days):
+        for c in range(countries):
+            builder.add(start + timedelta(days=d), f"Country {c}",
+                        int(rng.integers(0, 1000)), int(rng.integers(0, 9)))
+    return builder.build()
+
+
+class PartitionsTest(TestCase):
+    def test_covers_range_without_empty_parts(self):
+        self.assertEqual([(0, 3), (3, 7)], parallel.partitions(7, 2))
+        self.assertEqual([(0, 1), (1, 2)], parallel.partitions(2, 8))
+        self.assertEqual([], parallel.partitions(0, 4))
+
+
+class ParallelTest(TestCase):
+    def test_sums_match_serial_path(self):
+        store = sample_store()
+        cases, deaths = store.sum_by_country()
+        for workers in (2, 3):
+            p_cases, p_deaths = parallel.sum_by_country(store, workers)
+            self.assertEqual(cases.tolist(), p_cases.tolist())
+            self.assertEqual(deaths.tolist(), p_deaths.tolist())
+
+    def test_reuses_one_pool(self):
+        self.assertIs(parallel.executor(2), parallel.executor(2))
+        self.assertIs(parallel.executor(2), parallel.executor(1))
+
+    def test_metrics_match_serial_path(self):
+        series = timeseries.daily_series(sample_store())
+        population = [1_000 * (i + 1) for i in range(7)]
+        expected = timeseries.compute(series, population)
+        result = parallel.compute_metrics(series, population, workers=3)
+        self.assertEqual(expected.dates, result.dates)
+        for field in parallel.METRIC_FIELDS:
+            self.assertTrue(np.array_equal(getattr(expected, field),
+                                           getattr(result, field),
+                                           equal_nan=True), field)
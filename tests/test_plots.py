@@ -1,8 +1,25 @@
+import os, gzip, tempfile
+from datetime import date, timedelta
+from pathlib import Path
 from unittest import TestCase
+from unittest.mock import patch
 from io import StringIO
 
+import numpy as np
 
-from plots import process_template
+from plots import (process_template, make_jobs, render_batch, write_map,
+                   render_pages,
+                   precompress, OutputOptions, compile_template,
+                   atomic_open, animation_data, delta_frames,
+                   write_animation, write_province_map)
+import geogrid
+import timeseries
+from rendercache import RenderCache
+from readers import CaseDayData
+from readers.jhucsse_reader import Points
+from readers.loader import LoadResult
+from readers.popreader import PopData
+from readers.popindex import build_index
 
 
 class TemplatingTest(TestCase):
@@ -58,3 +75,260 @@ class TemplatingTest(TestCase):
         template = "Hello <!-- INSERT MY-MIXED-NAME -->"
         result = self.process_template(template, {"my-MiXeD-NAME": "there"})
         self.assertEqual("Hello there", result)
+
+
+class StreamingTemplateTest(TestCase):
+    def test_reuses_compiled_template(self):
+        template = compile_template("one <!-- INSERT X --> three")
+        for value in ["two", "2"]:
+            outfile = StringIO()
+            process_template(template, outfile, {"x": value})
+            self.assertEqual(f"one {value} three", outfile.getvalue())
+
+    def test_accepts_callables_writing_to_output(self):
+        outfile = StringIO()
+        process_template(StringIO("a<!-- INSERT X -->c"), outfile,
+                         {"x": lambda f: f.write("b")})
+        self.assertEqual("abc", outfile.getvalue())
+
+    def test_accepts_iterables_of_chunks(self):
+        outfile = StringIO()
+        process_template(StringIO("a<!-- INSERT X -->d"), outfile,
+                         {"x": iter(["b", "c"])})
+        self.assertEqual("abcd", outfile.getvalue())
+
+    def test_atomic_open_leaves_no_partial_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "page.html"
+            path.write_text("old")
+            with self.assertRaises(RuntimeError):
+                with atomic_open(path) as f:
+                    f.write("partial")
+                    raise RuntimeError()
+            self.assertEqual("old", path.read_text())
+            self.assertEqual(["page.html"], os.listdir(tmpdir))
+            with atomic_open(path) as f:
+                f.write("new")
+            self.assertEqual("new", path.read_text())
+
+
+class BatchRenderingTest(TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmpdir.name)
+        self.template = self.dir / "template.html"
+        self.template.write_text(
+            "<!-- INSERT SOURCE-NAME -->: <!-- INSERT MAP -->")
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_rejects_mismatched_outputs(self):
+        with self.assertRaises(Exception):
+            make_jobs(["ecdc", "jhucsse"], ["t.html"], ["one.html"])
+
+    def test_shares_single_template(self):
+        jobs = make_jobs(["ecdc", "jhucsse"], ["t.html"], ["a", "b"])
+        self.assertEqual(["t.html", "t.html"], [j.template for j in jobs])
+
+    def test_loads_population_once_and_renders_each_source(self):
+        totals = [("A", 10, 0), ("San Marino", 1000, 0)]
+        popcount = [PopData("A", "AAA", 2019, 1000),
+                    PopData("San Marino", "SMR", 2019, 10)]
+        load_calls = []
+
+        def fake_load_all(data_sources, **kwargs):
+            load_calls.append(data_sources)
+            return ([LoadResult(s.name, totals, None) for s in data_sources],
+                    LoadResult("population", popcount, None))
+
+        jobs = make_jobs(["ecdc", "jhucsse"], [str(self.template)],
+                         [str(self.dir / "a.html"), str(self.dir / "b.html")])
+        def fake_write_map(outfile, data, options):
+            outfile.write(repr(data))
+
+        with patch("stats.load_all", fake_load_all), \
+             patch("plots.write_map", fake_write_map):
+            render_batch(jobs)
+
+        self.assertEqual(1, len(load_calls))
+        page = (self.dir / "a.html").read_text()
+        self.assertTrue(page.startswith("European Centre"))
+        self.assertIn("'AAA', 10, 10000.0", page)
+        self.assertNotIn("San Marino", page)
+
+    def test_shows_age_of_served_data(self):
+        self.template.write_text(
+            "Last updated: <!-- INSERT DATE --><!-- INSERT DATA-AGE -->.")
+
+        def fake_load_all(data_sources, **kwargs):
+            return ([LoadResult(s.name, [], None) for s in data_sources],
+                    LoadResult("population", [], None))
+
+        jobs = make_jobs(["ecdc"], [str(self.template)],
+                         [str(self.dir / "a.html")])
+        with patch("stats.load_all", fake_load_all), \
+             patch("readers.httpcache.data_age", lambda f: 3 * 3600 + 5):
+            render_batch(jobs)
+        page = (self.dir / "a.html").read_text()
+        self.assertTrue(page.endswith(" (data checked 3 hours ago)."))
+
+    def test_writes_plotlyjs_asset_once_per_directory(self):
+        def fake_load_all(data_sources, **kwargs):
+            return ([LoadResult(s.name, [], None) for s in data_sources],
+                    LoadResult("population", [], None))
+
+        written = []
+
+        def fake_write_asset(directory):
+            written.append(directory)
+            return "plotly.min.js"
+
+        def fake_write_map(outfile, data, options):
+            outfile.write(options.plotlyjs)
+
+        jobs = make_jobs(["ecdc", "jhucsse"], [str(self.template)],
+                         [str(self.dir / "a.html"), str(self.dir / "b.html")])
+        with patch("stats.load_all", fake_load_all), \
+             patch("plots.write_plotlyjs_asset", fake_write_asset), \
+             patch("plots.write_map", fake_write_map):
+            render_batch(jobs, options=OutputOptions(
+                compact=False, plotlyjs="asset", precompress=False))
+        self.assertEqual([self.dir], written)
+        self.assertTrue((self.dir / "b.html").read_text()
+                        .endswith(": plotly.min.js"))
+
+    def test_renders_batch_in_worker_processes(self):
+        def fake_load_all(data_sources, **kwargs):
+            return ([LoadResult(s.name, [("A", 10, 0)], None)
+                     for s in data_sources],
+                    LoadResult("population",
+                               [PopData("A", "AAA", 2019, 1000)], None))
+
+        jobs = make_jobs(["ecdc", "jhucsse"], [str(self.template)],
+                         [str(self.dir / "a.html"), str(self.dir / "b.html")])
+        cache = RenderCache(self.dir / "render")
+        with patch("stats.load_all", fake_load_all), \
+             patch("plots.render_cache", cache):
+            render_batch(jobs, workers=2, options=OutputOptions(
+                compact=True, plotlyjs=False, precompress=False))
+        page = (self.dir / "b.html").read_text()
+        self.assertTrue(page.startswith("Johns Hopkins"))
+        self.assertIn('"AAA"', page)
+        # The workers used the parent's render cache.
+        self.assertEqual(1, len(list((self.dir / "render").glob("*.html"))))
+
+    def test_rejects_precompress_without_output(self):
+        with self.assertRaises(Exception):
+            render_pages(["--no-render-cache", "--precompress"])
+
+
+class CompactOutputTest(TestCase):
+    data = [("China", "CHN", 81000, 56.27311),
+            ("Sweden", "SWE", 1623, 159.123456789),
+            ("Chad", "TCD", 1, 0.0612345678)]
+
+    def write_map(self, options):
+        buf = StringIO()
+        write_map(buf, self.data, options)
+        return buf.getvalue()
+
+    def test_references_external_plotlyjs(self):
+        options = OutputOptions(compact=True, plotlyjs="js/plotly.min.js",
+                                precompress=False)
+        html = self.write_map(options)
+        self.assertIn('src="js/plotly.min.js"', html)
+        self.assertLess(len(html), 100_000)
+
+    def test_rounds_values_to_display_precision(self):
+        options = OutputOptions(compact=True, plotlyjs=False,
+                                precompress=False)
+        html = self.write_map(options)
+        self.assertIn("159.12", html)
+        self.assertNotIn("159.123456789", html)
+        self.assertIn("hovertemplate", html)
+
+    def test_colors_by_selected_metric(self):
+        data = [("Sweden", "SWE", 1623, -12.5),
+                ("Chad", "TCD", 1, 40.0)]
+        options = OutputOptions(compact=True, plotlyjs=False,
+                                precompress=False, metric="growth")
+        buf = StringIO()
+        write_map(buf, data, options)
+        html = buf.getvalue()
+        self.assertIn("Weekly growth (%)", html)
+        self.assertIn("Growth over last week (%)", html)
+
+    def test_precompresses_output(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "page.html"
+            path.write_text("<p>" + "hello " * 1000 + "</p>")
+            precompress(path)
+            compressed = Path(f"{path}.gz").read_bytes()
+        self.assertEqual("<p>" + "hello " * 1000 + "</p>",
+                         gzip.decompress(compressed).decode())
+
+
+class AnimationTest(TestCase):
+    def animation(self, step=1):
+        start = date(2020, 3, 1)
+        rows = [CaseDayData(start + timedelta(days=d), country, n, 0,
+                            None, None)
+                for country, n in [("A", 1), ("B", 0)] for d in range(10)]
+        popcount = build_index([PopData("A", "AAA", 2019, 1_000_000),
+                                PopData("B", "BBB", 2019, 1_000_000)])
+        series = timeseries.daily_series(rows)
+        metrics = timeseries.compute(series, [1_000_000, 1_000_000])
+        return animation_data(metrics, popcount, "density", step)
+
+    def test_downsamples_up_to_latest_date(self):
+        animation = self.animation(step=7)
+        self.assertEqual(["2020-03-03", "2020-03-10"], animation.dates)
+        self.assertEqual([[3, 10], [0, 0]], animation.values.tolist())
+        self.assertEqual(["AAA", "BBB"], animation.codes)
+
+    def test_encodes_only_changed_values(self):
+        values = np.array([[1.0, 1.0, 2.0],
+                           [np.nan, np.nan, 5.0],
+                           [3.0, 4.0, 4.0]])
+        first, deltas = delta_frames(values)
+        self.assertEqual([1.0, None, 3.0], first)
+        self.assertEqual([[[2], [4.0]], [[0, 1], [2.0, 5.0]]], deltas)
+
+    def test_writes_frames_into_page(self):
+        options = OutputOptions(compact=True, plotlyjs=False,
+                                precompress=False, animate=1)
+        buf = StringIO()
+        write_animation(buf, self.animation(), options)
+        html = buf.getvalue()
+        self.assertIn("Plotly.addFrames", html)
+        self.assertIn('"2020-03-01"', html)
+        self.assertIn('"2020-03-10"', html)
+
+
+class ProvinceMapTest(TestCase):
+    def test_sends_one_marker_per_cell(self):
+        n = 5000
+        rng = np.random.default_rng(0)
+        points = Points([f"Region {i}" for i in range(n)],
+                        rng.uniform(-60, 70, n), rng.uniform(-180, 180, n),
+                        rng.integers(0, 1000, n))
+        levels = geogrid.levels(points, resolutions=(10, 5))
+        options = OutputOptions(compact=True, plotlyjs=False,
+                                precompress=False, provinces=True)
+        buf = StringIO()
+        write_province_map(buf, levels, options)
+        html = buf.getvalue()
+        self.assertIn("plotly_relayout", html)
+        self.assertNotIn("_fullLayout", html)
+        markers = sum(len(c.cases) for c in levels)
+        self.assertLess(markers, n / 2)
+        self.assertLessEqual(html.count("Region "), markers)
+
+    def test_rejects_points_without_location(self):
+        points = Points(["A", "B"], np.array([np.nan, 1.0]),
+                        np.array([2.0, np.nan]), np.array([1, 2]))
+        options = OutputOptions(compact=True, plotlyjs=False,
+                                precompress=False, provinces=True)
+        with self.assertRaises(ValueError):
+            write_province_map(StringIO(), geogrid.levels(points), options)
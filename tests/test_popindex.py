@@ -0,0 +1,66 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from readers.popreader import PopData
+from readers.popindex import build_index, population_index, PopulationIndex
+
+
+sample_population = [
+    PopData("United States", "USA", 2018, 327_167_434),
+    PopData("Korea, Rep.", "KOR", 2018, 51_635_256),
+    PopData("Taiwan", "TWN", 2020, 23_600_903),
+    PopData("Sweden", "SWE", 2018, 10_183_175),
+]
+
+
+class PopulationIndexTest(TestCase):
+    def setUp(self):
+        self.index = build_index(sample_population)
+
+    def test_uses_canonical_names(self):
+        self.assertEqual(["United States of America", "South Korea",
+                          "Taiwan", "Sweden"],
+                         [e.name for e in self.index])
+
+    def test_resolves_all_known_aliases(self):
+        for alias in ["United States", "United States of America", "US",
+                      "USA", "united states of america"]:
+            self.assertEqual(327_167_434, self.index.population(alias))
+        self.assertEqual("KOR", self.index.code("Korea, South"))
+        self.assertEqual("TWN", self.index.code("Taiwan*"))
+
+    def test_unknown_names(self):
+        self.assertNotIn("Atlantis", self.index)
+        self.assertIsNone(self.index.lookup("Atlantis"))
+        with self.assertRaises(KeyError):
+            self.index.population("Atlantis")
+
+    def test_round_trips_through_snapshot(self):
+        restored = PopulationIndex.from_snapshot(*self.index.to_snapshot())
+        self.assertEqual(list(self.index), list(restored))
+        self.assertEqual("SWE", restored.code("sweden"))
+
+
+class CachedPopulationIndexTest(TestCase):
+    def test_builds_from_the_file_it_is_keyed_by(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            datafile = Path(tmpdir) / "pop.xls"
+            datafile.write_bytes(b"stand-in workbook")
+            parsed = []
+
+            def parse_file(filename):
+                parsed.append(filename)
+                return sample_population[:1]
+
+            with patch("readers.popreader.data_file",
+                       lambda as_of=None: datafile), \
+                 patch("readers.popreader.parse_file", parse_file), \
+                 patch("readers.popreader.supplemental_data", []), \
+                 patch("readers.popreader.latest_population_count",
+                       side_effect=AssertionError("fetched again")):
+                index = population_index()
+        self.assertEqual([datafile], parsed)
+        self.assertEqual(["United States of America"],
+                         [e.name for e in index])
@@ -0,0 +1,59 @@
+import os, time, tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+import plots
+from rendercache import RenderCache
+
+
+class RenderCacheTest(TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.cache = RenderCache(Path(self._tmpdir.name) / "render",
+                                 max_entries=2, max_age=3600)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_returns_stored_text(self):
+        key = self.cache.key("map", [("A", "AAA", 1, 2.5)])
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, "<div>map</div>")
+        self.assertEqual("<div>map</div>", self.cache.get(key))
+
+    def test_key_depends_on_content(self):
+        self.assertEqual(self.cache.key("a", [1, 2.0]),
+                         self.cache.key("a", (1, 2.0)))
+        self.assertNotEqual(self.cache.key("a", [1, 2.0]),
+                            self.cache.key("a", [1, 2.5]))
+
+    def test_evicts_least_recently_used_entries(self):
+        for i, key in enumerate(["a", "b"]):
+            self.cache.put(key, key)
+            os.utime(self.cache.path(key), (1000 + i, time.time() - 10 + i))
+        self.cache.get("a")
+        self.cache.put("c", "c")
+        self.assertEqual("a", self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual("c", self.cache.get("c"))
+
+    def test_expires_old_entries(self):
+        self.cache.put("a", "a")
+        old = time.time() - 7200
+        os.utime(self.cache.path("a"), (old, old))
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_make_map_skips_rendering_on_hit(self):
+        data = [("A", "AAA", 1, 2.5)]
+        calls = []
+
+        def fake_write_map(outfile, data, options):
+            calls.append(data)
+            outfile.write("<div>map</div>")
+
+        with patch("plots.write_map", fake_write_map):
+            first = plots.make_map(data, cache=self.cache)
+            second = plots.make_map(list(data), cache=self.cache)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(first, second)
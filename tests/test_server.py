@@ -0,0 +1,167 @@
+import json, time, tempfile, threading
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import server, readers
+from benchmarks.fixtures import FakeBook, FakeSheet, FakeCell
+from readers import jhucsse_reader, popreader
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+confirmed_csv = b"""\
+Province/State,Country/Region,Lat,Long,1/22/20,1/23/20
+,A,0,0,4,10
+North,B,0,0,1,2
+South,B,0,0,3,5
+"""
+
+# Stands in for what xlrd reads from the World Bank download, since
+# xlrd cannot write workbooks.
+population_book = FakeBook({"Data": FakeSheet([
+    [FakeCell(v) for v in ("Country Name", "Country Code", "Indicator Name",
+                           "Indicator Code", "2018", "2019")],
+    [FakeCell(v) for v in ("A", "AAA", "Population, total", "SP.POP.TOTL",
+                           900.0, 1000.0)],
+    [FakeCell(v) for v in ("B", "BBB", "Population, total", "SP.POP.TOTL",
+                           7000.0, "")],
+])})
+
+
+class ServerTest(TestCase):
+    def setUp(self):
+        self.snapshots = []
+        self.dataset = server.Dataset(self.next_snapshot)
+        self.httpd = server.make_server(self.dataset, port=0)
+        threading.Thread(target=self.httpd.serve_forever,
+                         daemon=True).start()
+        host, port = self.httpd.server_address
+        self.base_url = f"http://{host}:{port}"
+
+    def tearDown(self):
+        self.dataset.stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def next_snapshot(self):
+        result = self.snapshots.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get(self, path):
+        with urlopen(self.base_url + path) as response:
+            return response.read()
+
+    def test_unavailable_before_first_load(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.get("/")
+        self.assertEqual(503, cm.exception.code)
+
+    def test_serves_page_and_stats(self):
+        self.snapshots.append(server.Snapshot(b"<p>map</p>", b"[]", 0))
+        self.dataset.refresh()
+        self.assertEqual(b"<p>map</p>", self.get("/"))
+        self.assertEqual(b"[]", self.get("/stats.json"))
+        with self.assertRaises(HTTPError) as cm:
+            self.get("/other")
+        self.assertEqual(404, cm.exception.code)
+
+    def test_retries_failed_initial_load_with_backoff(self):
+        self.snapshots.append(RuntimeError("upstream down"))
+        self.snapshots.append(RuntimeError("still down"))
+        self.snapshots.append(server.Snapshot(b"v1", b"[]", 0))
+        self.dataset.retry_delay = 0.01
+        with patch("traceback.print_exc"):
+            self.assertFalse(self.dataset.refresh())
+            self.dataset.start(interval=3600)
+            deadline = time.monotonic() + 5
+            while (self.dataset.current is None and
+                   time.monotonic() < deadline):
+                time.sleep(0.01)
+        self.assertEqual(b"v1", self.get("/"))
+
+    def test_backs_off_up_to_interval(self):
+        delays = [self.dataset.next_delay(60, failures)
+                  for failures in range(6)]
+        self.assertEqual([60, 5, 10, 20, 40, 60], delays)
+
+    def test_keeps_last_good_snapshot_when_refresh_fails(self):
+        self.snapshots.append(server.Snapshot(b"v1", b"[]", 0))
+        self.snapshots.append(RuntimeError("upstream down"))
+        self.dataset.refresh()
+        with patch("traceback.print_exc"):
+            self.assertFalse(self.dataset.refresh())
+        self.assertEqual(b"v1", self.get("/"))
+        self.assertIsInstance(self.dataset.last_error, RuntimeError)
+
+
+class BuildSnapshotTest(TestCase):
+    def setUp(self):
+        self.upstream = ThreadingHTTPServer(("127.0.0.1", 0),
+                                            UpstreamHandler)
+        self.upstream.files = {"/confirmed.csv": confirmed_csv,
+                               "/population.xls": b"stand-in workbook"}
+        threading.Thread(target=self.upstream.serve_forever,
+                         daemon=True).start()
+        host, port = self.upstream.server_address
+        base_url = f"http://{host}:{port}"
+
+        self._tmpdir = tempfile.TemporaryDirectory()
+        cache_dir = Path(self._tmpdir.name)
+        patches = [
+            patch.object(jhucsse_reader, "ENDPOINT",
+                         base_url + "/confirmed.csv"),
+            patch.object(jhucsse_reader, "CACHE_DIR", cache_dir),
+            patch.object(jhucsse_reader, "CACHE_FILE",
+                         cache_dir / "confirmed_global.csv"),
+            patch.object(popreader, "ENDPOINT", base_url + "/population.xls"),
+            patch.object(popreader, "CACHE_DIR", cache_dir),
+            patch("readers.archive.record"),
+            patch("xlrd.open_workbook",
+                  lambda filename, **kwargs: population_book),
+            patch("plots.write_map",
+                  lambda outfile, data, options: outfile.write("MAP")),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        self._tmpdir.cleanup()
+
+    def test_builds_from_upstream_files(self):
+        snapshot = server.build_snapshot(
+            readers.jhucsse_source,
+            "<!-- INSERT SOURCE-NAME -->: <!-- INSERT MAP -->")
+        self.assertTrue(snapshot.page.endswith(b": MAP"))
+        self.assertEqual([dict(country="A", code="AAA", cases=10,
+                               cases_per_million=10000.0),
+                          dict(country="B", code="BBB", cases=7,
+                               cases_per_million=1000.0)],
+                         json.loads(snapshot.stats_json))
+
+    def test_keeps_parsed_data_resident(self):
+        snapshot = server.build_snapshot(readers.jhucsse_source, "")
+        self.assertEqual(["A", "B"],
+                         sorted(snapshot.store.reported_countries()))
+        self.assertEqual(1000, snapshot.popcount["A"].population)
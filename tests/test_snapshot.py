@@ -0,0 +1,66 @@
+import tempfile
+from datetime import date
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from readers import CaseDayData, httpcache, snapshot
+from readers.casestore import CaseStore
+from readers.popreader import (PopData, popdata_to_snapshot,
+                               popdata_from_snapshot)
+
+
+class CachedParseTest(TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.source = Path(self._tmpdir.name) / "cases.xls"
+        self.source.write_bytes(b"version 1")
+        self.parse_count = 0
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def parse(self, filename):
+        self.parse_count += 1
+        return CaseStore.from_rows([
+            CaseDayData(date(2020, 3, 1), "A", 1, 0, "AA", "EU"),
+            CaseDayData(date(2020, 3, 2), "B", 5, 2, None, None),
+        ])
+
+    def cached_parse(self):
+        return snapshot.cached_parse(self.source, "cases", 1, self.parse,
+                                     CaseStore.to_snapshot,
+                                     CaseStore.from_snapshot)
+
+    def test_reuses_snapshot_for_unchanged_file(self):
+        first = list(self.cached_parse())
+        second = list(self.cached_parse())
+        self.assertEqual(1, self.parse_count)
+        self.assertEqual(first, second)
+
+    def test_reparses_changed_file_and_prunes_old_snapshot(self):
+        self.cached_parse()
+        self.source.write_bytes(b"version 2")
+        self.cached_parse()
+        self.assertEqual(2, self.parse_count)
+        snapshots = list((self.source.parent / "snapshots").iterdir())
+        self.assertEqual(1, len(snapshots))
+
+    def test_uses_digest_recorded_by_download_cache(self):
+        httpcache.write_manifest(self.source, dict(
+            sha256="ab" * 32, stat=httpcache.file_stat(self.source)))
+        with patch("readers.snapshot.file_digest") as file_digest:
+            self.cached_parse()
+            self.cached_parse()
+        file_digest.assert_not_called()
+        self.assertEqual(1, self.parse_count)
+        self.source.write_bytes(b"version 2, edited")
+        self.cached_parse()
+        self.assertEqual(2, self.parse_count)
+
+    def test_round_trips_population_data(self):
+        data = [PopData("Country 1", "ONE", 2019, 1000),
+                PopData("Country 2", "TWO", 2018, 3_000_000_000)]
+        directory = Path(self._tmpdir.name) / "pop"
+        snapshot.save(directory, *popdata_to_snapshot(data))
+        self.assertEqual(data, popdata_from_snapshot(*snapshot.load(directory)))
@@ -0,0 +1,201 @@
+import tempfile
+import threading
+from datetime import date
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+from contextlib import contextmanager
+
+import stats
+from readers import CaseDayData, make_filter
+from readers.loader import SourceError
+from readers.jhucsse_reader import JhuCsseDataSource
+from readers.casestore import CaseStore
+from readers.popreader import PopData
+from readers.popindex import build_index
+
+
+sample_rows = [
+    CaseDayData(date(2020, 3, 1), "A", 10, 1, None, None),
+    CaseDayData(date(2020, 3, 2), "A", 20, 0, None, None),
+    CaseDayData(date(2020, 3, 1), "B", 5, 0, None, None),
+    CaseDayData(date(2020, 3, 1), "Unknown", 7, 0, None, None),
+]
+
+sample_population = [
+    PopData("A", "AAA", 2019, 1_000_000),
+    PopData("B", "BBB", 2019, 500_000),
+    PopData("C", "CCC", 2019, 100),
+]
+
+
+class CaseDensityTest(TestCase):
+    def case_density(self, **kwargs):
+        with patch("stats.population_index",
+                   lambda as_of=None: build_index(sample_population)):
+            return sorted(stats.case_density(lambda: iter(sample_rows),
+                                             **kwargs))
+
+    def test_reports_countries_with_population_data(self):
+        expected = [("A", "AAA", 30, 30.0), ("B", "BBB", 5, 10.0)]
+        self.assertEqual(expected, self.case_density())
+
+    def test_streaming_matches_columnar_result(self):
+        self.assertEqual(self.case_density(),
+                         self.case_density(streaming=True))
+
+        # Provinces with gaps, and a country whose rows are apart.
+        lines = [
+            "Province/State,Country/Region,Lat,Long,3/1/20,3/2/20,3/3/20",
+            "North,A,0,0,5,,7",
+            "South,A,0,0,1,2,4",
+            ",B,0,0,,3,6",
+            "East,A,0,0,,,1",
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = Path(tmpdir) / "confirmed_global.csv"
+            filename.write_text("\n".join(lines) + "\n")
+
+            @contextmanager
+            def fetch_data(as_of=None):
+                with open(filename, "r", newline="") as f:
+                    yield f
+
+            with patch("readers.jhucsse_reader.fetch_data", fetch_data), \
+                 patch("readers.jhucsse_reader.data_file",
+                       lambda as_of=None: filename):
+                columnar = sorted(stats.country_totals(JhuCsseDataSource))
+                streamed = sorted(stats.country_totals(JhuCsseDataSource,
+                                                       streaming=True))
+        self.assertEqual([("A", 12, 0), ("B", 6, 0)], columnar)
+        self.assertEqual(columnar, streamed)
+
+    def test_pushes_countries_down_to_filtering_sources(self):
+        opened = []
+
+        class Source:
+            supports_filter = True
+
+            def __init__(self, where):
+                opened.append(where)
+
+            def __iter__(self):
+                return iter(r for r in sample_rows
+                            if opened[0].match_country(r.CountryExp))
+
+        with patch("stats.population_index",
+                   lambda as_of=None: build_index(sample_population)):
+            result = list(stats.case_density(Source, countries=["b"]))
+        self.assertEqual([("B", "BBB", 5, 10.0)], result)
+        self.assertEqual([make_filter(["b"])], opened)
+
+    def test_filters_totals_of_other_sources(self):
+        where = make_filter(exclude=["A"])
+        self.assertEqual([("B", "BBB", 5, 10.0)],
+                         self.case_density(where=where))
+
+    def test_reports_latest_incidence(self):
+        with patch("stats.population_index",
+                   lambda as_of=None: build_index(sample_population)):
+            result = stats.country_metrics(lambda: iter(sample_rows))
+        self.assertEqual(["A", "B"], [r.country for r in result])
+        self.assertEqual("AAA", result[0].code)
+        self.assertEqual(30, result[0].cases)
+        self.assertEqual(30.0, result[0].incidence_7)
+        self.assertEqual(10.0, result[1].incidence_14)
+
+    def test_streaming_consumes_source_once(self):
+        consumed = []
+
+        def source():
+            for r in sample_rows:
+                consumed.append(r)
+                yield r
+
+        with patch("stats.population_index",
+                   lambda as_of=None: build_index(sample_population)):
+            list(stats.case_density(source, streaming=True))
+        self.assertEqual(sample_rows, consumed)
+
+    def test_streams_rows_of_real_reader(self):
+        lines = [
+            "Province/State,Country/Region,Lat,Long,3/1/20,3/2/20",
+            "North,A,0,0,4,10",
+            "South,A,0,0,5,20",
+            ",B,0,0,1,5",
+            ",C,0,0,2,2",
+        ]
+        read = []
+
+        def stream():
+            for line in lines:
+                read.append(line)
+                yield line
+
+        @contextmanager
+        def fetch_data(as_of=None):
+            yield stream()
+
+        with patch("readers.jhucsse_reader.fetch_data", fetch_data), \
+             patch("readers.jhucsse_reader.daily_stats",
+                   side_effect=AssertionError("built a store")):
+            rows = iter(JhuCsseDataSource())
+            first = next(rows)
+            # A country's rows are yielded once the next country starts.
+            self.assertEqual(4, len(read))
+            self.assertEqual(("A", 9), (first.CountryExp, first.NewConfCases))
+            totals = stats.country_totals(JhuCsseDataSource, streaming=True)
+        self.assertEqual([("A", 30, 0), ("B", 5, 0), ("C", 2, 0)],
+                         sorted(totals))
+
+    def test_times_loading_apart_from_aggregation(self):
+        events = []
+
+        class Source:
+            def case_store(self):
+                events.append("case_store")
+                return CaseStore.from_rows(sample_rows)
+
+        @contextmanager
+        def span(name):
+            events.append(name)
+            yield
+            events.append("end " + name)
+
+        with patch("readers.instrument.span", span):
+            stats.country_totals(Source)
+        self.assertEqual(["load", "case_store", "end load",
+                          "aggregate", "end aggregate"], events)
+
+    def test_aggregates_on_calling_thread(self):
+        threads = []
+        sum_days = stats.sum_days
+
+        def recording_sum_days(store, workers=1):
+            threads.append(threading.current_thread())
+            return sum_days(store, workers)
+
+        with patch("stats.sum_days", recording_sum_days):
+            self.assertEqual([("A", "AAA", 30, 30.0), ("B", "BBB", 5, 10.0)],
+                             self.case_density(workers=2))
+        self.assertEqual([threading.current_thread()], threads)
+
+    def test_passes_as_of_to_archiving_sources(self):
+        opened = []
+
+        class Source:
+            supports_as_of = True
+
+            def __init__(self, as_of):
+                opened.append(as_of)
+
+            def __iter__(self):
+                return iter(sample_rows)
+
+        with patch("stats.population_index",
+                   lambda as_of=None: build_index(sample_population)):
+            list(stats.case_density(Source, as_of=date(2020, 3, 2)))
+            self.assertEqual([date(2020, 3, 2)], opened)
+            with self.assertRaises(SourceError):
+                list(stats.case_density(lambda: iter(sample_rows),
+                                        as_of=date(2020, 3, 2)))
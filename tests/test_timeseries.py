@@ -0,0 +1,60 @@
+from datetime import date
+from unittest import TestCase
+
+import numpy as np
+
+import timeseries
+from readers import CaseDayData
+
+
+def rows(country, start, counts):
+    return [CaseDayData(date.fromordinal(start.toordinal() + i), country,
+                        n, 0, None, None)
+            for i, n in enumerate(counts)]
+
+
+class DailySeriesTest(TestCase):
+    def test_lays_out_countries_by_day(self):
+        data = (rows("A", date(2020, 3, 1), [1, 2, 3]) +
+                rows("B", date(2020, 3, 2), [10]) +
+                [CaseDayData(None, "B", 100, 0, None, None)])
+        series = timeseries.daily_series(data)
+        self.assertEqual(["A", "B"], series.countries)
+        self.assertEqual(date(2020, 3, 1).toordinal(), series.start)
+        self.assertEqual([[1, 2, 3], [0, 10, 0]], series.cases.tolist())
+        self.assertEqual([date(2020, 3, 1), date(2020, 3, 2),
+                          date(2020, 3, 3)], timeseries.dates(series))
+
+    def test_handles_empty_data(self):
+        series = timeseries.daily_series([])
+        self.assertEqual((0, 0), series.cases.shape)
+
+
+class RollingWindowTest(TestCase):
+    def test_matches_naive_window_sums(self):
+        matrix = np.random.default_rng(1).integers(0, 100, (5, 30))
+        for window in (1, 7, 14, 40):
+            expected = [[sum(row[max(0, t - window + 1):t + 1])
+                         for t in range(len(row))]
+                        for row in matrix.tolist()]
+            self.assertEqual(expected,
+                             timeseries.rolling_sum(matrix, window).tolist())
+
+    def test_incidence_per_million(self):
+        series = timeseries.daily_series(rows("A", date(2020, 3, 1),
+                                              [1] * 10))
+        result = timeseries.incidence(series, [500_000], 7)
+        self.assertEqual(14.0, result[0, -1])
+        self.assertEqual(2.0, result[0, 0])
+
+    def test_growth_and_doubling_time(self):
+        counts = [1] * 7 + [2] * 7 + [1] * 7
+        series = timeseries.daily_series(rows("A", date(2020, 3, 1),
+                                              counts))
+        growth = timeseries.growth_rate(series, 7)
+        self.assertTrue(np.isnan(growth[0, 12]))
+        self.assertEqual(1.0, growth[0, 13])
+        self.assertEqual(-0.5, growth[0, 20])
+        doubling = timeseries.doubling_time(growth, 7)
+        self.assertAlmostEqual(7.0, doubling[0, 13])
+        self.assertTrue(np.isnan(doubling[0, 20]))
@@ -0,0 +1,107 @@
+# Per-day metrics for every country at once.  Daily counts are laid out
+# as a dense (countries, days) matrix, so trailing-window sums are one
+# cumulative sum and a subtraction instead of a loop per day and window.
+
+from collections import namedtuple
+
+import numpy as np
+
+from readers.casestore import NO_DATE, as_case_store, ordinal_to_date
+
+
+# cases and deaths are (countries, days) matrices of new daily counts,
+# day 0 being start (a date ordinal); days without reports are zero.
+DailySeries = namedtuple("DailySeries", "countries start cases deaths")
+
+# Matrices shaped like DailySeries.cases.  density and the incidences
+# are per million inhabitants, growth is the change of the 7-day sum
+# relative to the preceding 7 days, and doubling_time is in days (nan
+# unless growing).
+Metrics = namedtuple(
+    "Metrics",
+    "countries dates cumulative density incidence_7 incidence_14 growth"
+    " doubling_time")
+
+
+def daily_series(data):
+    store = as_case_store(data)
+    dated = store.date_ordinal != NO_DATE
+    country_index = store.country_index[dated].astype(np.int64)
+    ordinals = store.date_ordinal[dated].astype(np.int64)
+    n = len(store.countries)
+    if not len(ordinals):
+        empty = np.zeros((n, 0), dtype=np.int64)
+        return DailySeries(store.country_names(), NO_DATE, empty, empty)
+
+    start = int(ordinals.min())
+    days = int(ordinals.max()) - start + 1
+    cell = country_index * days + (ordinals - start)
+
+    def matrix(values):
+        m = np.bincount(cell, weights=values[dated], minlength=n * days)
+        return m.astype(np.int64).reshape(n, days)
+
+    return DailySeries(store.country_names(), start,
+                       matrix(store.cases), matrix(store.deaths))
+
+
+def dates(series):
+    return [ordinal_to_date(series.start + i)
+            for i in range(series.cases.shape[1])]
+
+
+def rolling_sum(matrix, window):
+    # Column t holds the sum of columns t-window+1..t; the first columns
+    # sum over the days available so far.
+    prefix = np.zeros((matrix.shape[0], matrix.shape[1] + 1),
+                      dtype=np.int64)
+    np.cumsum(matrix, axis=1, out=prefix[:, 1:])
+    lagged = np.empty_like(prefix[:, 1:])
+    lagged[:, :window] = 0
+    lagged[:, window:] = prefix[:, 1:-window]
+    return prefix[:, 1:] - lagged
+
+
+def incidence(series, population, window, per=1_000_000):
+    population = np.asarray(population, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return rolling_sum(series.cases, window) * per / population[:, None]
+
+
+def growth_rate(series, window=7):
+    # Ratio of the trailing window to the window before it, minus one;
+    # nan where the earlier window is empty or not yet complete.
+    current = rolling_sum(series.cases, window).astype(np.float64)
+    previous = np.full_like(current, np.nan)
+    previous[:, 2 * window - 1:] = current[:, window - 1:-window]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(previous > 0, current / previous - 1, np.nan)
+
+
+def doubling_time(growth, window=7):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days = window * np.log(2) / np.log1p(growth)
+    return np.where(growth > 0, days, np.nan)
+
+
+def compute(series, population):
+    return Metrics(countries=series.countries,
+                   dates=dates(series),
+                   **metric_matrices(series.cases, population))
+
+
+def metric_matrices(cases, population):
+    # Every row depends only on its own country, so any subset of rows
+    # can be computed separately.
+    series = DailySeries(None, NO_DATE, cases, None)
+    growth = growth_rate(series, 7)
+    cumulative = np.cumsum(cases, axis=1)
+    population = np.asarray(population, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        density = cumulative * 1_000_000 / population[:, None]
+    return dict(cumulative=cumulative,
+                density=density,
+                incidence_7=incidence(series, population, 7),
+                incidence_14=incidence(series, population, 14),
+                growth=growth,
+                doubling_time=doubling_time(growth, 7))